@@ -0,0 +1,130 @@
+"""Keeps one copy of each distinct file in the cache
+
+NCBI re-versions assemblies without changing most of their files and
+lots of accessions have identical READMEs.  Downloads are stored once
+under blobs/ by their md5 (which we've already worked out to check
+them) and each cached path is a hard link to its blob, so everything
+else can keep opening files by path."""
+
+import logging
+import os
+
+from threading import Lock
+
+class BlobStore(object):
+  """Content addressed storage for a cache directory
+
+  A blob's link count is its reference count: when the last cached path
+  linking to it is removed (with unlink) the blob goes too.  Which blob
+  each path links to is appended to a tab separated file so that this
+  survives restarts; blobs left with no links (e.g. if that file was
+  lost) are removed by collect."""
+  def __init__(self, root_dir):
+    self.root_dir = root_dir
+    self.blob_dir = os.path.join(root_dir, 'blobs')
+    self.index_path = os.path.join(root_dir, 'blobs.tsv')
+    self.links = {} # path -> md5
+    self.lock = Lock()
+    self.hits = 0
+    self.misses = 0
+    try:
+      with open(self.index_path) as f:
+        for line in f:
+          try:
+            path, md5 = line.rstrip('\n').split('\t')
+            self.links[path] = md5
+          except ValueError:
+            pass # probably a partially written line
+    except IOError:
+      pass
+
+  def blob_path(self, md5):
+    return os.path.join(self.blob_dir, md5[:2], md5)
+
+  def store(self, temp_path, md5, path):
+    """Moves temp_path into the store and links path (relative to the root) to it
+
+    If we already have a blob with the same md5, temp_path is deleted
+    instead.  Readers of temp_path keep their file handles either way."""
+    blob_path = self.blob_path(md5)
+    cache_path = os.path.join(self.root_dir, path)
+    with self.lock:
+      for directory in (os.path.dirname(blob_path), os.path.dirname(cache_path)):
+        if not os.path.isdir(directory):
+          os.makedirs(directory, 0755)
+      if os.path.isfile(blob_path):
+        os.remove(temp_path)
+        self.hits += 1
+      else:
+        os.rename(temp_path, blob_path)
+        self.misses += 1
+      # link then rename so that path is replaced in one step
+      os.link(blob_path, temp_path)
+      os.rename(temp_path, cache_path)
+      if self.links.get(path) != md5:
+        self.links[path] = md5
+        with open(self.index_path, 'a') as f:
+          f.write("%s\t%s\n" % (path, md5))
+
+  def unlink(self, path):
+    """Removes a cached path and its blob if nothing else links to it"""
+    cache_path = os.path.join(self.root_dir, path)
+    with self.lock:
+      try:
+        st = os.lstat(cache_path)
+        os.remove(cache_path)
+      except OSError:
+        return
+      md5 = self.links.pop(path, None)
+      if md5 is None or st.st_nlink != 2:
+        return
+      blob_path = self.blob_path(md5)
+      try:
+        if os.lstat(blob_path).st_ino == st.st_ino:
+          os.remove(blob_path)
+      except OSError:
+        pass
+
+  def collect(self):
+    """Removes blobs which no cached path links to; returns how many"""
+    removed = 0
+    for blob_path in self._blob_paths():
+      with self.lock:
+        try:
+          if os.lstat(blob_path).st_nlink == 1:
+            os.remove(blob_path)
+            removed += 1
+        except OSError:
+          pass
+    if removed:
+      logging.info("Removed %s unused blobs" % removed)
+    return removed
+
+  def stats(self):
+    """How much space deduplication is saving"""
+    blobs = blob_bytes = linked_bytes = 0
+    for blob_path in self._blob_paths():
+      try:
+        st = os.lstat(blob_path)
+      except OSError:
+        continue
+      blobs += 1
+      blob_bytes += st.st_size
+      linked_bytes += st.st_size * (st.st_nlink - 1)
+    return dict(blobs=blobs, blob_bytes=blob_bytes, linked_bytes=linked_bytes,
+                saved_bytes=max(linked_bytes - blob_bytes, 0),
+                hits=self.hits, misses=self.misses)
+
+  def _blob_paths(self):
+    try:
+      prefixes = os.listdir(self.blob_dir)
+    except OSError:
+      return
+    for prefix in prefixes:
+      prefix_dir = os.path.join(self.blob_dir, prefix)
+      try:
+        names = os.listdir(prefix_dir)
+      except OSError:
+        continue
+      for name in names:
+        yield os.path.join(prefix_dir, name)
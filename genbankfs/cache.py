@@ -1,3 +1,5 @@
+import ctypes
+import ctypes.util
 import hashlib
 import logging
 import os
@@ -6,16 +8,79 @@ import socket
 import tempfile
 import urllib
 
-from Queue import Queue, Full, Empty
+from errno import EIO
+from functools import partial
+from Queue import Full, Empty
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from StringIO import StringIO
-from threading import Lock, Thread, Event
+from threading import Condition, Lock, Thread, Event, local
 from time import time
 from urlparse import urlparse
 
+from boltons.cacheutils import LRU
+
+from .blobs import BlobStore
+from .engine import Cancelled, DownloadEngine
+from .eviction import CacheEvictor, gzip_index_path
+from .gzindex import GzipIndex, GzipIndexError, GzipReader
+from .integrity import ChecksumIndex, Scrubber, checksums_filename
+from .journal import DownloadJournal, ResumableFile
+from .mapping import MappedFiles
+from .metrics import Metrics, throughput_buckets
+from .origins import OriginChain, UpstreamOrigin
+from .scheduler import (DownloadScheduler, background_priority, foreground_priority,
+                        prefetch_priority)
+from .sessions import SessionError, SessionPool, thread_sessions
+from .sizes import SizeDiscovery, SizeIndex
+from .sparse import RangeError, SparseFile, fetch_range
+
 # Set download timeout
 socket.setdefaulttimeout(600)
 
+# The files in each accession's directory
+accession_files = [
+  'README.txt',
+  'md5checksums.txt',
+  '{accession}_assembly_stats.txt',
+  '{accession}_assembly_report.txt',
+  '{accession}_genomic.fna.gz',
+  '{accession}_genomic.gbff.gz',
+  '{accession}_genomic.gff.gz'
+]
+
+# Labels for the scheduler's classes of job in metrics
+priority_names = {foreground_priority: 'foreground',
+                  prefetch_priority: 'prefetch',
+                  background_priority: 'background'}
+
+# Uncompressed views of the gzipped files
+decompressed_files = [filename[:-len('.gz')] for filename in accession_files
+                      if filename.endswith('.gz')]
+
+try:
+  pread = os.pread
+except AttributeError:
+  # Python 2 doesn't have os.pread so we borrow it from libc.  ctypes
+  # releases the GIL while it is running so reads can run in parallel
+  _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  _libc_pread = getattr(_libc, 'pread64', _libc.pread)
+  _libc_pread.restype = ctypes.c_ssize_t
+  _libc_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                          ctypes.c_int64]
+
+  _pread_buffers = local()
+
+  def pread(fd, size, offset):
+    """Reads size bytes from offset without moving the file position"""
+    buf = getattr(_pread_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+      buf = _pread_buffers.buf = ctypes.create_string_buffer(size)
+    count = _libc_pread(fd, buf, size, offset)
+    if count < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+    return ctypes.string_at(buf, count)
+
 class DownloadError(Exception):
   pass
 
@@ -26,23 +91,146 @@ class DownloadWithExceptions(urllib.FancyURLopener):
   http_error_403 = error
   http_error_404 = error
 
-  def retrieve_tempfile(self, url, temp_dir, *args, **kwargs):
+  def retrieve_tempfile(self, url, temp_dir, progress=None, blocksize=64*1024,
+                        timeout=None, resume_path=None):
+    """Downloads url into a temporary file in temp_dir
+
+    Unlike urllib's retrieve, the temporary file is flushed after every
+    block and progress(temp_path, bytes_written) is called so that other
+    threads can start reading the file before the download finishes.
+    The file's md5 is worked out as it's written and left in the
+    temporary file's md5 attribute.  FTP and HTTP downloads reuse the
+    calling thread's sessions and give up if the server goes quiet for
+    timeout seconds (the default socket timeout if it's not set).
+
+    If resume_path is set, the download goes there instead (as a
+    ResumableFile) and carries on from the end of whatever is already
+    in it.  If the download fails, resume_path is left for next time."""
+    if resume_path is not None:
+      return self._resume(url, resume_path, progress, blocksize, timeout)
     try:
-      temp_file = tempfile.NamedTemporaryFile(mode='w',
+      temp_file = tempfile.NamedTemporaryFile(mode='wb',
                                               prefix=self._prefix_from_url(url),
                                               suffix='.tmp',
                                               dir=temp_dir,
                                               delete=True)
     except OSError:
       os.makedirs(temp_dir, 0755)
-      temp_file = tempfile.NamedTemporaryFile(mode='w',
+      temp_file = tempfile.NamedTemporaryFile(mode='wb',
                                               prefix=self._prefix_from_url(url),
                                               suffix='.tmp',
                                               dir=temp_dir,
                                               delete=True)
     logging.info("Downloading %s to %s" % (url, temp_file.name))
-    (filename, status) = self.retrieve(url, temp_file.name)
-    return (temp_file, status)
+    if SessionPool.supports(url):
+      source = thread_sessions().open(url, timeout=timeout)
+    else:
+      source = self.open(url)
+    try:
+      headers = source.info()
+      digest = hashlib.md5()
+      bytes_written = 0
+      if progress:
+        progress(temp_file.name, bytes_written)
+      while True:
+        block = source.read(blocksize)
+        if not block:
+          break
+        temp_file.write(block)
+        temp_file.flush()
+        digest.update(block)
+        bytes_written += len(block)
+        if progress:
+          progress(temp_file.name, bytes_written)
+    finally:
+      source.close()
+    if "content-length" in headers:
+      expected_size = int(headers["Content-Length"])
+      if bytes_written < expected_size:
+        raise urllib.ContentTooShortError("retrieval incomplete: got only %i "
+                                          "out of %i bytes" % (bytes_written,
+                                                               expected_size),
+                                          (temp_file.name, headers))
+    temp_file.md5 = digest.hexdigest()
+    return (temp_file, headers)
+
+  def _resume(self, url, resume_path, progress, blocksize, timeout):
+    temp_file = ResumableFile(resume_path)
+    try:
+      digest = temp_file.digest() if temp_file.offset else hashlib.md5()
+      source = self._open_from(url, temp_file, timeout, progress)
+      if not temp_file.offset:
+        digest = hashlib.md5() # the server didn't take up where we stopped
+      logging.info("Downloading %s to %s from byte %s" % (url, temp_file.name,
+                                                        temp_file.offset))
+      try:
+        headers = source.info()
+        bytes_written = temp_file.offset
+        if progress:
+          progress(temp_file.name, bytes_written)
+        while True:
+          block = source.read(blocksize)
+          if not block:
+            break
+          temp_file.write(block)
+          temp_file.flush()
+          digest.update(block)
+          bytes_written += len(block)
+          if progress:
+            progress(temp_file.name, bytes_written)
+      finally:
+        source.close()
+      if "content-length" in headers:
+        expected_size = temp_file.offset + int(headers["Content-Length"])
+        if bytes_written < expected_size:
+          raise urllib.ContentTooShortError("retrieval incomplete: got only %i "
+                                            "out of %i bytes" % (bytes_written,
+                                                                 expected_size),
+                                            (temp_file.name, headers))
+    except:
+      temp_file.close()
+      raise
+    temp_file.md5 = digest.hexdigest()
+    temp_file.delete = True
+    return (temp_file, headers)
+
+  def _open_from(self, url, temp_file, timeout, progress=None):
+    """Opens url from temp_file.offset (truncating temp_file if we can't)
+
+    progress is told before anything is thrown away so that readers of
+    temp_file can give up on it."""
+    offset = temp_file.offset
+    def truncate():
+      if temp_file.offset and progress:
+        progress(temp_file.name, 0)
+      temp_file.truncate()
+    if not offset or not SessionPool.supports(url):
+      truncate()
+      return (thread_sessions().open(url, timeout=timeout) if SessionPool.supports(url)
+              else self.open(url))
+    if url.startswith('ftp:'):
+      source = thread_sessions().open(url, rest=offset, timeout=timeout)
+      if source.size is not None and offset > source.size:
+        source.close()
+        truncate()
+        source = thread_sessions().open(url, timeout=timeout)
+      return source
+    try:
+      source = thread_sessions().open(url, headers={'Range': 'bytes=%s-' % offset},
+                                      timeout=timeout)
+    except SessionError as e:
+      if e.status != 416: # the range is past the end of the file
+        raise
+      truncate()
+      return thread_sessions().open(url, timeout=timeout)
+    content_range = source.getheader('Content-Range') or ''
+    if source.status == 206 and content_range.startswith('bytes %s-' % offset):
+      return source
+    truncate()
+    if source.status == 206: # but not the range we asked for
+      source.read()
+      return thread_sessions().open(url, timeout=timeout)
+    return source # the server ignored the range and is sending the whole file
 
   def _prefix_from_url(self, url):
     url_path = urlparse(url).path
@@ -92,6 +280,92 @@ WARNING: There was a problem downloading this file
 Please try again later
 """
 
+class StreamingDownload(object):
+  """A file which is being downloaded into the cache
+
+  The download thread reports progress as bytes are written to the
+  temporary file so that readers can open the partial file and only
+  wait for the bytes they actually need.  Everyone asking for the same
+  origin_path shares one of these."""
+  def __init__(self, cache_path, origin_path):
+    self.cache_path = cache_path
+    self.origin_path = origin_path
+    self.temp_path = None
+    self.bytes_written = 0
+    self.finished = False
+    self.failed = False
+    self.condition = Condition()
+    self.task = None # set if it's running on the event loop
+    self.attempt = 0
+    self.started_at = None
+
+  def progress(self, temp_path, bytes_written):
+    with self.condition:
+      if temp_path != self.temp_path:
+        self.started_at = time()
+      self.temp_path = temp_path
+      self.bytes_written = bytes_written
+      self.condition.notify_all()
+
+  def restart(self):
+    """Called when a download is thrown away to be tried again
+
+    Readers of the old partial file should give up on it"""
+    with self.condition:
+      self.attempt += 1
+      self.temp_path = None
+      self.bytes_written = 0
+      self.condition.notify_all()
+
+  def finish(self, failed=False):
+    with self.condition:
+      self.finished = True
+      self.failed = failed
+      self.condition.notify_all()
+
+  def started(self):
+    return self.temp_path is not None
+
+  def available(self, end):
+    return self.bytes_written >= end
+
+  def wait(self, predicate, timeout):
+    """Waits until predicate() is true or the download finishes
+
+    Returns False if we gave up waiting"""
+    deadline = time() + timeout
+    with self.condition:
+      while not (self.finished or predicate()):
+        remaining = deadline - time()
+        if remaining <= 0:
+          return False
+        self.condition.wait(remaining)
+      return True
+
+class OpenFile(object):
+  """State for a file handle which we've given to FUSE
+
+  download is set if the file was opened while it was still streaming
+  into the cache.  sparse is set if it is being filled in by ranged
+  requests as it is read; next_offset and read_ahead track whether it
+  is being read sequentially.  path is relative to the cache root and
+  stops the file from being evicted while it's open.  attempt is the
+  download's attempt when the file was opened.  gzip is set if reads
+  are of the file's uncompressed data.  mapped is set if reads are
+  served from a memory map of the file (see MappedFiles)"""
+  def __init__(self, fh, download=None, sparse=None, path=None, origin_path=None,
+               attempt=0, gzip=None, mapped=None):
+    self.fh = fh
+    self.download = download
+    self.attempt = attempt
+    self.gzip = gzip
+    self.mapped = mapped
+    self.sparse = sparse
+    self.path = path
+    self.origin_path = origin_path
+    self.next_offset = 0
+    self.read_ahead = 0
+
 class GenbankCache(object):
   """Create a local cache of files from Genbank
 
@@ -101,56 +375,226 @@ class GenbankCache(object):
   It avoids downloading the same file multiple times and uses threading
   to control the number of concurent downloads.  It also has a download
   queue to help save you if you accidentally make a request which would
-  download all of Genbank at once"""
-  def __init__(self, root_dir, lookup_func, max_queue=100, concurent_downloads=2):
-    self.lookup = lookup_func
+  download all of Genbank at once.
+
+  Queued downloads are scheduled by a DownloadScheduler: files which
+  are being opened go before prefetches which go before size lookups,
+  smaller files go first and the processes opening files (pid) take
+  turns.  Only per_host_downloads run against each server at once.
+
+  With event_loop set, HTTP and FTP downloads are run by a
+  DownloadEngine in one thread (up to max_transfers at once) rather than
+  by concurent_downloads threads.  Anything else queued (other schemes,
+  size lookups) gets a short lived thread of its own.
+
+  In streaming mode (the default) files are opened as soon as their
+  download starts and reads wait for the bytes they need to arrive.
+
+  Downloads in progress are recorded in a DownloadJournal.  One which
+  fails after getting somewhere is carried on from where it stopped
+  (with a Range or REST request) and ones which were interrupted by a
+  restart are queued again in the background.  Anything else left in
+  tmp/ is removed when the cache is created.
+
+  The sizes of files which haven't been downloaded are looked up in the
+  background (if discover_sizes is set).  Until they're known, files
+  claim to be unknown_size bytes.  Files which haven't been downloaded
+  are timestamped when the cache was created so that their attributes
+  don't change between calls.
+
+  In sparse mode, files aren't downloaded when they are opened.  Instead
+  the blocks which are read (plus some read ahead, which grows while a
+  file is read sequentially) are fetched with ranged requests into
+  partial/ and the file is moved into the cache once it's complete.
+
+  If max_cache_bytes or max_cache_files are set, files which haven't
+  been opened recently are evicted to keep the cache under them (see
+  CacheEvictor).  Files which are open are never evicted.
+
+  If prefetch_siblings is set, the first time a file in an accession is
+  opened the rest of the accession's files are queued for download
+  behind anything which has actually been asked for.
+
+  If verify_checksums is set, downloads are only moved into the cache
+  if their md5 (worked out as they stream in) matches the accession's
+  md5checksums.txt; otherwise they're tried again up to verify_retries
+  times.  Readers of a partial file which turns out to be corrupt get
+  an error.  If scrub_rate is set, cached files are re-checked in the
+  background at up to that many bytes per second (see Scrubber); this
+  is also how files filled in by sparse mode get checked.
+
+  Each gzipped accession file has an uncompressed view without the .gz
+  (see decompressed_files).  Opening one downloads the whole gzip file
+  and builds an index of it (see GzipIndex) with an access point every
+  gzip_span bytes; indexes are kept in gzindex/ so reads at any offset
+  only decompress from the access point before them.  Until a file's
+  index has been built, its view's size is reported as unknown_size.
+
+  If deduplicate is set, downloads are kept in a BlobStore by their md5
+  and cached paths are hard links to them, so identical files in
+  different accessions only take up space once.
+
+  origins is either a function which maps paths to their URLs upstream
+  or an OriginChain of places to try first (e.g. a directory shared
+  between nodes or other nodes' caches).  If a download from one origin
+  fails, the next one is tried; files which had to come from further
+  along the chain can be written back to a shared directory.
+
+  If map_files is set, files which are already in the cache when they
+  are opened are memory mapped (once, however many handles they have)
+  and read from the mapping rather than with a syscall per read.
+
+  Cache hits and misses, bytes served and downloaded, queue depths and
+  waits and download throughput are recorded in metrics (see Metrics)."""
+  def __init__(self, root_dir, origins, max_queue=100, concurent_downloads=2,
+               streaming=True, read_timeout=600, discover_sizes=True,
+               unknown_size=10**12, sparse=False, block_size=256*1024,
+               read_ahead=1024**2, max_read_ahead=16*1024**2,
+               max_cache_bytes=None, max_cache_files=None, eviction_policy='lru',
+               prefetch_siblings=False, per_host_downloads=2, event_loop=False,
+               max_transfers=64, verify_checksums=True, verify_retries=2,
+               scrub_rate=None, gzip_span=1024**2, deduplicate=True, metrics=None,
+               map_files=True):
+    if not isinstance(origins, OriginChain):
+      origins = OriginChain([UpstreamOrigin(origins, timeout=socket.getdefaulttimeout())])
+    self.origins = origins
+    self.lookup = origins # maps paths to their upstream URLs
+    self.sparse = sparse
+    self.block_size = block_size
+    self.read_ahead = read_ahead
+    self.max_read_ahead = max_read_ahead
+    self.sparse_files = {}
+    self.sparse_lock = Lock()
     self.max_queue = max_queue
+    self.streaming = streaming
+    self.read_timeout = read_timeout
+    self.unknown_size = unknown_size
+    self.created_at = time()
     self.root_dir = os.path.realpath(root_dir)
-    self.download_queue = Queue(maxsize=max_queue)
-    self.rwlock = Lock()
-    self.threads = [Thread(target=self._download_queued, args=(self.download_queue,))
-                      for i in xrange(concurent_downloads)]
+    if not os.path.isdir(self.root_dir):
+      os.makedirs(self.root_dir, 0755)
+    self.scheduler = DownloadScheduler({foreground_priority: max_queue,
+                                        prefetch_priority: max_queue,
+                                        background_priority: 10 * max_queue},
+                                       per_host=per_host_downloads)
+    self.metrics = metrics or Metrics()
+    self._describe_metrics()
+    self.sizes = SizeIndex(os.path.join(self.root_dir, 'sizes.tsv'))
+    self.size_discovery = (SizeDiscovery(self.sizes, self.lookup,
+                                         scheduler=self.scheduler)
+                           if discover_sizes else None)
+    self.prefetch_siblings = prefetch_siblings
+    self.prefetched_accessions = LRU(max_size=10000)
+    self.verify_retries = verify_retries
+    if verify_checksums or scrub_rate:
+      self.checksums = ChecksumIndex(os.path.join(self.root_dir, 'checksums.tsv'),
+                                     self.lookup)
+    else:
+      self.checksums = None
+    self.verify_checksums = verify_checksums
+    self.checksum_fetches = {} # accession -> what's waiting for its checksums
+    self.checksum_lock = Lock()
+    self.gzip_span = gzip_span
+    self.gzip_indexes = LRU(max_size=100)
+    self.gzip_locks = {} # path -> [lock, number of threads using it]
+    self.gzip_lock = Lock() # for gzip_locks
+    if event_loop:
+      self.engine = DownloadEngine(max_transfers, timeout=socket.getdefaulttimeout())
+      self.threads = [Thread(target=self._feed_engine)]
+    else:
+      self.engine = None
+      self.threads = [Thread(target=self._download_scheduled)
+                        for i in xrange(concurent_downloads)]
     for thread in self.threads:
       thread.daemon = True
       thread.start()
+    self.job_threads = [] # running jobs which aren't on the event loop
     self.warning_files = {
       'queue': create_warning_file(self.root_dir, 'download_queue_warning',
                                    download_queue_warning % dict(max_downloads=self.max_queue)),
       'timeout': create_warning_file(self.root_dir, 'download_timeout_warning', download_timeout_warning),
       'error': create_warning_file(self.root_dir, 'download_error', download_error)
     }
-    self.download_locks = {}
+    self.journal = DownloadJournal(self.root_dir)
+    self.journal.collect(keep=self.warning_files.values())
+    self.downloads = {}
+    self.downloads_lock = Lock()
+    self.handles = {}
+    if map_files:
+      self.mapped_files = MappedFiles()
+      self.metrics.gauge('genbankfs_mapped_files', lambda: len(self.mapped_files))
+      self.metrics.gauge('genbankfs_mapped_bytes', self.mapped_files.mapped_bytes)
+    else:
+      self.mapped_files = None
+    if deduplicate:
+      self.blobs = BlobStore(self.root_dir)
+      self.collector = Thread(target=self.blobs.collect)
+      self.collector.daemon = True
+      self.collector.start()
+    else:
+      self.blobs = None
+    if max_cache_bytes is not None or max_cache_files is not None:
+      self.evictor = CacheEvictor(self.root_dir, max_cache_bytes, max_cache_files,
+                                  eviction_policy, pinned_func=self._open_paths,
+                                  blob_store=self.blobs).start()
+    else:
+      self.evictor = None
+    if scrub_rate:
+      self.scrubber = Scrubber(self.root_dir, self.checksums, scrub_rate,
+                               remove_func=self._discard).start()
+    else:
+      self.scrubber = None
+    self._resume_interrupted()
 
-  def open(self, path, flags):
+  def open(self, path, flags, pid=None):
     """Returns a file number for a given path
 
     If the path is not in the cache, it uses a lookup function to find the
     Genbank URL and tries to download it.  If another thread is already
-    downloading the file, it waits patiently rather than also requesting
-    the same file."""
+    downloading the file, it shares that download rather than also
+    requesting the same file.  pid is the process asking for the file."""
     cache_path = os.path.join(self.root_dir, path)
     self._check_in_root(cache_path)
+    compressed_path = self._compressed_path(path)
+    if compressed_path is not None:
+      return self._open_decompressed(compressed_path, flags, pid)
     try:
-      return os.open(cache_path, flags)
+      fh = self._open_handle(cache_path, flags, path=path)
     except OSError:
       pass
+    else:
+      if self.mapped_files is not None:
+        self.handles[fh].mapped = self.mapped_files.acquire(fh)
+      self.metrics.inc('genbankfs_cache_opens_total', result='hit')
+      if self.evictor:
+        self.evictor.touch(path)
+      if self.prefetch_siblings:
+        self._prefetch_siblings(path, pid)
+      return fh
     try:
       origin_path = self.lookup(path)
     except:
       raise IOError('%s not found and not available for download' % path)
-    download_lock, download_complete_event = self.download_locks.setdefault(origin_path, (Lock(), Event()))
-    if download_lock.acquire(False):
-      download_fn = self.download(cache_path, origin_path, flags)
-      download_complete_event.set()
-      del self.download_locks[origin_path]
-      download_lock.release()
+    self.metrics.inc('genbankfs_cache_opens_total', result='miss')
+    if self.sparse:
+      fh = self._open_sparse(path, origin_path, flags)
     else:
-      download_fn = self.wait_for_download(cache_path, flags, download_complete_event)
-    return download_fn
+      fh = self.download(cache_path, origin_path, flags, pid=pid)
+    if self.prefetch_siblings:
+      self._prefetch_siblings(path, pid)
+    return fh
+
+  def is_cached(self, path):
+    cache_path = os.path.join(self.root_dir, path)
+    self._check_in_root(cache_path)
+    return os.path.isfile(cache_path)
 
   def getattr(self, path):
     cache_path = os.path.join(self.root_dir, path)
     self._check_in_root(cache_path)
+    compressed_path = self._compressed_path(path)
+    if compressed_path is not None:
+      return self._decompressed_getattr(compressed_path)
     try:
       st = os.lstat(cache_path)
       return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
@@ -158,92 +602,771 @@ class GenbankCache(object):
                                                       'st_mtime', 'st_nlink',
                                                       'st_size', 'st_uid'))
     except OSError:
+      size = self.sizes.get(path)
+      if size is None:
+        size = self.unknown_size
+        if self.size_discovery:
+          self.size_discovery.request(path)
       return dict(st_mode=(S_IFREG | 0444), st_nlink=1,
-                  st_size=10**12, st_ctime=time(),
-                  st_mtime=time(), st_atime=time())
+                  st_size=size, st_ctime=self.created_at,
+                  st_mtime=self.created_at, st_atime=self.created_at)
 
   def read(self, size, offset, fh):
-    with self.rwlock:
-      os.lseek(fh, offset, 0)
-      return os.read(fh, size)
+    """Reads from a file handle returned by open
 
-  def wait_for_download(self, cache_path, flags, download_complete_event, timeout=600):
-    """Waits for another thread to finish downloading a file
+    Reads are positional so they don't need a lock and handles can be
+    read from in parallel"""
+    return self._read(size, offset, fh, view=False)
 
-    Returns an error file if this takes too long"""
-    logging.info("Awaiting download of %s" % cache_path)
-    download_complete_event.wait(timeout=timeout)
+  def read_view(self, size, offset, fh):
+    """Like read but returns a buffer of the file's mapping if it has one
+
+    The buffer is only valid until the handle is released."""
+    return self._read(size, offset, fh, view=True)
+
+  def _read(self, size, offset, fh, view):
+    handle = self.handles.get(fh)
+    download = handle and handle.download
+    if download is not None:
+      download.wait(lambda: (download.attempt != handle.attempt or
+                             download.available(offset + size)),
+                    timeout=self.read_timeout)
+      if download.attempt != handle.attempt:
+        raise OSError(EIO, "Download of %s was restarted" % download.origin_path)
+      if download.failed or not (download.finished or
+                                 download.available(offset + size)):
+        raise OSError(EIO, "Download of %s did not complete" % download.origin_path)
+      if download.finished:
+        handle.download = None
+    if handle is not None and handle.sparse is not None:
+      self._fill_sparse(handle, size, offset)
+    if handle is not None and handle.gzip is not None:
+      try:
+        data = handle.gzip.read(size, offset)
+      except GzipIndexError as e:
+        raise OSError(EIO, "Couldn't decompress %s: %s" % (handle.path, e))
+    elif handle is not None and handle.mapped is not None:
+      if view:
+        data = handle.mapped.view(size, offset)
+      else:
+        data = handle.mapped.read(size, offset)
+    else:
+      data = pread(fh, size, offset)
+    self.metrics.inc('genbankfs_served_bytes_total', len(data))
+    return data
+
+  def release(self, fh):
+    handle = self.handles.pop(fh, None)
+    if handle is not None and handle.gzip is not None:
+      handle.gzip.close()
+    if handle is not None and handle.mapped is not None:
+      self.mapped_files.release(handle.mapped)
+    os.close(fh)
+    if handle is not None and handle.sparse is not None:
+      with self.sparse_lock:
+        handle.sparse.users -= 1
+        if handle.sparse.users == 0:
+          handle.sparse.close()
+          del self.sparse_files[handle.path]
+    if self.evictor:
+      self.evictor.released()
+
+  def _open_handle(self, file_path, flags, download=None, **kwargs):
+    fh = os.open(file_path, flags)
+    self.handles[fh] = OpenFile(fh, download, **kwargs)
+    return fh
+
+  def _open_paths(self):
+    """Returns the paths (relative to the root) which have open handles"""
+    return set(handle.path for handle in self.handles.values()
+               if handle.path is not None)
+
+  def _compressed_path(self, path):
+    """Returns the gzip file which path is an uncompressed view of (or None)"""
+    accession, _, filename = path.partition('/')
+    for decompressed_file in decompressed_files:
+      if filename == decompressed_file.format(accession=accession):
+        return path + '.gz'
+    return None
+
+  def _open_decompressed(self, path, flags, pid=None):
+    """Opens the uncompressed data of a gzip file
+
+    The whole gzip file has to be in the cache first"""
+    cache_path = os.path.join(self.root_dir, path)
+    if os.path.isfile(cache_path):
+      self.metrics.inc('genbankfs_cache_opens_total', result='hit')
+    else:
+      try:
+        origin_path = self.lookup(path)
+      except:
+        raise IOError('%s not found and not available for download' % path)
+      self.metrics.inc('genbankfs_cache_opens_total', result='miss')
+      try:
+        download = self._start_download(cache_path, origin_path, pid)
+      except Full:
+        return self._open_handle(self.warning_files['queue'], flags)
+      if not download.wait(lambda: False, timeout=self.read_timeout):
+        return self._open_handle(self.warning_files['timeout'], flags)
+      if download.failed:
+        return self._open_handle(self.warning_files['error'], flags)
     try:
-      return os.open(cache_path, flags)
-    except OSError:
-      return os.open(self.warning_files['timeout'], flags)
+      index = self._gzip_index(path)
+    except (GzipIndexError, OSError) as e:
+      logging.info("Couldn't index %s: %s" % (path, e))
+      return self._open_handle(self.warning_files['error'], flags)
+    fh = self._open_handle(cache_path, flags, path=path)
+    self.handles[fh].gzip = GzipReader(index, lambda offset, size: pread(fh, size, offset))
+    if self.evictor:
+      self.evictor.touch(path)
+    if self.prefetch_siblings:
+      self._prefetch_siblings(path, pid)
+    return fh
+
+  def _decompressed_getattr(self, path):
+    """Only uses an index which has already been built (see _open_decompressed)"""
+    cache_path = os.path.join(self.root_dir, path)
+    try:
+      st = os.lstat(cache_path)
+      index = self._gzip_index(path, build=False)
+    except (GzipIndexError, OSError):
+      index = None
+    if index is None:
+      return dict(st_mode=(S_IFREG | 0444), st_nlink=1,
+                  st_size=self.unknown_size, st_ctime=self.created_at,
+                  st_mtime=self.created_at, st_atime=self.created_at)
+    return dict(st_mode=st.st_mode, st_nlink=1, st_size=index.size, st_uid=st.st_uid,
+                st_gid=st.st_gid, st_ctime=st.st_ctime, st_mtime=st.st_mtime,
+                st_atime=st.st_atime)
+
+  def _gzip_index(self, path, build=True):
+    """Returns the index of a cached gzip file, building it if need be
 
-  def download(self, cache_path, origin_path, flags, timeout=600):
+    Only one thread builds each file's index and the others wait for it.
+    If build is unset, returns None rather than building or waiting."""
+    cache_path = os.path.join(self.root_dir, path)
+    index = self.gzip_indexes.get(path)
+    if index is not None and index.matches(cache_path):
+      return index
+    with self.gzip_lock:
+      lock = self.gzip_locks.setdefault(path, [Lock(), 0])
+      lock[1] += 1
+    try:
+      if not lock[0].acquire(build):
+        return None # someone else is building it
+      try:
+        index = self.gzip_indexes.get(path)
+        if index is not None and index.matches(cache_path):
+          return index
+        index_path = gzip_index_path(self.root_dir, path)
+        index = GzipIndex.load(index_path)
+        if index is None or not index.matches(cache_path):
+          if not build:
+            return None
+          logging.info("Indexing %s" % path)
+          index = GzipIndex.build(cache_path, span=self.gzip_span)
+          index.save(index_path)
+        self.gzip_indexes[path] = index
+        return index
+      finally:
+        lock[0].release()
+    finally:
+      with self.gzip_lock:
+        lock[1] -= 1
+        if not lock[1]:
+          del self.gzip_locks[path]
+
+  def _open_sparse(self, path, origin_path, flags):
+    """Opens a partial file which is filled in as it is read
+
+    If we don't know the file's size, we find it by fetching the first
+    few blocks.  If the server won't tell us, the whole file is
+    downloaded instead."""
+    first_range = None
+    if path not in self.sparse_files and self.sizes.get(path) is None:
+      try:
+        first_range = fetch_range(origin_path, 0, max(self.block_size, self.read_ahead),
+                                  self.read_timeout)
+      except (IOError, RangeError):
+        logging.info("Failed to fetch the start of %s" % origin_path)
+        return self._open_handle(self.warning_files['error'], flags)
+      self.metrics.inc('genbankfs_downloaded_bytes_total', len(first_range[1]),
+                       origin='upstream')
+      if first_range[2] is None:
+        logging.info("Don't know the size of %s; downloading all of it" % origin_path)
+        return self.download(os.path.join(self.root_dir, path), origin_path, flags)
+      self.sizes.update({path: first_range[2]})
+    with self.sparse_lock:
+      sparse_file = self.sparse_files.get(path)
+      if sparse_file is None:
+        sparse_file = SparseFile(os.path.join(self.root_dir, 'partial', path),
+                                 self.sizes.get(path), self.block_size)
+        self.sparse_files[path] = sparse_file
+      sparse_file.users += 1
+    if first_range is not None:
+      offset, data, size = first_range
+      sparse_file.write(offset, data)
+    return self._open_handle(sparse_file.data_path, flags, sparse=sparse_file,
+                             path=path, origin_path=origin_path)
+
+  def _fill_sparse(self, handle, size, offset):
+    if offset == handle.next_offset:
+      handle.read_ahead = min(max(handle.read_ahead * 2, self.read_ahead),
+                              self.max_read_ahead)
+    else:
+      handle.read_ahead = self.read_ahead
+    handle.next_offset = offset + size
+    sparse_file = handle.sparse
+    end = min(offset + size + handle.read_ahead, sparse_file.size)
+    try:
+      fetched = sparse_file.fill(handle.origin_path, offset, end, timeout=self.read_timeout)
+    except (IOError, RangeError) as e:
+      raise OSError(EIO, "Could not fetch part of %s: %s" % (handle.origin_path, e))
+    if fetched:
+      self.metrics.inc('genbankfs_downloaded_bytes_total', fetched, origin='upstream')
+    if sparse_file.complete():
+      self._promote_sparse(handle.path, sparse_file)
+
+  def _promote_sparse(self, path, sparse_file):
+    """Moves a complete sparse file into the cache"""
+    cache_path = os.path.join(self.root_dir, path)
+    with sparse_file.lock:
+      if not os.path.exists(sparse_file.data_path):
+        return # someone else got here first
+      intended_dir = os.path.dirname(cache_path)
+      if not os.path.isdir(intended_dir):
+        os.makedirs(intended_dir, mode=0755)
+      os.rename(sparse_file.data_path, cache_path)
+      self._remove_quietly(sparse_file.bitmap_path)
+    logging.info("%s is complete" % path)
+    if self.evictor:
+      self.evictor.add(path, sparse_file.size)
+
+  def download(self, cache_path, origin_path, flags, timeout=600, pid=None):
     """Downloads a file from Genbank
 
     Downloads are queued for the download threads to deal with them.
-    If the download takes too long, it returns a warning file but the
-    file may still be downloaded in due course.  If it looks like
+    If the download takes too long to start, it returns a warning file
+    but the file may still be downloaded in due course.  If it looks like
     too many files have been queued for download at once, it returns
-    a different error."""
-    result = Queue()
+    a different error.  Joining a queued prefetch of the same file moves
+    it up to the foreground."""
+    try:
+      download = self._start_download(cache_path, origin_path, pid)
+    except Full:
+      return self._open_handle(self.warning_files['queue'], flags)
+    return self.wait_for_download(download, flags, timeout)
+
+  def _start_download(self, cache_path, origin_path, pid=None):
+    """Queues a download in the foreground (or joins an existing one)
+
+    Raises Queue.Full if too many downloads are queued"""
+    with self.downloads_lock:
+      download = self.downloads.get(origin_path)
+      if download is None:
+        download = StreamingDownload(cache_path, origin_path)
+        logging.info("Adding %s to download queue of length %s" % (origin_path,
+                                                                   self.scheduler.qsize()))
+        self._schedule(download, foreground_priority, pid)
+        self.downloads[origin_path] = download
+      else:
+        self.scheduler.promote(download, foreground_priority, pid)
+    return download
+
+  def _schedule(self, download, priority, pid, block=False):
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    self.scheduler.put(download, priority, host=urlparse(download.origin_path).netloc,
+                       pid=pid, size=self.sizes.get(path), block=block)
+
+  def prefetch(self, path, block=False, pid=None, priority=prefetch_priority):
+    """Queues path for download behind anything which has been opened
+
+    Returns the StreamingDownload or None if the file is already cached
+    or couldn't be queued.  If block is set and too many prefetches are
+    queued, we wait for space rather than giving up."""
+    if self.is_cached(path):
+      return None
+    cache_path = os.path.join(self.root_dir, path)
     try:
-      logging.info("Adding %s to download queue of length %s" % (origin_path,                                                                 self.download_queue.qsize()))
-      self.download_queue.put_nowait((cache_path, origin_path, flags, result))
-      output_file = result.get(timeout=timeout)
+      origin_path = self.lookup(path)
+    except:
+      logging.info("Can't prefetch %s; it isn't available for download" % path)
+      return None
+    with self.downloads_lock:
+      download = self.downloads.get(origin_path)
+      if download is not None:
+        return download
+      download = StreamingDownload(cache_path, origin_path)
+      self.downloads[origin_path] = download
+    try:
+      # not under downloads_lock because the download threads need it
+      # to make space in the queue
+      self._schedule(download, priority, pid, block=block)
     except Full:
-      output_file = os.open(self.warning_files['queue'], flags)
-    except Empty:
-      ouput_file = os.open(self.warning_files['timeout'], flags)
-    logging.info("Finished downloading %s; queue length is %s" % (origin_path,
-                                                                  self.download_queue.qsize()))
-    return output_file
-
-  def _download_queued(self, queue):
+      with self.downloads_lock:
+        self.downloads.pop(origin_path, None)
+      return None
+    return download
+
+  def _resume_interrupted(self):
+    """Queues downloads which were in progress when we last stopped
+
+    They go behind everything else and carry on from where they got to."""
+    for path in self.journal.interrupted():
+      if self.is_cached(path):
+        self.journal.finish(path)
+      elif self.prefetch(path, priority=background_priority) is None:
+        logging.info("Couldn't resume the download of %s" % path)
+      else:
+        logging.info("Resuming the download of %s" % path)
+
+  def _prefetch_siblings(self, path, pid=None):
+    accession, _, filename = path.partition('/')
+    if not filename or accession in self.prefetched_accessions:
+      return
+    self.prefetched_accessions[accession] = True
+    for sibling in accession_files:
+      sibling = sibling.format(accession=accession)
+      if sibling != filename:
+        self.prefetch("%s/%s" % (accession, sibling), pid=pid)
+
+  def wait_for_download(self, download, flags, timeout=600):
+    """Waits for a download to start (or finish if we're not streaming)
+
+    Returns an error file if this takes too long"""
+    logging.info("Awaiting download of %s" % download.cache_path)
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    if self.streaming:
+      ready = download.wait(download.started, timeout=timeout)
+    else:
+      ready = download.wait(lambda: False, timeout=timeout)
+    with download.condition:
+      if download.failed:
+        return self._open_handle(self.warning_files['error'], flags)
+      elif download.finished:
+        return self._open_handle(download.cache_path, flags, path=path)
+      elif not ready:
+        return self._open_handle(self.warning_files['timeout'], flags)
+      return self._open_handle(download.temp_path, flags, download, path=path,
+                               attempt=download.attempt)
+
+  def cancel(self, path):
+    """Stops downloading path if it's queued (or running on the event loop)
+
+    Anyone waiting for the file gets the error file.  Returns False if
+    there was nothing to cancel."""
+    try:
+      origin_path = self.lookup(path)
+    except:
+      return False
+    with self.downloads_lock:
+      download = self.downloads.get(origin_path)
+      if download is None:
+        return False
+      if self.scheduler.discard(download):
+        self.downloads.pop(origin_path, None)
+        download.finish(failed=True)
+        return True
+    if download.task is not None:
+      self.engine.cancel(download.task)
+      return True
+    return False
+
+  def dedup_stats(self):
+    """Space saved by deduplication (see BlobStore.stats) or None if it's off"""
+    if self.blobs:
+      return self.blobs.stats()
+    return None
+
+  def close(self):
+    """Cancels any downloads on the event loop and stops background work
+
+    Queued downloads fail and we wait for the ones which are running (and
+    anything else which might write to the cache) to finish."""
+    for entry in self.scheduler.close():
+      if isinstance(entry.job, StreamingDownload):
+        entry.job.finish(failed=True)
+        with self.downloads_lock:
+          self.downloads.pop(entry.job.origin_path, None)
+    if self.size_discovery:
+      self.size_discovery.stop()
+    if self.engine is not None:
+      self.engine.stop()
+    for thread in self.threads + self.job_threads:
+      thread.join()
+    if self.blobs:
+      self.collector.join()
+    if self.evictor:
+      self.evictor.stop()
+    if self.scrubber:
+      self.scrubber.stop()
+    self.journal.close()
+
+  def _download_scheduled(self):
     downloader = DownloadWithExceptions()
-    download_staging_dir = os.path.join(self.root_dir, 'tmp')
     while True:
-      cache_path, origin_path, flags, result = queue.get()
+      entry = self.scheduler.get()
+      if entry is None:
+        return # we're closing
+      self._dequeued(entry)
+      try:
+        self._run_scheduled(entry, downloader)
+      except Exception:
+        # the download has been failed; carry on with the next one
+        logging.exception("Problem downloading %s" % entry.job.origin_path)
+
+  def _dequeued(self, entry):
+    self.metrics.observe('genbankfs_queue_wait_seconds', time() - entry.queued_at,
+                         priority=priority_names[entry.priority])
 
-      # Double check it's not in the cache
+  def _run_scheduled(self, entry, downloader):
+    download = entry.job
+    if not isinstance(download, StreamingDownload):
       try:
-        result.put(os.open(cache_path, flags))
-      except OSError:
-        pass # File doesn't exist so we should get started downloading it
+        download() # e.g. some size lookups
+      except Exception:
+        logging.exception("Scheduled job failed")
+      finally:
+        self.scheduler.done(entry)
+      return
+    try:
+      self._fetch(downloader, os.path.join(self.root_dir, 'tmp'), download)
+    finally:
+      self._finish_download(entry)
+
+  def _finish_download(self, entry):
+    download = entry.job
+    if not download.finished:
+      download.finish(failed=True)
+    if download.failed:
+      self.metrics.inc('genbankfs_downloads_total', result='failed')
+    with self.downloads_lock:
+      self.downloads.pop(download.origin_path, None)
+    self.scheduler.done(entry)
+    logging.info("Finished downloading %s; queue length is %s" % (download.origin_path,
+                                                                  self.scheduler.qsize()))
+
+  def _feed_engine(self):
+    """Starts scheduled jobs on the event loop while it has room for them"""
+    while True:
+      self.engine.acquire_slot()
+      entry = self.scheduler.get()
+      if entry is None:
+        self.engine.release_slot()
+        return # we're closing
+      self._dequeued(entry)
+      download = entry.job
+      sources = isinstance(download, StreamingDownload) and self._sources(download)
+      if sources and all(self.engine.supports(source.url) for source in sources):
+        self._with_checksums(download, partial(self._start_on_engine, entry, sources))
       else:
-        continue # Someone else downloaded it since this was queued
+        thread = Thread(target=self._run_off_engine, args=(entry,))
+        thread.daemon = True
+        thread.start()
+        self.job_threads = [job_thread for job_thread in self.job_threads
+                            if job_thread.is_alive()] + [thread]
+
+  def _run_off_engine(self, entry):
+    try:
+      self._run_scheduled(entry, DownloadWithExceptions())
+    finally:
+      self.engine.release_slot()
+
+  def _with_checksums(self, download, start):
+    """Calls start() once the checksums of download's accession are known
+
+    They're fetched on the event loop first (once, however many of the
+    accession's files are waiting for them) so that checking the
+    download doesn't hold up the loop's thread."""
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    if not self.verify_checksums or self.checksums.ready(path):
+      start()
+      return
+    accession = path.partition('/')[0]
+    with self.checksum_lock:
+      waiting = self.checksum_fetches.get(accession)
+      self.checksum_fetches.setdefault(accession, []).append(start)
+      if waiting is not None:
+        return
+    try:
+      url = self.checksums.url(accession)
+      if not self.engine.supports(url):
+        raise IOError("%s isn't available on the event loop" % url)
+    except Exception as e:
+      self._checksums_fetched(accession, None, e)
+      return
+    self.engine.fetch(url, os.path.join(self.root_dir, 'tmp'), lambda *args: None,
+                      partial(self._checksums_fetched, accession),
+                      timeout=self.checksums.timeout)
 
-      # Download the file to a temporary location
+  def _checksums_fetched(self, accession, temp_file, error):
+    if temp_file is not None:
       try:
-        urllib.urlcleanup()
-        download_tempfile, status = downloader.retrieve_tempfile(origin_path,
-                                                                 download_staging_dir)
-      except (DownloadError, IOError):
-        result.put(os.open(self.warning_files['error'], flags))
-        queue.task_done()
-        del download_tempfile
-        continue
-
-      # If the download was ok, move it where we need it
+        with open(temp_file.name) as f:
+          self.checksums.add(accession, f.read())
+      except IOError as e:
+        error = e
+      finally:
+        temp_file.close()
+    if error is not None:
+      self.checksums.failed(accession, error)
+    with self.checksum_lock:
+      waiting = self.checksum_fetches.pop(accession)
+    for start in waiting:
+      start()
+
+  def _start_on_engine(self, entry, sources):
+    download = entry.job
+    if os.path.isfile(download.cache_path):
+      download.finish()
+      self._finish_download(entry)
+      self.engine.release_slot()
+      return
+    sources = list(sources)
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    progress = partial(self._progress, download)
+    retries = [0] # downloads from sources[0] which were corrupt or resumed
+    written_before = [0]
+    def next_source():
+      sources.pop(0)
+      retries[0] = 0
+      return bool(sources)
+    def finished(download_tempfile, error):
       try:
-        shutil.move(download_tempfile.name, cache_path)
-        result_fn = os.open(cache_path, flags)
-      except IOError:
-        intended_dir = os.path.dirname(os.path.realpath(cache_path))
-        os.makedirs(intended_dir, mode=0755)
-        shutil.move(download_tempfile.name, cache_path)
-        result_fn = os.open(cache_path, flags)
-      except:
-        result_fn = os.open(self.warning_files['error'], flags)
+        if isinstance(error, Cancelled):
+          logging.info("Cancelled the download of %s" % download.origin_path)
+          download.finish(failed=True)
+        elif error is not None:
+          logging.info("Failed to download %s from %s: %s" % (download.origin_path,
+                                                              sources[0].url, error))
+          self.origins.failed(sources[0], error)
+          if (self._resumable(download, written_before[0], error) and
+              retries[0] < self.verify_retries):
+            retries[0] += 1
+            start() # carrying on from where it stopped
+            return
+          if download.started():
+            download.restart()
+          if next_source():
+            start() # keeping our slot
+            return
+          download.finish(failed=True)
+        elif not self._store(download, download_tempfile, sources[0],
+                             fetch_checksums=False):
+          retries[0] += 1
+          if retries[0] <= self.verify_retries or next_source():
+            start()
+            return
+          download.finish(failed=True)
+      except Exception:
+        logging.exception("Problem finishing %s" % download.origin_path)
+      download.task = None
+      self._finish_download(entry)
+      self.engine.release_slot()
+    def start():
+      written_before[0] = download.bytes_written
+      download.task = self.engine.fetch(sources[0].url, os.path.join(self.root_dir, 'tmp'),
+                                        progress, finished,
+                                        timeout=sources[0].timeout,
+                                        resume_path=self._journal_start(path, sources[0]))
+    start()
+
+  def _fetch(self, downloader, download_staging_dir, download):
+    # Double check it's not in the cache
+    if os.path.isfile(download.cache_path):
+      download.finish() # Someone else downloaded it since this was queued
+      return
+
+    # Download the file to a temporary location, trying each origin in turn
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    progress = partial(self._progress, download)
+    for source in self._sources(download):
+      for attempt in xrange(self.verify_retries + 1):
+        resume_path = self._journal_start(path, source)
+        written_before = download.bytes_written
+        try:
+          download_tempfile, status = downloader.retrieve_tempfile(source.url,
+                                                                   download_staging_dir,
+                                                                   progress=progress,
+                                                                   timeout=source.timeout,
+                                                                   resume_path=resume_path)
+        except (DownloadError, IOError) as e:
+          logging.info("Failed to download %s from %s: %s" % (download.origin_path,
+                                                              source.url, e))
+          self.origins.failed(source, e)
+          if self._resumable(download, written_before, e):
+            continue # carry on from where it stopped
+          if download.started():
+            download.restart()
+          break
+        if self._store(download, download_tempfile, source):
+          return
+    download.finish(failed=True)
+
+  def _journal_start(self, path, source):
+    """Journals a download of path from source; returns where it should go
+
+    or None if another process is already downloading it from there (and
+    it should go in a temporary file of its own)."""
+    md5 = None
+    if self.verify_checksums:
+      md5 = self.checksums.expected(path, fetch=False)
+    return self.journal.start(path, source.url, self.sizes.get(path), md5)
+
+  def _progress(self, download, temp_path, bytes_written):
+    if download.temp_path is not None and (temp_path != download.temp_path or
+                                           bytes_written < download.bytes_written):
+      # What readers have open is being thrown away or replaced
+      download.restart()
+    download.progress(temp_path, bytes_written)
+    self.journal.progress(temp_path, bytes_written)
+
+  def _resumable(self, download, written_before, error):
+    """True if a failed download got somewhere and is worth carrying on from
 
-      result.put(result_fn)
-      queue.task_done()
+    Its readers keep reading the same partial file."""
+    status = getattr(error, 'status', None)
+    return (download.started() and download.bytes_written > written_before and
+            (status is None or status >= 500))
 
-      # Delete the tempfile (this should happen anyway)
+  def _sources(self, download):
+    """Where download could come from, best first"""
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    try:
+      return self.origins.sources(path)
+    except Exception:
+      return []
+
+  def _verify(self, path, download_tempfile, fetch_checksums=True):
+    """Returns False if a download doesn't match its expected md5"""
+    if not self.verify_checksums:
+      return True
+    expected = self.checksums.expected(path, fetch=fetch_checksums)
+    if expected is None:
+      return True
+    md5 = self._download_md5(download_tempfile)
+    if md5 != expected:
+      logging.warning("Download of %s has md5 %s but expected %s" % (path, md5, expected))
+      return False
+    if self.scrubber:
+      self.scrubber.verified(path)
+    return True
+
+  def _download_md5(self, download_tempfile):
+    """The md5 worked out while downloading (or by reading the file if not)"""
+    md5 = getattr(download_tempfile, 'md5', None)
+    if md5 is None:
+      with open(download_tempfile.name, 'rb') as f:
+        digest = hashlib.md5()
+        for block in iter(lambda: f.read(1024**2), ''):
+          digest.update(block)
+      md5 = download_tempfile.md5 = digest.hexdigest()
+    return md5
+
+  def _store(self, download, download_tempfile, source=None, fetch_checksums=True):
+    """Moves a finished download into the cache
+
+    Returns False if it was corrupt; the download is restarted so that
+    it can be tried again.  If it came from source, it's written back
+    to the origins before it in the background.  If fetch_checksums is
+    unset, it's only checked against checksums we already have (e.g. on
+    the event loop, which mustn't wait for them)."""
+    path = os.path.relpath(download.cache_path, self.root_dir)
+    if not self._verify(path, download_tempfile, fetch_checksums):
+      download_tempfile.close() # which deletes it
+      self.journal.finish(path)
+      download.restart()
+      self.metrics.inc('genbankfs_downloads_total', result='corrupt')
+      return False
+    # If the download was ok, move it where we need it.  Readers of the
+    # partial file keep their file handles because the move is a rename
+    download_tempfile.delete = False
+    download_tempfile.close()
+    with download.condition:
       try:
-        del download_tempfile
-      except OSError:
-        pass # If it was moved, this will fail but that's ok
+        if self.blobs:
+          self.blobs.store(download_tempfile.name, self._download_md5(download_tempfile),
+                           path)
+        else:
+          intended_dir = os.path.dirname(os.path.realpath(download.cache_path))
+          if not os.path.isdir(intended_dir):
+            os.makedirs(intended_dir, mode=0755)
+          shutil.move(download_tempfile.name, download.cache_path)
+      except (IOError, OSError):
+        logging.info("Failed to move %s into the cache" % download_tempfile.name)
+        self._remove_quietly(download_tempfile.name)
+        self.journal.finish(path)
+        download.finish(failed=True)
+      else:
+        self.journal.finish(path)
+        download.finish()
+        self._downloaded(download, source)
+        self.sizes.update({path: download.bytes_written})
+        if self.evictor:
+          self.evictor.add(path, download.bytes_written)
+        if self.checksums and os.path.basename(path) == checksums_filename:
+          self._add_checksums(path)
+        if source is not None and self.origins.writes_back(source):
+          self._write_back(path, source)
+    return True
+
+  def _downloaded(self, download, source):
+    origin = source.origin.name if source is not None else 'upstream'
+    self.metrics.inc('genbankfs_downloads_total', result='ok')
+    self.metrics.inc('genbankfs_downloaded_bytes_total', download.bytes_written,
+                     origin=origin)
+    duration = time() - (download.started_at or time())
+    if duration > 0:
+      self.metrics.observe('genbankfs_download_bytes_per_second',
+                           download.bytes_written / duration,
+                           buckets=throughput_buckets, origin=origin)
+
+  def _describe_metrics(self):
+    describe = self.metrics.describe
+    describe('genbankfs_cache_opens_total', "Files opened which were (hit) or weren't (miss) cached")
+    describe('genbankfs_served_bytes_total', "Bytes returned by reads")
+    describe('genbankfs_downloaded_bytes_total', "Bytes downloaded by the origin they came from")
+    describe('genbankfs_downloads_total', "Finished downloads by result")
+    describe('genbankfs_download_bytes_per_second', "Throughput of each download")
+    describe('genbankfs_queue_wait_seconds', "Time jobs spent queued before they ran")
+    describe('genbankfs_queue_depth', "Jobs waiting to run")
+    describe('genbankfs_active_downloads', "Files which are queued or downloading")
+    for priority, name in priority_names.items():
+      self.metrics.gauge('genbankfs_queue_depth', partial(self.scheduler.qsize, priority),
+                         priority=name)
+    self.metrics.gauge('genbankfs_active_downloads', lambda: len(self.downloads))
+    describe('genbankfs_mapped_files', "Cached files which are memory mapped")
+    describe('genbankfs_mapped_bytes', "Size of the cached files which are memory mapped")
+
+  def _write_back(self, path, source):
+    try:
+      self.scheduler.put(partial(self.origins.fetched, path,
+                                 os.path.join(self.root_dir, path), source),
+                         background_priority)
+    except Full:
+      logging.info("Too busy to write %s back to the shared cache" % path)
+
+  def _add_checksums(self, path):
+    try:
+      with open(os.path.join(self.root_dir, path)) as f:
+        self.checksums.add(os.path.dirname(path), f.read())
+    except IOError:
+      pass
+
+  def _discard(self, path):
+    """Removes a corrupt file from the cache"""
+    if self.evictor:
+      self.evictor.discard(path)
+    elif self.blobs:
+      self.blobs.unlink(path)
+    else:
+      self._remove_quietly(os.path.join(self.root_dir, path))
+
+  def _remove_quietly(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
 
   def _check_in_root(self, path):
     if not os.path.realpath(path).startswith(self.root_dir):
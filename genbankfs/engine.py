@@ -0,0 +1,623 @@
+"""Drives many downloads at once from a single thread
+
+Python 2 doesn't have asyncio so this is a small event loop of its own
+in the same style.  Each transfer is a generator (a coroutine) which
+yields ('read', sock) or ('write', sock) when it needs to wait for a
+socket, or yields another coroutine to call it; coroutines return
+values by raising Return.  The loop polls every waiting socket at once
+so hundreds of transfers cost one thread rather than one each.
+
+Only plain HTTP and FTP are spoken.  Logged in FTP control connections
+and kept alive HTTP connections are reused between transfers to the
+same server.  Host names are resolved (once per host) in the loop
+thread."""
+
+import errno
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import select
+import socket
+import tempfile
+import urllib
+
+from collections import defaultdict, deque
+from threading import Lock, Semaphore, Thread
+from time import time
+from types import GeneratorType
+from urlparse import urljoin, urlparse
+
+from .journal import ResumableFile
+
+class Return(BaseException):
+  """Raised by a coroutine to return value to the coroutine which called it"""
+  def __init__(self, value=None):
+    self.value = value
+
+class TransferError(IOError):
+  status = None # set if an HTTP server answered with an unsuccessful status
+
+class Cancelled(IOError):
+  pass
+
+READ = 'read'
+WRITE = 'write'
+
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+class Task(object):
+  """A coroutine and the coroutines it's waiting on
+
+  timeout overrides the loop's timeout for this task if it's set"""
+  def __init__(self, coroutine, timeout=None):
+    self.stack = [coroutine]
+    self.timeout = timeout
+    self.fd = None
+    self.deadline = None
+    self.cancelled = False
+    self.cancel_delivered = False
+
+class EventLoop(object):
+  """Runs coroutines in one thread
+
+  spawn, cancel and stop can be called from any thread.  A coroutine
+  which waits for a socket for more than timeout seconds has
+  socket.timeout raised in it; one which is cancelled has Cancelled
+  raised in it."""
+  def __init__(self, timeout=600):
+    self.timeout = timeout
+    self.poller = select.poll()
+    self.waiting = {} # fd -> task
+    self.ready = deque() # (task, value, exception)
+    self.tasks = set()
+    self.requests = deque()
+    self.lock = Lock()
+    self.wake_read, self.wake_write = os.pipe()
+    self.poller.register(self.wake_read, select.POLLIN)
+    self.stopping = False
+    self.thread = Thread(target=self.run)
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def spawn(self, coroutine, timeout=None):
+    task = Task(coroutine, timeout)
+    self._request(('spawn', task))
+    return task
+
+  def cancel(self, task):
+    self._request(('cancel', task))
+
+  def stop(self):
+    """Cancels every task and waits for the loop to finish"""
+    self._request(('stop', None))
+    self.thread.join()
+
+  def _request(self, request):
+    with self.lock:
+      self.requests.append(request)
+    os.write(self.wake_write, 'x')
+
+  def _handle_requests(self):
+    with self.lock:
+      requests, self.requests = self.requests, deque()
+    for action, task in requests:
+      if action == 'spawn':
+        self.tasks.add(task)
+        self.ready.append((task, None, None))
+        if self.stopping:
+          self._cancel(task)
+      elif action == 'cancel':
+        self._cancel(task)
+      elif action == 'stop':
+        self.stopping = True
+        for task in list(self.tasks):
+          self._cancel(task)
+
+  def _cancel(self, task):
+    if task not in self.tasks or task.cancelled:
+      return
+    task.cancelled = True
+    if task.fd is not None:
+      self._unwait(task)
+      self.ready.append((task, None, None))
+
+  def _unwait(self, task):
+    self.poller.unregister(task.fd)
+    del self.waiting[task.fd]
+    task.fd = None
+
+  def run(self):
+    while True:
+      self._handle_requests()
+      while self.ready:
+        self._step(*self.ready.popleft())
+      if self.stopping and not self.tasks and not self.requests:
+        break
+      deadlines = [task.deadline for task in self.waiting.values()]
+      if self.requests:
+        timeout = 0
+      elif deadlines:
+        timeout = max(0, (min(deadlines) - time()) * 1000)
+      else:
+        timeout = None
+      for fd, event in self.poller.poll(timeout):
+        if fd == self.wake_read:
+          os.read(self.wake_read, 4096)
+          continue
+        task = self.waiting.get(fd)
+        if task is not None:
+          self._unwait(task)
+          self.ready.append((task, None, None))
+      now = time()
+      for task in self.waiting.values():
+        if task.deadline < now:
+          self._unwait(task)
+          self.ready.append((task, None, socket.timeout("timed out")))
+    os.close(self.wake_read)
+    os.close(self.wake_write)
+
+  def _step(self, task, value, exception):
+    """Runs task until it waits for a socket or finishes"""
+    while task.stack:
+      coroutine = task.stack[-1]
+      if task.cancelled and not task.cancel_delivered and _started(coroutine):
+        task.cancel_delivered = True
+        exception = Cancelled("Transfer cancelled")
+      try:
+        if exception is not None:
+          request = coroutine.throw(exception)
+        else:
+          request = coroutine.send(value)
+      except Return as e:
+        task.stack.pop()
+        value, exception = e.value, None
+        continue
+      except StopIteration:
+        task.stack.pop()
+        value, exception = None, None
+        continue
+      except Exception as e:
+        task.stack.pop()
+        value, exception = None, e
+        continue
+      value, exception = None, None
+      if isinstance(request, GeneratorType):
+        task.stack.append(request)
+        continue
+      if task.cancelled and not task.cancel_delivered:
+        task.cancel_delivered = True
+        exception = Cancelled("Transfer cancelled")
+        continue
+      event, sock = request
+      task.fd = sock.fileno()
+      task.deadline = time() + (task.timeout or self.timeout)
+      self.waiting[task.fd] = task
+      self.poller.register(task.fd, select.POLLIN if event == READ else select.POLLOUT)
+      return
+    self.tasks.discard(task)
+    if exception is not None:
+      logging.error("Unhandled error in event loop task: %s" % exception)
+
+def _started(coroutine):
+  # Exceptions thrown into a generator which hasn't started skip its
+  # cleanup so cancellations wait until it's running
+  return coroutine.gi_frame is not None and coroutine.gi_frame.f_lasti != -1
+
+class Stream(object):
+  """Buffered, non-blocking reads and writes for coroutines"""
+  def __init__(self, sock):
+    self.sock = sock
+    self.buffer = ''
+    self.eof = False
+
+  def fill(self):
+    while True:
+      try:
+        data = self.sock.recv(64*1024)
+      except socket.error as e:
+        if e.errno in _would_block:
+          yield (READ, self.sock)
+          continue
+        raise
+      if not data:
+        self.eof = True
+      self.buffer += data
+      return
+
+  def readline(self):
+    while '\n' not in self.buffer and not self.eof:
+      yield self.fill()
+    line, newline, self.buffer = self.buffer.partition('\n')
+    raise Return(line + newline)
+
+  def read_some(self, limit):
+    """Returns up to limit bytes ('' at the end of the stream)"""
+    if not self.buffer and not self.eof:
+      yield self.fill()
+    data, self.buffer = self.buffer[:limit], self.buffer[limit:]
+    raise Return(data)
+
+  def write(self, data):
+    while data:
+      try:
+        sent = self.sock.send(data)
+      except socket.error as e:
+        if e.errno in _would_block:
+          yield (WRITE, self.sock)
+          continue
+        raise
+      data = data[sent:]
+
+  def close(self):
+    self.sock.close()
+
+class FTPControl(object):
+  """A logged in FTP control connection"""
+  def __init__(self, stream):
+    self.stream = stream
+    self.directory = None
+
+  def reply(self):
+    line = yield self.stream.readline()
+    if not line:
+      raise socket.error(errno.ECONNRESET, "FTP server hung up")
+    code = line[:3]
+    text = [line]
+    if line[3:4] == '-':
+      while not (line[:3] == code and line[3:4] == ' '):
+        line = yield self.stream.readline()
+        if not line:
+          raise socket.error(errno.ECONNRESET, "FTP server hung up")
+        text.append(line)
+    raise Return((code, "".join(text).strip()))
+
+  def command(self, command, expected='2'):
+    yield self.stream.write(command + '\r\n')
+    code, text = yield self.reply()
+    if expected and not code.startswith(expected):
+      raise TransferError("FTP %s failed: %s" % (command.split()[0], text))
+    raise Return((code, text))
+
+  def close(self):
+    self.stream.close()
+
+_pasv = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)')
+
+class DownloadEngine(object):
+  """Downloads files into temporary files on an EventLoop
+
+  At most max_transfers downloads run at once: callers should take a
+  slot (acquire_slot) before fetching and give it back (release_slot)
+  when the download has finished.  This pushes back on whatever is
+  queueing downloads rather than letting transfers pile up."""
+  def __init__(self, max_transfers=64, timeout=600, blocksize=64*1024):
+    self.loop = EventLoop(timeout).start()
+    self.slots = Semaphore(max_transfers)
+    self.blocksize = blocksize
+    self.addresses = {}
+    self.idle = defaultdict(list) # connections which can be reused, by server
+
+  @staticmethod
+  def supports(url):
+    scheme = urlparse(url).scheme
+    return scheme in ('ftp', 'http') and scheme not in urllib.getproxies()
+
+  def acquire_slot(self):
+    self.slots.acquire()
+
+  def release_slot(self):
+    self.slots.release()
+
+  def fetch(self, url, temp_dir, progress, callback, timeout=None, resume_path=None):
+    """Downloads url into a temporary file in temp_dir
+
+    progress(temp_path, bytes_written) is called as data arrives.  When
+    the download finishes, callback(temp_file, None) or callback(None,
+    error) is called (in the loop's thread).  The temporary file's md5
+    attribute is the hex digest of its contents.  It is deleted when
+    it's closed unless its delete attribute is unset first.  timeout
+    overrides the engine's socket timeout for this download.
+
+    If resume_path is set, the download goes there instead (as a
+    ResumableFile) and carries on from the end of whatever is already in
+    it with a ranged request.  If it fails, resume_path is left alone.
+    Returns a task which can be cancelled."""
+    return self.loop.spawn(self._download(url, temp_dir, progress, callback, resume_path),
+                           timeout)
+
+  def cancel(self, task):
+    self.loop.cancel(task)
+
+  def stop(self):
+    self.loop.stop()
+    for connections in self.idle.values():
+      for connection in connections:
+        connection.close()
+    self.idle.clear()
+
+  def _download(self, url, temp_dir, progress, callback, resume_path=None):
+    temp_file = None
+    try:
+      if resume_path is not None:
+        temp_file = ResumableFile(resume_path)
+        # Reading back what's already there could take a while
+        md5 = (yield self._in_thread(temp_file.digest)) if temp_file.offset else None
+        sink = _TempFileSink(temp_file, progress, temp_file.offset, md5)
+      else:
+        if not os.path.isdir(temp_dir):
+          os.makedirs(temp_dir, 0755)
+        prefix = urlparse(url).path.split('/')[-1] + '_'
+        temp_file = tempfile.NamedTemporaryFile(mode='wb', prefix=prefix, suffix='.tmp',
+                                                dir=temp_dir, delete=True)
+        sink = _TempFileSink(temp_file, progress)
+      logging.info("Downloading %s to %s from byte %s" % (url, temp_file.name,
+                                                        sink.bytes_written))
+      progress(temp_file.name, sink.bytes_written)
+      if url.startswith('ftp:'):
+        yield self._ftp_transfer(url, sink)
+      else:
+        yield self._http_transfer(url, sink)
+      temp_file.md5 = sink.md5.hexdigest()
+      temp_file.delete = True
+    except Exception as e:
+      if temp_file is not None:
+        temp_file.close()
+      self._callback(callback, None, e)
+    else:
+      self._callback(callback, temp_file, None)
+
+  def _in_thread(self, func):
+    """Returns func() from a thread of its own so that the loop isn't held up"""
+    result = []
+    done, wake = socket.socketpair()
+    def run():
+      try:
+        result.append((func(), None))
+      except Exception as e:
+        result.append((None, e))
+      try:
+        wake.send('x')
+      except socket.error:
+        pass # we were cancelled
+      wake.close()
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+      yield (READ, done)
+    finally:
+      done.close()
+    value, error = result[0]
+    if error is not None:
+      raise error
+    raise Return(value)
+
+  def _callback(self, callback, temp_file, error):
+    try:
+      callback(temp_file, error)
+    except Exception:
+      logging.exception("Problem finishing a download")
+
+  def _connect(self, host, port):
+    address = self.addresses.get((host, port))
+    if address is None:
+      family, socktype, proto, name, address = socket.getaddrinfo(host, port, 0,
+                                                                  socket.SOCK_STREAM)[0]
+      self.addresses[(host, port)] = (family, address)
+    else:
+      family, address = address
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    error = sock.connect_ex(address)
+    if error not in (0,) + _would_block:
+      sock.close()
+      raise socket.error(error, os.strerror(error))
+    yield (WRITE, sock)
+    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error:
+      sock.close()
+      raise socket.error(error, os.strerror(error))
+    raise Return(Stream(sock))
+
+  def _take_idle(self, key):
+    connections = self.idle.get(key)
+    if connections:
+      return connections.pop()
+    return None
+
+  def _http_transfer(self, url, sink, redirects=5):
+    parsed = urlparse(url)
+    key = ('http', parsed.hostname, parsed.port or 80)
+    path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+    byte_range = "Range: bytes=%s-\r\n" % sink.bytes_written if sink.bytes_written else ""
+    request = ("GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\n%s\r\n" %
+               (path, parsed.netloc, byte_range))
+    stream = self._take_idle(key)
+    reused = stream is not None
+    while True:
+      if stream is None:
+        stream = yield self._connect(parsed.hostname, parsed.port or 80)
+      try:
+        yield stream.write(request)
+        status_line = yield stream.readline()
+        if not status_line:
+          raise socket.error(errno.ECONNRESET, "Web server hung up")
+        break
+      except socket.error:
+        stream.close()
+        stream = None
+        if not reused:
+          raise
+        reused = False # the server closed the idle connection; try a new one
+    try:
+      version, status, reason = (status_line.split(None, 2) + ['', ''])[:3]
+      headers = {}
+      while True:
+        line = yield stream.readline()
+        if not line.strip():
+          break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+      if status in ('301', '302', '303', '307') and 'location' in headers and redirects:
+        stream.close()
+        yield self._http_transfer(urljoin(url, headers['location']), sink, redirects - 1)
+        return
+      resumed = (status == '206' and
+                 headers.get('content-range', '').startswith('bytes %s-' % sink.bytes_written))
+      if byte_range and not resumed and status in ('200', '206', '416'):
+        sink.restart() # the server didn't take up where we stopped
+        if status != '200':
+          stream.close()
+          yield self._http_transfer(url, sink, redirects)
+          return
+      elif status != '200' and not resumed:
+        error = TransferError("Could not fetch %s: HTTP %s %s" % (url, status, reason.strip()))
+        error.status = int(status)
+        raise error
+      chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+      length = None if chunked else headers.get('content-length')
+      if chunked:
+        yield self._read_chunked(stream, sink)
+      elif length is not None:
+        yield self._read_length(stream, sink, int(length))
+      else:
+        yield self._read_to_end(stream, sink)
+    except:
+      stream.close()
+      raise
+    if (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        and (chunked or length is not None)):
+      self.idle[key].append(stream)
+    else:
+      stream.close()
+
+  def _read_length(self, stream, sink, length):
+    remaining = length
+    while remaining:
+      data = yield stream.read_some(min(remaining, self.blocksize))
+      if not data:
+        raise TransferError("retrieval incomplete: got only %i out of %i bytes" %
+                            (length - remaining, length))
+      sink.write(data)
+      remaining -= len(data)
+
+  def _read_chunked(self, stream, sink):
+    while True:
+      line = yield stream.readline()
+      try:
+        size = int(line.split(';')[0].strip(), 16)
+      except ValueError:
+        raise TransferError("Bad chunk header: %r" % line)
+      if size == 0:
+        while (yield stream.readline()).strip():
+          pass # trailers
+        return
+      yield self._read_length(stream, sink, size)
+      yield stream.readline()
+
+  def _read_to_end(self, stream, sink):
+    while True:
+      data = yield stream.read_some(self.blocksize)
+      if not data:
+        return
+      sink.write(data)
+
+  def _ftp_transfer(self, url, sink):
+    parsed = urlparse(url)
+    key = ('ftp', parsed.hostname, parsed.port or 21,
+           parsed.username or 'anonymous', parsed.password or 'anonymous@')
+    directory, filename = posixpath.split(urllib.unquote(parsed.path))
+    control = self._take_idle(key)
+    reused = control is not None
+    while True:
+      try:
+        if control is None:
+          control = yield self._ftp_login(key)
+        if control.directory != directory:
+          yield control.command('CWD ' + (directory or '/'))
+          control.directory = directory
+        code, text = yield control.command('SIZE ' + filename, expected=None)
+        size = int(text.split()[1]) if code == '213' else None
+        if size is not None and sink.bytes_written > size:
+          sink.restart()
+        code, text = yield control.command('PASV', '227')
+        numbers = map(int, _pasv.search(text).groups())
+        data_stream = yield self._connect('.'.join(map(str, numbers[:4])),
+                                          numbers[4] * 256 + numbers[5])
+        break
+      except socket.error:
+        if control is not None:
+          control.close()
+          control = None
+        if not reused:
+          raise
+        reused = False # the server closed the idle connection; try a new one
+      except:
+        if control is not None:
+          control.close()
+        raise
+    try:
+      try:
+        if sink.bytes_written:
+          yield control.command('REST %s' % sink.bytes_written, '3')
+        yield control.command('RETR ' + filename, '1')
+        yield self._read_to_end(data_stream, sink)
+      finally:
+        data_stream.close()
+      code, text = yield control.reply()
+      if not code.startswith('2'):
+        raise TransferError("FTP transfer of %s failed: %s" % (url, text))
+      if size is not None and sink.bytes_written < size:
+        raise TransferError("retrieval incomplete: got only %i out of %i bytes" %
+                            (sink.bytes_written, size))
+    except:
+      control.close()
+      raise
+    self.idle[key].append(control)
+
+  def _ftp_login(self, key):
+    scheme, host, port, user, password = key
+    stream = yield self._connect(host, port)
+    control = FTPControl(stream)
+    try:
+      code, text = yield control.reply()
+      if not code.startswith('2'):
+        raise TransferError("FTP server refused connection: %s" % text)
+      code, text = yield control.command('USER ' + user, expected=None)
+      if code.startswith('3'):
+        yield control.command('PASS ' + password)
+      elif not code.startswith('2'):
+        raise TransferError("FTP login failed: %s" % text)
+      yield control.command('TYPE I')
+    except:
+      control.close()
+      raise
+    raise Return(control)
+
+class _TempFileSink(object):
+  """Writes to temp_file, which already has offset bytes (whose md5 is md5)"""
+  def __init__(self, temp_file, progress, offset=0, md5=None):
+    self.temp_file = temp_file
+    self.progress = progress
+    self.bytes_written = offset
+    self.md5 = md5 or hashlib.md5()
+
+  def restart(self):
+    """Throws away what was already in the file (telling progress first)"""
+    if self.bytes_written:
+      self.progress(self.temp_file.name, 0)
+    self.temp_file.truncate()
+    self.bytes_written = 0
+    self.md5 = hashlib.md5()
+
+  def write(self, data):
+    self.temp_file.write(data)
+    self.md5.update(data)
+    self.temp_file.flush()
+    self.bytes_written += len(data)
+    self.progress(self.temp_file.name, self.bytes_written)
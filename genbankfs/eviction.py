@@ -0,0 +1,263 @@
+"""Keeps the cache directory under a size limit
+
+Files in the cache are tracked with the last time they were opened.
+When the cache grows beyond its capacity, a background thread deletes
+the least recently used files which aren't open until it is back under
+low_water of its capacity.  Access times are saved in the cache root
+so that they survive restarts."""
+
+import logging
+import os
+import tempfile
+
+from collections import Counter
+from threading import Event, Lock, Thread
+from time import time
+
+# Things in the cache root which aren't cached files
+reserved_names = set(['tmp', 'partial', 'metadata', 'gzindex', 'blobs'])
+
+def gzip_index_path(root_dir, path):
+  """Where the GzipIndex of a cached file is kept"""
+  return os.path.join(root_dir, 'gzindex', path + '.idx')
+
+class CacheEvictor(object):
+  """Evicts files from a cache to keep it under max_bytes and max_files
+
+  policy is 'lru' (oldest access first) or 'size' which prefers to
+  evict large files by ranking them by age * size.  Files larger than
+  max_file_fraction of max_bytes aren't admitted; they're evicted as
+  soon as nothing has them open.  pinned_func should return the set of
+  paths which are open and mustn't be deleted.
+
+  Paths which are hard links to the same file (see BlobStore) only
+  count towards max_bytes once and the space only comes back when the
+  last of them is evicted.  Files are removed with blob_store if it's
+  given so that their blobs go too."""
+  def __init__(self, root_dir, max_bytes=None, max_files=None, policy='lru',
+               pinned_func=lambda: set(), low_water=0.9, max_file_fraction=0.5,
+               interval=10, save_interval=60, blob_store=None):
+    if policy not in ('lru', 'size'):
+      raise ValueError("Unknown eviction policy %s" % policy)
+    self.root_dir = root_dir
+    self.max_bytes = max_bytes
+    self.max_files = max_files
+    self.policy = policy
+    self.pinned = pinned_func
+    self.low_water = low_water
+    self.max_file_fraction = max_file_fraction
+    self.interval = interval
+    self.save_interval = save_interval
+    self.blob_store = blob_store
+    self.access_path = os.path.join(root_dir, 'access.tsv')
+    self.files = {} # path -> [size, last_access, inode]
+    self.links = Counter() # inode -> number of paths
+    self.total_bytes = 0
+    self.unadmitted = 0 # files with a last_access of 0
+    self.lock = Lock()
+    self.wake = Event()
+    self.loaded = Event()
+    self.dirty = False
+    self.stopped = False
+    self.thread = None
+
+  def start(self):
+    self.thread = Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    """Stops the background thread (after saving access times)"""
+    self.stopped = True
+    self.wake.set()
+    if self.thread is not None:
+      self.thread.join()
+
+  def touch(self, path):
+    """Records that path has been used (this is cheap)"""
+    entry = self.files.get(path)
+    if entry is not None and entry[1] != 0: # files which weren't admitted stay that way
+      entry[1] = time()
+      self.dirty = True
+
+  def add(self, path, size):
+    """Records a new file in the cache and wakes the evictor if it's full"""
+    admitted = self.admit(size)
+    try:
+      inode = os.lstat(os.path.join(self.root_dir, path)).st_ino
+    except OSError:
+      inode = None
+    with self.lock:
+      self._untrack(path)
+      self._track(path, [size, time() if admitted else 0, inode])
+      self.dirty = True
+    if not admitted:
+      logging.info("%s is too big to keep in the cache" % path)
+    if not admitted or self.over_capacity():
+      self.wake.set()
+
+  def admit(self, size):
+    if self.max_bytes is None:
+      return True
+    return size <= self.max_bytes * self.max_file_fraction
+
+  def released(self):
+    """Called when a file is closed in case it can now be evicted"""
+    if self.over_capacity() or self._has_unadmitted():
+      self.wake.set()
+
+  def over_capacity(self, fraction=1.0):
+    if self.max_bytes is not None and self.total_bytes > self.max_bytes * fraction:
+      return True
+    if self.max_files is not None and len(self.files) > self.max_files * fraction:
+      return True
+    return False
+
+  def _has_unadmitted(self):
+    return self.unadmitted > 0
+
+  def _track(self, path, entry):
+    self.files[path] = entry
+    size, last_access, inode = entry
+    if last_access == 0:
+      self.unadmitted += 1
+    if inode is None or self.links[inode] == 0:
+      self.total_bytes += size
+    if inode is not None:
+      self.links[inode] += 1
+
+  def _untrack(self, path):
+    entry = self.files.pop(path, None)
+    if entry is None:
+      return
+    size, last_access, inode = entry
+    if last_access == 0:
+      self.unadmitted -= 1
+    if inode is not None:
+      self.links[inode] -= 1
+      if self.links[inode] > 0:
+        return # other paths still link to it
+      del self.links[inode]
+    self.total_bytes -= size
+
+  def scan(self):
+    """Finds the files in the cache and loads their saved access times"""
+    access_times = {}
+    try:
+      with open(self.access_path) as f:
+        for line in f:
+          try:
+            path, last_access = line.rstrip('\n').split('\t')
+            access_times[path] = float(last_access)
+          except ValueError:
+            pass
+    except IOError:
+      pass
+    files = {}
+    for accession in os.listdir(self.root_dir):
+      accession_dir = os.path.join(self.root_dir, accession)
+      if accession in reserved_names or not os.path.isdir(accession_dir):
+        continue
+      for filename in os.listdir(accession_dir):
+        path = "%s/%s" % (accession, filename)
+        try:
+          st = os.lstat(os.path.join(accession_dir, filename))
+        except OSError:
+          continue
+        files[path] = [st.st_size, access_times.get(path, st.st_atime), st.st_ino]
+    with self.lock:
+      # files may have been added while we were scanning
+      files.update(self.files)
+      self.files = {}
+      self.links = Counter()
+      self.total_bytes = 0
+      self.unadmitted = 0
+      for path, entry in files.items():
+        self._track(path, entry)
+    self.loaded.set()
+
+  def save(self):
+    """Saves access times to the cache root"""
+    self.dirty = False
+    with self.lock:
+      entries = [(path, entry[1]) for path, entry in self.files.items()]
+    with tempfile.NamedTemporaryFile(mode='w', dir=self.root_dir,
+                                     prefix='access_', suffix='.tmp',
+                                     delete=False) as f:
+      f.writelines("%s\t%r\n" % entry for entry in entries)
+    os.rename(f.name, self.access_path)
+
+  def evict(self):
+    """Deletes files until the cache is under its low water mark
+
+    Returns the paths which were evicted"""
+    pinned = self.pinned()
+    now = time()
+    with self.lock:
+      candidates = [(path, size, last_access) for path, (size, last_access, inode)
+                    in self.files.items() if path not in pinned]
+    if self.policy == 'size':
+      rank = lambda (path, size, last_access): -(now - last_access) * size
+    else:
+      rank = lambda (path, size, last_access): last_access
+    candidates.sort(key=rank)
+    evicted = []
+    for path, size, last_access in candidates:
+      if last_access != 0 and not self.over_capacity(self.low_water):
+        break
+      self._remove(path)
+      evicted.append(path)
+    if evicted:
+      logging.info("Evicted %s files from the cache; it is now %s bytes" % (len(evicted),
+                                                                             self.total_bytes))
+      self.dirty = True
+    return evicted
+
+  def discard(self, path):
+    """Deletes path from the cache (e.g. because it's corrupt)"""
+    self._remove(path)
+    self.dirty = True
+
+  def _remove(self, path):
+    cache_path = os.path.join(self.root_dir, path)
+    if self.blob_store is not None:
+      self.blob_store.unlink(path)
+    else:
+      try:
+        os.remove(cache_path)
+      except OSError:
+        pass
+    try:
+      os.rmdir(os.path.dirname(cache_path))
+    except OSError:
+      pass # there are other files in the accession
+    try:
+      os.remove(gzip_index_path(self.root_dir, path))
+    except OSError:
+      pass
+    with self.lock:
+      self._untrack(path)
+
+  def _run(self):
+    self.scan()
+    last_saved = time()
+    while not self.stopped:
+      if self.over_capacity() or self._has_unadmitted():
+        try:
+          self.evict()
+        except Exception:
+          logging.exception("Problem evicting files from the cache")
+      if self.dirty and time() - last_saved > self.save_interval:
+        try:
+          self.save()
+        except (IOError, OSError):
+          logging.exception("Couldn't save cache access times")
+        last_saved = time()
+      self.wake.wait(self.interval)
+      self.wake.clear()
+    if self.dirty:
+      try:
+        self.save()
+      except (IOError, OSError):
+        logging.exception("Couldn't save cache access times")
@@ -1,13 +1,21 @@
+import ctypes
+import hashlib
+import itertools
 import logging
 import os
 
 from collections import namedtuple
-from errno import ENOENT
+from errno import ENOENT, ENOTDIR
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from sys import exit
 from time import time
 
-from fuse import FuseOSError, Operations, LoggingMixIn
+from boltons.cacheutils import LRU
+from fuse import (FUSE, FuseOSError, Operations, LoggingMixIn, c_stat,
+                  fuse_get_context, set_st_attrs)
+
+from .cache import accession_files, decompressed_files
+from .metrics import Metrics
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
@@ -15,28 +23,180 @@ if not hasattr(__builtins__, 'bytes'):
 class PathParseResult(namedtuple("PathParseResult", "file_path dir_name path_list query")):
   pass
 
+_as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+_as_read_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(ctypes.c_void_p),
+                            ctypes.POINTER(ctypes.c_ssize_t)]
+_as_read_buffer.restype = ctypes.c_int
+
+def _buffer_address(data):
+  """Returns the address and length of a str or buffer's bytes"""
+  address = ctypes.c_void_p()
+  length = ctypes.c_ssize_t()
+  _as_read_buffer(data, ctypes.byref(address), ctypes.byref(length))
+  return address.value, length.value
+
+class PagedFUSE(FUSE):
+  """Passes the offset the kernel wants a directory listed from to readdir
+
+  fusepy's FUSE lists every entry each time the kernel asks for more.
+  This one expects readdir(path, fh, offset) to return a page of
+  (name, attributes, next offset) entries and lists nothing else, so a
+  big directory is read a page at a time.
+
+  read can also return a buffer (e.g. of a memory mapped file), which
+  is copied straight into the kernel's buffer rather than via a string.
+  It sets operations' paged attribute so that they know they've been
+  mounted this way."""
+  def read(self, path, buf, size, offset, fip):
+    data = self.operations('read', self._decode_optional_path(path), size, offset,
+                           fip.contents.fh)
+    if not data:
+      return 0
+    address, length = _buffer_address(data)
+    assert length <= size, 'read %d bytes but only %d were asked for' % (length, size)
+    ctypes.memmove(buf, address, length)
+    return length
+
+  def __init__(self, operations, *args, **kwargs):
+    operations.paged = True
+    super(PagedFUSE, self).__init__(operations, *args, **kwargs)
+
+  def readdir(self, path, buf, filler, offset, fip):
+    entries = self.operations('readdir', self._decode_optional_path(path),
+                              fip.contents.fh, offset)
+    for name, attrs, next_offset in entries:
+      st = c_stat()
+      set_st_attrs(st, attrs, use_ns=self.use_ns)
+      if filler(buf, name.encode(self.encoding), st, next_offset) != 0:
+        break
+    return 0
+
 class GenbankFuse(LoggingMixIn, Operations):
-  def __init__(self, searcher, cache):
+  """A filesystem for browsing Genbank
+
+  The metadata doesn't change while it is mounted so parsed paths and
+  directory listings are kept in LRU caches.  Paths which aren't listed
+  (unknown folders, values with no accessions under the folders above
+  them) don't exist; they're kept in another LRU cache (of up to
+  missing_cache_size) so that probes for .git and the like are cheap.
+  Unless decompressed_views is unset, accessions also list uncompressed
+  versions of their gzipped files.
+
+  Directories are listed from the sorted values in the search indexes
+  and each entry comes with its mode and inode.  fusepy's FUSE wants
+  every entry at once and strings from read; mounted with PagedFUSE (or
+  if paged is set) they are listed readdir_page_size at a time and read
+  returns buffers of the cache's memory mapped files.
+
+  Attributes don't change unless a file is downloaded so that the
+  kernel can cache them (see the entry_timeout and attr_timeout FUSE
+  options).  Directories are timestamped when the filesystem was
+  created and every path has a stable inode number (see inode).
+
+  The time taken by each operation, path parse and search is recorded
+  in metrics (the cache's by default).  Reading stats_path (which isn't
+  listed) returns everything which has been recorded."""
+  stats_path = '/.stats'
+
+  def __init__(self, searcher, cache, parse_cache_size=100000,
+               readdir_cache_size=1000, decompressed_views=True, metrics=None,
+               missing_cache_size=100000, readdir_page_size=1000, paged=False):
     self.searcher = searcher
     self.cache = cache
+    if metrics is None:
+      metrics = getattr(cache, 'metrics', None)
+      if not isinstance(metrics, Metrics):
+        metrics = Metrics()
+    self.metrics = metrics
+    self.metrics.describe('genbankfs_fuse_op_seconds', "Time taken by each FUSE operation")
+    self.metrics.describe('genbankfs_fuse_errors_total', "FUSE operations which failed")
+    self.metrics.describe('genbankfs_parse_path_seconds', "Time taken to parse paths which weren't cached")
+    self.metrics.describe('genbankfs_search_seconds', "Time taken to list a folder's values")
+    self.metrics.gauge('genbankfs_parse_cache_size', lambda: len(self.parse_cache))
+    self.metrics.gauge('genbankfs_readdir_cache_size', lambda: len(self.readdir_cache))
+    self.metrics.gauge('genbankfs_missing_cache_size', lambda: len(self.missing_cache))
+    self.stats_files = {} # file handle -> the stats it was opened with
+    # numbered well above any real file descriptor
+    self.stats_handles = itertools.count(2**32)
+    self.parse_cache = LRU(max_size=parse_cache_size)
+    self.readdir_cache = LRU(max_size=readdir_cache_size)
+    self.missing_cache = LRU(max_size=missing_cache_size)
+    self.readdir_page_size = readdir_page_size
+    self.paged = paged
     self.parsers = {folder: self._parser_builder(folder)
                       for folder in self.searcher.folders}
     self.parsers['accession'] = self._parse_accession
-    self.accession_files = [
-      'README.txt',
-      'md5checksums.txt',
-      '{accession}_assembly_stats.txt',
-      '{accession}_assembly_report.txt',
-      '{accession}_genomic.fna.gz',
-      '{accession}_genomic.gbff.gz',
-      '{accession}_genomic.gff.gz'
-    ]
+    self.accession_files = list(accession_files)
+    if decompressed_views:
+      self.accession_files += decompressed_files
+    self.mount_time = time()
     self.fn = 0
     super(GenbankFuse, self).__init__()
 
+  def __call__(self, op, *args):
+    with self.metrics.timed('genbankfs_fuse_op_seconds', op=op):
+      try:
+        return super(GenbankFuse, self).__call__(op, *args)
+      except Exception:
+        self.metrics.inc('genbankfs_fuse_errors_total', op=op)
+        raise
+
   def parse_path(self, path, query=None):
-    query = {} if query == None else query
+    if query:
+      return self._parse_uncached_path(path, query)
+    return self._lookup(path)[0]
+
+  def resolve(self, path):
+    """Parses a path, raising ENOENT if it doesn't exist"""
+    parse_result, exists = self._lookup(path)
+    if not exists:
+      raise FuseOSError(ENOENT)
+    return parse_result
+
+  def _lookup(self, path):
+    """Returns a path's parse result and whether it exists"""
+    try:
+      return self.parse_cache[path], True
+    except KeyError:
+      pass
+    try:
+      return self.missing_cache[path], False
+    except KeyError:
+      pass
+    with self.metrics.timed('genbankfs_parse_path_seconds'):
+      result = self._parse_uncached_path(path, {})
+      exists = self._exists(path)
+    if exists:
+      self.parse_cache[path] = result
+    else:
+      self.missing_cache[path] = result
+    return result, exists
+
+  def _exists(self, path):
+    """True if each part of path would be listed by its parent"""
+    path_list = [part for part in os.path.realpath(path).split(os.path.sep) if part]
+    query = {}
+    while path_list:
+      folder = path_list[0]
+      if folder not in self.parsers or folder in query:
+        return False
+      if len(path_list) == 1:
+        return True
+      listing = self._cached_listing(folder, query)
+      value = path_list[1]
+      query[folder] = value
+      if not (listing is not None and value in listing) and not self.searcher.exists(**query):
+        return False
+      if folder == 'accession':
+        # accession directories only have files in them
+        filenames = path_list[2:]
+        return (len(filenames) == 0 or
+                (len(filenames) == 1 and self._is_accession_file(query['accession'],
+                                                                 filenames[0])))
+      path_list = path_list[2:]
+    return True
 
+  def _parse_uncached_path(self, path, query):
     drive_path, base_path = os.path.splitdrive(path)
     path_list = os.path.realpath(base_path).split(os.path.sep)
     assert path_list.pop(0) == '' # first element is ''
@@ -104,30 +264,141 @@ class GenbankFuse(LoggingMixIn, Operations):
       pass
     return PathParseResult(None, 'default', [], query)
 
-  def readdir(self, path, fh):
-    parse_result = self.parse_path(path)
+  def readdir(self, path, fh, offset=0):
+    """Returns a directory's (name, attributes, next offset) entries
+
+    The attributes are each entry's mode and inode.  If paged, there are
+    up to readdir_page_size entries starting at offset and an empty list
+    means there are no more.  Otherwise every entry is returned (with
+    offsets of 0, so that the kernel doesn't ask for them by offset)."""
+    if self.paged:
+      return self._readdir_page(path, offset, self.readdir_page_size)
+    return [(name, attributes, 0) for name, attributes, next_offset
+            in self._readdir_page(path, 0, None)]
+
+  def _readdir_page(self, path, offset, page_size):
+    """Up to page_size (or all) entries from offset, as paged readdir returns"""
+    parse_result = self.resolve(path)
     if parse_result.file_path:
-      return [path]
-    elif 'accession' in parse_result.query:
-      accession_id = parse_result.query['accession']
-      accession_files = [filename.format(accession=accession_id) for filename
-                         in self.accession_files]
-      return ['.', '..'] + accession_files
+      raise FuseOSError(ENOTDIR)
+    query = parse_result.query
+    # each entry's inode key is prefix + name + suffix
+    if 'accession' in query:
+      accession_id = query['accession']
+      names = [filename.format(accession=accession_id) for filename
+               in self.accession_files]
+      mode = S_IFREG | 0444
+      prefix, suffix = '/' + os.path.join(accession_id, ''), ''
     elif parse_result.dir_name == 'default':
-      folders = set(self.searcher.folders).difference(parse_result.query.keys())
-      return ['.', '..'] + list(folders)
+      names = sorted(set(self.searcher.folders).difference(query.keys()))
+      mode = S_IFDIR | 0755
+      prefix, suffix = self._inode_key(PathParseResult(None, '\0', [], query)).split('\0')
     else:
-      return ['.', '..'] + self.searcher.list(parse_result.dir_name,
-                                              **parse_result.query)
+      folder = parse_result.dir_name
+      names = self._listing(folder, query)
+      mode = S_IFDIR | 0755
+      prefix, suffix = self._inode_key(PathParseResult(None, 'default', [],
+                                                       dict(query, **{folder: '\0'}))).split('\0')
+    entries = []
+    if offset < 2:
+      parent = self.parse_path(os.path.dirname(os.path.realpath(path)))
+      dots = [('.', self.inode(parse_result)), ('..', self.inode(parent))]
+      for position, (name, inode) in enumerate(dots[offset:], offset):
+        entries.append((name, dict(st_mode=(S_IFDIR | 0755), st_ino=inode),
+                        position + 1))
+    start = max(offset - 2, 0)
+    end = None if page_size is None else start + page_size - len(entries)
+    for position, name in enumerate(names[start:end], start + 2):
+      entries.append((name, dict(st_mode=mode, st_ino=self._inode(prefix + name + suffix)),
+                      position + 1))
+    return entries
+
+  def listdir(self, path):
+    """Yields the name of everything in a directory, a page at a time"""
+    offset = 0
+    while True:
+      entries = self._readdir_page(path, offset, self.readdir_page_size)
+      if not entries:
+        return
+      for name, attributes, offset in entries:
+        yield name
+      if len(entries) < self.readdir_page_size:
+        return
+
+  def _listing(self, folder, query):
+    """The values of folder under query as a (cached) Listing"""
+    key = (folder, tuple(sorted(query.items())))
+    try:
+      return self.readdir_cache[key]
+    except KeyError:
+      with self.metrics.timed('genbankfs_search_seconds', folder=folder):
+        listing = self.searcher.listing(folder, **query)
+      self.readdir_cache[key] = listing
+      return listing
+
+  def _cached_listing(self, folder, query):
+    """Like _listing but returns None rather than searching"""
+    key = (folder, tuple(sorted(query.items())))
+    if key in self.readdir_cache:
+      return self.readdir_cache.get(key)
+    return None
+
+  def cache_stats(self):
+    """Hit and miss counts for the parsed path and listing caches"""
+    return {
+      'parse_path': dict(hits=self.parse_cache.hit_count,
+                         misses=self.parse_cache.miss_count,
+                         size=len(self.parse_cache)),
+      'readdir': dict(hits=self.readdir_cache.hit_count,
+                      misses=self.readdir_cache.miss_count,
+                      size=len(self.readdir_cache)),
+      'missing': dict(hits=self.missing_cache.hit_count,
+                      misses=self.missing_cache.miss_count,
+                      size=len(self.missing_cache))
+    }
+
+  def inode(self, parse_result):
+    """A stable inode number for a parsed path
+
+    It only depends on what the path refers to, so it's the same in
+    every mount and each accession file has the same number however
+    it's reached (as if they were hard links).  The root is 1, as FUSE
+    numbers it."""
+    if (not parse_result.file_path and parse_result.dir_name == 'default' and
+        not parse_result.query):
+      return 1
+    return self._inode(self._inode_key(parse_result))
+
+  def _inode_key(self, parse_result):
+    if parse_result.file_path:
+      return '/' + parse_result.file_path
+    return "%s?%s" % (parse_result.dir_name,
+                      '&'.join('%s=%s' % item for item in sorted(parse_result.query.items())))
+
+  def _inode(self, key):
+    return int(hashlib.md5(key).hexdigest()[:15], 16) + 2 # 1 is the root's
 
   def getattr(self, path, fh=None):
-    parse_result = self.parse_path(path)
+    if path == self.stats_path:
+      # each handle reads the snapshot it was opened with (fstat asks
+      # with its handle so that the kernel knows that snapshot's size)
+      stats = self.stats_files.get(fh)
+      if stats is None:
+        stats = self.metrics.render()
+      now = time()
+      return dict(st_mode=(S_IFREG | 0444), st_nlink=1, st_ino=self._inode(path),
+                  st_size=len(stats), st_ctime=now, st_mtime=now,
+                  st_atime=now)
+    parse_result = self.resolve(path)
     if parse_result.file_path:
-      return self.cache.getattr(parse_result.file_path)
+      attributes = dict(self.cache.getattr(parse_result.file_path))
+      attributes['st_ino'] = self.inode(parse_result)
+      return attributes
     else:
       return dict(st_mode=(S_IFDIR | 0755), st_nlink=2,
-                  st_size=0, st_ctime=time(), st_mtime=time(),
-                  st_atime=time())
+                  st_ino=self.inode(parse_result), st_size=0,
+                  st_ctime=self.mount_time, st_mtime=self.mount_time,
+                  st_atime=self.mount_time)
 
   def getxattr(self, path, name, position=0):
     return self.getattr(path).get(name, '')
@@ -136,14 +407,29 @@ class GenbankFuse(LoggingMixIn, Operations):
     return self.getattr(path).keys()
 
   def open(self, path, flags):
-    parse_result = self.parse_path(path)
+    if path == self.stats_path:
+      fh = next(self.stats_handles)
+      self.stats_files[fh] = self.metrics.render()
+      return fh
+    parse_result = self.resolve(path)
     if parse_result.file_path:
-      return self.cache.open(parse_result.file_path, flags)
+      uid, gid, pid = fuse_get_context()
+      return self.cache.open(parse_result.file_path, flags, pid=pid)
     else:
       raise FuseOSError("Path '%s' was not parsable" % path)
 
   def read(self, path, size, offset, fh):
+    """Returns a string or, if paged, maybe a buffer of a memory mapped file"""
+    if fh in self.stats_files:
+      return self.stats_files[fh][offset:offset + size]
+    if self.paged:
+      return self.cache.read_view(size, offset, fh)
     return self.cache.read(size, offset, fh)
 
+  def release(self, path, fh):
+    if self.stats_files.pop(fh, None) is not None:
+      return
+    return self.cache.release(fh)
+
   def statfs(self, path):
     return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
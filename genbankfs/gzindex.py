@@ -0,0 +1,321 @@
+"""Random access into gzip files
+
+Reading from the middle of a gzip file usually means decompressing
+everything before it.  An index records access points every span bytes
+of uncompressed data (like zlib's zran example): where a deflate block
+starts in the compressed file, how many bits of its first byte belong
+to the previous block and the 32KB of uncompressed data before it which
+later blocks can refer back to.  A read starts at the last access point
+before it so it decompresses at most span bytes it doesn't want.
+
+Python's zlib module can't start inflating part way through a byte or
+tell us where blocks start so we drive libz through ctypes."""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import tempfile
+import zlib
+
+from bisect import bisect_right
+from threading import Lock
+
+class GzipIndexError(IOError):
+  pass
+
+_libz = ctypes.CDLL(ctypes.util.find_library('z'))
+
+class _ZStream(ctypes.Structure):
+  _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint),
+              ('total_in', ctypes.c_ulong), ('next_out', ctypes.c_void_p),
+              ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+              ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+              ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p),
+              ('opaque', ctypes.c_void_p), ('data_type', ctypes.c_int),
+              ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+_stream_pointer = ctypes.POINTER(_ZStream)
+_libz.zlibVersion.restype = ctypes.c_char_p
+_libz.inflateInit2_.argtypes = [_stream_pointer, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+_libz.inflate.argtypes = [_stream_pointer, ctypes.c_int]
+_libz.inflateEnd.argtypes = [_stream_pointer]
+_libz.inflateReset.argtypes = [_stream_pointer]
+_libz.inflatePrime.argtypes = [_stream_pointer, ctypes.c_int, ctypes.c_int]
+_libz.inflateSetDictionary.argtypes = [_stream_pointer, ctypes.c_char_p, ctypes.c_uint]
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+GZIP_WINDOW_BITS = 31 # gzip header and trailer
+AUTO_WINDOW_BITS = 47 # gzip or zlib header
+RAW_WINDOW_BITS = -15 # bare deflate blocks
+
+WINDOW_SIZE = 32768
+_version = _libz.zlibVersion()
+
+class _Inflater(object):
+  """A libz inflate stream"""
+  def __init__(self, window_bits):
+    self.stream = _ZStream()
+    self.input = None # keeps the buffer next_in points into alive
+    self.output = ctypes.create_string_buffer(WINDOW_SIZE)
+    ret = _libz.inflateInit2_(ctypes.byref(self.stream), window_bits, _version,
+                              ctypes.sizeof(_ZStream))
+    if ret != Z_OK:
+      raise GzipIndexError("Couldn't start inflating (%s)" % ret)
+
+  def feed(self, data):
+    """Gives inflate more input; anything it hadn't used is kept"""
+    if self.stream.avail_in:
+      data = self.unused() + data
+    self.input = ctypes.create_string_buffer(data, len(data))
+    self.stream.next_in = ctypes.addressof(self.input)
+    self.stream.avail_in = len(data)
+
+  def unused(self):
+    return ctypes.string_at(self.stream.next_in, self.stream.avail_in)
+
+  def skip(self, count):
+    """Drops count bytes of unused input"""
+    unused = self.unused()[count:]
+    self.stream.avail_in = 0
+    self.feed(unused)
+
+  def prime(self, bits, value):
+    _libz.inflatePrime(ctypes.byref(self.stream), bits, value)
+
+  def set_dictionary(self, window):
+    _libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window))
+
+  def reset(self):
+    _libz.inflateReset(ctypes.byref(self.stream))
+
+  def inflate(self, size, flush=Z_NO_FLUSH):
+    """Returns (return code, up to size bytes of output)"""
+    if len(self.output) < size:
+      self.output = ctypes.create_string_buffer(size)
+    self.stream.next_out = ctypes.addressof(self.output)
+    self.stream.avail_out = size
+    ret = _libz.inflate(ctypes.byref(self.stream), flush)
+    if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+      raise GzipIndexError("Corrupt gzip data: %s" % (self.stream.msg or ret))
+    return ret, self.output.raw[:size - self.stream.avail_out]
+
+  def close(self):
+    if self.stream is not None:
+      _libz.inflateEnd(ctypes.byref(self.stream))
+      self.stream = None
+
+  def __del__(self):
+    self.close()
+
+class GzipIndex(object):
+  """Access points into a gzip file
+
+  points is a sorted list of (uncompressed offset, compressed offset,
+  bits, window).  Windows are kept zlib compressed (as they are in the
+  saved index) because there are 32KB of them per span and an index
+  can be in memory for a long time; they're inflated when a reader
+  starts from them.  size is the length of the uncompressed data and
+  compressed_size and mtime identify the gzip file it was built from."""
+  magic = 'GZIDX1\n'
+  header = struct.Struct('<QQdI')
+  point_header = struct.Struct('<QQBI')
+
+  def __init__(self, points, size, compressed_size, mtime):
+    self.points = points
+    self.offsets = [point[0] for point in points]
+    self.size = size
+    self.compressed_size = compressed_size
+    self.mtime = mtime
+
+  @classmethod
+  def build(cls, path, span=1024**2, chunk_size=64*1024):
+    """Decompresses path once, noting an access point every span bytes"""
+    st = os.stat(path)
+    points = []
+    inflater = _Inflater(AUTO_WINDOW_BITS)
+    window = ''
+    total_in = total_out = 0
+    last = None
+    ended = False
+    try:
+      with open(path, 'rb') as f:
+        while True:
+          if inflater.stream.avail_in == 0:
+            data = f.read(chunk_size)
+            if not data:
+              break
+            if ended:
+              # another gzip member follows the one which just ended
+              inflater.reset()
+              ended = False
+            inflater.feed(data)
+          available = inflater.stream.avail_in
+          ret, output = inflater.inflate(WINDOW_SIZE, Z_BLOCK)
+          total_in += available - inflater.stream.avail_in
+          total_out += len(output)
+          if ret == Z_BUF_ERROR and inflater.stream.avail_in:
+            raise GzipIndexError("%s stopped inflating" % path)
+          window = (window + output)[-WINDOW_SIZE:]
+          if ret == Z_STREAM_END:
+            ended = True
+            if inflater.stream.avail_in:
+              inflater.reset()
+              ended = False
+            continue
+          data_type = inflater.stream.data_type
+          if (data_type & 128 and not data_type & 64 and
+              (last is None or total_out - last > span)):
+            points.append((total_out, total_in, data_type & 7,
+                           zlib.compress(window.rjust(WINDOW_SIZE, '\0'))))
+            last = total_out
+    finally:
+      inflater.close()
+    if not ended:
+      raise GzipIndexError("%s is truncated" % path)
+    return cls(points, total_out, st.st_size, st.st_mtime)
+
+  def matches(self, path):
+    """True if this was built from the file which is at path"""
+    try:
+      st = os.stat(path)
+    except OSError:
+      return False
+    return st.st_size == self.compressed_size and st.st_mtime == self.mtime
+
+  def save(self, index_path):
+    index_dir = os.path.dirname(index_path)
+    if not os.path.isdir(index_dir):
+      os.makedirs(index_dir, 0755)
+    with tempfile.NamedTemporaryFile(mode='wb', dir=index_dir, suffix='.tmp',
+                                     delete=False) as f:
+      f.write(self.magic)
+      f.write(self.header.pack(self.size, self.compressed_size, self.mtime,
+                               len(self.points)))
+      for out_offset, in_offset, bits, window in self.points:
+        f.write(self.point_header.pack(out_offset, in_offset, bits, len(window)))
+        f.write(window)
+    os.rename(f.name, index_path)
+
+  @classmethod
+  def load(cls, index_path):
+    """Returns a saved index or None if it can't be read"""
+    try:
+      with open(index_path, 'rb') as f:
+        if f.read(len(cls.magic)) != cls.magic:
+          return None
+        size, compressed_size, mtime, count = cls.header.unpack(f.read(cls.header.size))
+        points = []
+        for i in xrange(count):
+          out_offset, in_offset, bits, length = cls.point_header.unpack(
+            f.read(cls.point_header.size))
+          window = f.read(length)
+          if len(window) != length:
+            raise IOError("%s is truncated" % index_path)
+          points.append((out_offset, in_offset, bits, window))
+    except (IOError, struct.error):
+      logging.info("Couldn't read gzip index %s" % index_path)
+      return None
+    return cls(points, size, compressed_size, mtime)
+
+  def point_before(self, offset):
+    return self.points[max(bisect_right(self.offsets, offset) - 1, 0)]
+
+class GzipReader(object):
+  """Reads the uncompressed data of a gzip file using its index
+
+  read_func(offset, size) reads the compressed file.  Sequential reads
+  carry on inflating from where the last one stopped; others start from
+  the nearest access point."""
+  def __init__(self, index, read_func, chunk_size=64*1024):
+    self.index = index
+    self.read_compressed = read_func
+    self.chunk_size = chunk_size
+    self.inflater = None
+    self.position = 0 # of the next uncompressed byte
+    self.in_offset = 0 # of the next compressed byte to feed in
+    self.raw = True
+    self.lock = Lock()
+
+  def read(self, size, offset):
+    with self.lock:
+      size = min(size, self.index.size - offset)
+      if size <= 0 or not self.index.points:
+        return ''
+      if (self.inflater is None or offset < self.position or
+          offset - self.position > offset - self.index.point_before(offset)[0]):
+        self._seek(offset)
+      while self.position < offset:
+        self._inflate(min(offset - self.position, 1024**2))
+      pieces = []
+      remaining = size
+      while remaining > 0:
+        data = self._inflate(min(remaining, 1024**2))
+        if not data:
+          break
+        pieces.append(data)
+        remaining -= len(data)
+      return ''.join(pieces)
+
+  def close(self):
+    with self.lock:
+      if self.inflater is not None:
+        self.inflater.close()
+        self.inflater = None
+
+  def _seek(self, offset):
+    out_offset, in_offset, bits, window = self.index.point_before(offset)
+    if self.inflater is not None:
+      self.inflater.close()
+    self.inflater = _Inflater(RAW_WINDOW_BITS)
+    self.raw = True
+    self.in_offset = in_offset
+    if bits:
+      self.in_offset -= 1
+      byte = self.read_compressed(self.in_offset, 1)
+      self.in_offset += 1
+      self.inflater.prime(bits, ord(byte) >> (8 - bits))
+    try:
+      self.inflater.set_dictionary(zlib.decompress(window))
+    except zlib.error as e:
+      raise GzipIndexError("Corrupt gzip index: %s" % e)
+    self.position = out_offset
+
+  def _fill(self, minimum=1):
+    while self.inflater.stream.avail_in < minimum:
+      data = self.read_compressed(self.in_offset, self.chunk_size)
+      if not data:
+        raise GzipIndexError("Unexpected end of gzip data")
+      self.in_offset += len(data)
+      self.inflater.feed(data)
+
+  def _inflate(self, size):
+    """Returns the next (up to) size bytes of uncompressed data"""
+    while True:
+      if self.inflater.stream.avail_in == 0:
+        self._fill()
+      ret, output = self.inflater.inflate(size)
+      self.position += len(output)
+      if ret == Z_STREAM_END:
+        if self.position >= self.index.size:
+          return output
+        self._next_member()
+      if output:
+        return output
+
+  def _next_member(self):
+    if self.raw:
+      self._fill(8)
+      self.inflater.skip(8) # the crc and length of the member which ended
+    unused = self.inflater.unused()
+    self.inflater.close()
+    self.inflater = _Inflater(GZIP_WINDOW_BITS)
+    self.raw = False
+    if unused:
+      self.inflater.feed(unused)
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+class StringTable(object):
+  """An immutable list of strings packed into a single buffer
+
+  The ith string is blob[offsets[i]:offsets[i+1]].  Both are plain
+  numpy arrays so they can be saved and memory mapped."""
+  def __init__(self, blob, offsets):
+    self.blob = blob
+    self.offsets = offsets
+    self._data = buffer(blob)
+
+  @classmethod
+  def from_strings(cls, strings):
+    strings = [str(string) for string in strings]
+    lengths = np.fromiter((len(string) for string in strings),
+                          dtype=np.int64, count=len(strings))
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    blob = np.frombuffer("".join(strings), dtype=np.uint8)
+    return cls(blob, offsets)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self._data[self.offsets[i]:self.offsets[i+1]]
+
+  def __iter__(self):
+    return iter(self.take(np.arange(len(self))))
+
+  def take(self, positions):
+    """Returns a list of the strings at positions"""
+    positions = np.asarray(positions)
+    starts = self.offsets[positions].tolist()
+    ends = self.offsets[positions + 1].tolist()
+    data = self._data
+    return [data[start:end] for start, end in zip(starts, ends)]
+
+  def search(self, value):
+    """Returns the position of value in a sorted table (or None)"""
+    low, high = 0, len(self)
+    while low < high:
+      middle = (low + high) // 2
+      if self[middle] < value:
+        low = middle + 1
+      else:
+        high = middle
+    if low < len(self) and self[low] == value:
+      return low
+    return None
+
+class PrefixTable(object):
+  """Strings stored as one of a table of shared prefixes plus a suffix
+
+  The ith string is prefixes[codes[i]] + suffixes[i].  Accession URLs
+  are a directory shared by up to a thousand accessions followed by the
+  accession itself, which the accession index already has, so they take
+  four bytes each rather than a hundred."""
+  def __init__(self, prefixes, codes, suffixes):
+    self.prefixes = prefixes
+    self.codes = codes
+    self.suffixes = suffixes
+
+  @classmethod
+  def from_strings(cls, strings, suffixes):
+    """Raises ValueError unless each string ends with its suffix"""
+    prefixes = []
+    for string, suffix in zip(strings, suffixes):
+      string = str(string)
+      if not string.endswith(suffix):
+        raise ValueError("%s doesn't end with %s" % (string, suffix))
+      prefixes.append(string[:len(string) - len(suffix)])
+    codes, values = pd.factorize(np.array(prefixes, dtype=object), sort=True)
+    return cls(StringTable.from_strings(values), codes.astype(np.int32), suffixes)
+
+  def __len__(self):
+    return len(self.codes)
+
+  def __getitem__(self, i):
+    return self.prefixes[self.codes[i]] + self.suffixes[i]
+
+  def take(self, positions):
+    """Returns a list of the strings at positions"""
+    positions = np.asarray(positions)
+    return [prefix + suffix for prefix, suffix
+            in zip(self.prefixes.take(self.codes[positions]),
+                   self.suffixes.take(positions))]
+
+class FolderIndex(object):
+  """An inverted index from the values of a folder column to row ids
+
+  values is a sorted StringTable and each value's code is its position
+  in values.  rows holds every row id grouped by code so that the rows
+  with a given code are rows[offsets[code]:offsets[code+1]] (in order)."""
+  def __init__(self, values, codes, rows, offsets):
+    self.values = values
+    self.codes = codes
+    self.rows = rows
+    self.offsets = offsets
+
+  @classmethod
+  def from_column(cls, column):
+    codes, values = pd.factorize(column, sort=True)
+    return cls.from_codes(StringTable.from_strings(values),
+                          codes.astype(np.int32))
+
+  @classmethod
+  def from_codes(cls, values, codes):
+    rows = np.argsort(codes, kind='mergesort').astype(np.int32)
+    counts = np.bincount(codes, minlength=len(values))
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return cls(values, codes, rows, offsets)
+
+  def code(self, value):
+    """Returns the code for value or None if it isn't in the index"""
+    return self.values.search(value)
+
+  def lookup(self, value):
+    """Returns a sorted array of the rows which have value"""
+    code = self.code(value)
+    if code is None:
+      return np.empty(0, dtype=np.int32)
+    return self.rows[self.offsets[code]:self.offsets[code+1]]
+
+  def distinct(self, rows=None):
+    """Lists the distinct values in rows (or in every row)"""
+    if rows is None:
+      return list(self.values)
+    return self.values.take(np.unique(self.codes[rows]))
+
+  def listing(self, rows=None):
+    """The distinct values in rows (or in every row) as a Listing"""
+    if rows is None:
+      return Listing(self.values)
+    return Listing(self.values, np.unique(self.codes[rows]))
+
+  def take(self, rows):
+    """Returns the value of each of rows"""
+    return self.values.take(self.codes[rows])
+
+class Listing(object):
+  """A sorted list of some of a StringTable's strings
+
+  Only their positions (codes) are held, or nothing if it's all of
+  them, so strings are only made for the slices which are asked for.
+  Supports len, slicing and in (a binary search)."""
+  def __init__(self, values, codes=None):
+    self.values = values
+    self.codes = codes
+
+  def __len__(self):
+    return len(self.values) if self.codes is None else len(self.codes)
+
+  def __getitem__(self, index):
+    if not isinstance(index, slice):
+      raise TypeError("Listings can only be sliced")
+    positions = np.arange(*index.indices(len(self)))
+    if self.codes is not None:
+      positions = self.codes[positions]
+    return self.values.take(positions)
+
+  def __contains__(self, value):
+    code = self.values.search(value)
+    if code is None:
+      return False
+    if self.codes is None:
+      return True
+    position = np.searchsorted(self.codes, code)
+    return position < len(self.codes) and self.codes[position] == code
+
+def intersect(row_sets):
+  """Intersects sorted arrays of row ids
+
+  Starts with the smallest and binary searches the others so the cost
+  depends on the size of the smallest set rather than the database"""
+  row_sets = sorted(row_sets, key=len)
+  result = row_sets[0]
+  for rows in row_sets[1:]:
+    if len(result) == 0:
+      break
+    positions = np.searchsorted(rows, result)
+    positions = np.minimum(positions, len(rows) - 1)
+    result = result[rows[positions] == result]
+  return result
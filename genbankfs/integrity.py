@@ -0,0 +1,274 @@
+"""Checks cached files against their accession's md5checksums.txt
+
+A download which is cut short (or mangled on the way) would otherwise
+be cached and served forever.  Downloads work out their md5 as they
+stream into tmp/ and are only moved into the cache if it matches the
+one Genbank publishes.  A Scrubber re-reads cached files slowly in the
+background to catch anything which goes bad on disk."""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import urllib
+
+from threading import Event, Lock, Thread
+from time import time
+
+from boltons.cacheutils import LRU
+
+from .eviction import reserved_names
+from .sessions import SessionPool, thread_sessions
+
+checksums_filename = 'md5checksums.txt'
+
+_checksum_line = re.compile(r'^([0-9a-fA-F]{32})\s+\*?(?:\./)?(.+)$')
+
+def parse_md5checksums(text):
+  """Returns {filename: md5} from the contents of an md5checksums.txt"""
+  checksums = {}
+  for line in text.splitlines():
+    match = _checksum_line.match(line.strip())
+    if match:
+      md5, filename = match.groups()
+      checksums[filename] = md5.lower()
+  return checksums
+
+def fetch_text(url, timeout):
+  if SessionPool.supports(url):
+    source = thread_sessions().open(url, timeout=timeout)
+  else:
+    source = urllib.urlopen(url)
+  try:
+    return source.read()
+  finally:
+    source.close()
+
+class ChecksumIndex(object):
+  """Expected md5s of files (by path relative to the cache root)
+
+  Each accession's md5checksums.txt is fetched the first time one of
+  its files needs checking and the checksums are appended to a tab
+  separated file so that they survive restarts.  Accessions whose
+  checksums can't be fetched aren't retried for retry_delay seconds;
+  until then their files can't be checked."""
+  def __init__(self, index_path, lookup_func, timeout=60, retry_delay=300):
+    self.index_path = index_path
+    self.lookup = lookup_func
+    self.timeout = timeout
+    self.retry_delay = retry_delay
+    self.checksums = {}
+    self.accessions = set()
+    self.failures = LRU(max_size=10000) # accession -> time of failure
+    self.lock = Lock()
+    try:
+      with open(index_path) as f:
+        for line in f:
+          try:
+            path, md5 = line.rstrip('\n').split('\t')
+          except ValueError:
+            continue # probably a partially written line
+          self.checksums[path] = md5
+          self.accessions.add(path.partition('/')[0])
+    except IOError:
+      pass
+
+  def ready(self, path):
+    """True if expected(path) won't need to go to the network"""
+    accession, _, filename = path.partition('/')
+    return (not filename or filename == checksums_filename or
+            accession in self.accessions or self._recently_failed(accession))
+
+  def expected(self, path, fetch=True):
+    """Returns the md5 path should have or None if we don't know
+
+    If fetch is unset, only the checksums we already have are used."""
+    accession, _, filename = path.partition('/')
+    if not filename or filename == checksums_filename:
+      return None
+    if fetch and not self.ready(path):
+      self._fetch(accession)
+    return self.checksums.get(path)
+
+  def url(self, accession):
+    """Where accession's md5checksums.txt comes from"""
+    return self.lookup("%s/%s" % (accession, checksums_filename))
+
+  def add(self, accession, text):
+    """Records the checksums in the md5checksums.txt of accession"""
+    checksums = dict(("%s/%s" % (accession, filename), md5) for filename, md5
+                     in parse_md5checksums(text).items())
+    with self.lock:
+      new_checksums = dict((path, md5) for path, md5 in checksums.items()
+                           if self.checksums.get(path) != md5)
+      self.checksums.update(new_checksums)
+      self.accessions.add(accession)
+      if new_checksums:
+        with open(self.index_path, 'a') as f:
+          f.writelines("%s\t%s\n" % item for item in new_checksums.items())
+
+  def failed(self, accession, error):
+    """Records that accession's checksums couldn't be fetched"""
+    logging.info("Couldn't fetch the checksums of %s: %s" % (accession, error))
+    self.failures[accession] = time()
+
+  def _recently_failed(self, accession):
+    failed_at = self.failures.get(accession)
+    return failed_at is not None and time() - failed_at < self.retry_delay
+
+  def _fetch(self, accession):
+    try:
+      text = fetch_text(self.url(accession), self.timeout)
+    except Exception as e:
+      self.failed(accession, e)
+      return
+    self.add(accession, text)
+
+class Scrubber(object):
+  """Re-checks the md5s of cached files in the background
+
+  Files are read at no more than rate bytes per second so that checking
+  them doesn't compete with reads through FUSE.  The files which were
+  checked longest ago go first and nothing is checked more than once
+  every min_age seconds.  Downloads are recorded as checked (verified)
+  because their md5 was worked out as they were written.  Corrupt files
+  are passed to remove_func so that they're downloaded again next time
+  they are opened.  Check times are saved in the cache root."""
+  def __init__(self, root_dir, checksums, rate, remove_func=None, min_age=7*24*3600,
+               interval=60, save_interval=60, blocksize=1024**2):
+    self.root_dir = root_dir
+    self.checksums = checksums
+    self.rate = rate
+    self.remove = remove_func or self._remove
+    self.min_age = min_age
+    self.interval = interval
+    self.save_interval = save_interval
+    self.blocksize = blocksize
+    self.checked_path = os.path.join(root_dir, 'scrubbed.tsv')
+    self.checked = {} # path -> last time it was checked
+    self.lock = Lock()
+    self.dirty = False
+    self.stopped = Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+
+  def verified(self, path):
+    """Records that path has just been checked"""
+    with self.lock:
+      self.checked[path] = time()
+      self.dirty = True
+
+  def scan(self):
+    """Loads the saved check times; returns the cached files which are due"""
+    try:
+      with open(self.checked_path) as f:
+        for line in f:
+          try:
+            path, checked_at = line.rstrip('\n').split('\t')
+            checked_at = float(checked_at)
+          except ValueError:
+            continue
+          with self.lock:
+            if checked_at > self.checked.get(path, 0):
+              self.checked[path] = checked_at
+    except IOError:
+      pass
+    due = []
+    now = time()
+    for accession in os.listdir(self.root_dir):
+      accession_dir = os.path.join(self.root_dir, accession)
+      if accession in reserved_names or not os.path.isdir(accession_dir):
+        continue
+      for filename in os.listdir(accession_dir):
+        path = "%s/%s" % (accession, filename)
+        checked_at = self.checked.get(path, 0)
+        if now - checked_at > self.min_age:
+          due.append((checked_at, path))
+    return [path for checked_at, path in sorted(due)]
+
+  def save(self):
+    self.dirty = False
+    with self.lock:
+      entries = self.checked.items()
+    with tempfile.NamedTemporaryFile(mode='w', dir=self.root_dir,
+                                     prefix='scrubbed_', suffix='.tmp',
+                                     delete=False) as f:
+      f.writelines("%s\t%r\n" % entry for entry in entries)
+    os.rename(f.name, self.checked_path)
+
+  def check(self, path):
+    """Re-reads path and removes it if its md5 is wrong
+
+    Returns True if it's fine, False if it was corrupt and None if we
+    couldn't tell (no checksum or it disappeared while we read it)"""
+    expected = self.checksums.expected(path)
+    if expected is None:
+      return None
+    cache_path = os.path.join(self.root_dir, path)
+    digest = hashlib.md5()
+    started = time()
+    bytes_read = 0
+    try:
+      with open(cache_path, 'rb') as f:
+        inode = os.fstat(f.fileno()).st_ino
+        while True:
+          block = f.read(self.blocksize)
+          if not block:
+            break
+          digest.update(block)
+          bytes_read += len(block)
+          delay = bytes_read / float(self.rate) - (time() - started)
+          if delay > 0 and self.stopped.wait(delay):
+            return None
+    except IOError:
+      return None
+    self.verified(path)
+    if digest.hexdigest() == expected:
+      return True
+    try:
+      if os.stat(cache_path).st_ino != inode:
+        return None # it was replaced while we were reading it
+    except OSError:
+      return None
+    logging.warning("%s is corrupt (md5 %s but expected %s); removing it" % (path,
+                                                                            digest.hexdigest(),
+                                                                            expected))
+    self.remove(path)
+    with self.lock:
+      self.checked.pop(path, None)
+    return False
+
+  def _remove(self, path):
+    try:
+      os.remove(os.path.join(self.root_dir, path))
+    except OSError:
+      pass
+
+  def _run(self):
+    last_saved = time()
+    while not self.stopped.is_set():
+      try:
+        for path in self.scan():
+          if self.stopped.is_set():
+            break
+          self.check(path)
+          if self.dirty and time() - last_saved > self.save_interval:
+            self.save()
+            last_saved = time()
+        if self.dirty:
+          self.save()
+          last_saved = time()
+      except Exception:
+        logging.exception("Problem scrubbing the cache")
+      self.stopped.wait(self.interval)
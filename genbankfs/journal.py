@@ -0,0 +1,296 @@
+"""Remembers downloads which are in progress so that they can be resumed
+
+Each download streams into a file in tmp/ named after the path it's
+for and the URL it's coming from.  The journal (a tab separated file in
+the cache root) records the URL, how much of it has arrived and the
+size and md5 it's expected to have.  A download which is interrupted
+(because it timed out or genbankfs was stopped) carries on from where
+it got to with an HTTP Range or FTP REST request rather than starting
+again.
+
+More than one process can use the same cache (e.g. a mount and
+genbankfs-materialize) so each holds a lock (flock) on the files in
+tmp/ which it's downloading into and a shared lock on the cache's
+downloads.lock.  Other processes leave locked files alone and only a
+process which has the cache to itself tidies up tmp/."""
+
+import fcntl
+import hashlib
+import logging
+import os
+
+from collections import namedtuple
+from threading import Lock
+
+class JournalEntry(namedtuple("JournalEntry", "path url bytes_received size md5")):
+  """A download in progress; size and md5 are None if they weren't known"""
+  pass
+
+class ResumableFile(object):
+  """The temporary file of a download which might be resumed
+
+  It looks enough like a NamedTemporaryFile for the cache to use it in
+  the same way, but it's only deleted when it's closed if delete is
+  set.  Downloads set it once they've finished (so that corrupt ones are
+  thrown away) and leave it unset if they fail so that the next attempt
+  can carry on where they stopped.  offset is how much was already
+  there when it was opened."""
+  def __init__(self, path):
+    self.name = path
+    self.delete = False
+    self.md5 = None
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory, 0755)
+    self.file = open(path, 'ab')
+    self.offset = self.file.tell()
+
+  def digest(self):
+    """Returns an md5 object which has been fed the bytes already there"""
+    digest = hashlib.md5()
+    with open(self.name, 'rb') as f:
+      remaining = self.offset
+      while remaining:
+        block = f.read(min(remaining, 1024**2))
+        if not block:
+          break
+        digest.update(block)
+        remaining -= len(block)
+    return digest
+
+  def truncate(self):
+    """Throws away what was there so the download starts from the beginning"""
+    self.file.truncate(0)
+    self.offset = 0
+
+  def write(self, data):
+    self.file.write(data)
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    if self.file.closed:
+      return
+    self.file.close()
+    if self.delete:
+      try:
+        os.remove(self.name)
+      except OSError:
+        pass
+
+class DownloadJournal(object):
+  """Downloads which are in progress (by their temp_path)
+
+  Like SizeIndex, entries are appended to a tab separated file and later
+  lines override earlier ones; finished downloads get a line of their
+  own.  The file is rewritten with just the unfinished downloads when
+  it's loaded by a process which has the cache to itself.  How much has
+  arrived is only recorded every checkpoint_bytes so that fast
+  downloads don't write a line per block.  Call close to let other
+  processes have the files we were downloading."""
+  def __init__(self, root_dir, checkpoint_bytes=8*1024**2):
+    self.journal_path = os.path.join(root_dir, 'downloads.tsv')
+    self.temp_dir = os.path.join(root_dir, 'tmp')
+    self.checkpoint_bytes = checkpoint_bytes
+    self.entries = {}
+    self.owned = {} # temp_path -> the (locked) file
+    self.lock = Lock()
+    self.owner_lock = open(os.path.join(root_dir, 'downloads.lock'), 'a')
+    try:
+      fcntl.flock(self.owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      self.exclusive = True
+    except IOError:
+      self.exclusive = False # another process is using the cache
+    try:
+      with open(self.journal_path) as f:
+        for line in f:
+          fields = line.rstrip('\n').split('\t')
+          try:
+            if len(fields) == 2 and fields[1] == '-':
+              self._forget(fields[0])
+            else:
+              path, url, bytes_received, size, md5 = fields
+              self.entries[self.temp_path(path, url)] = JournalEntry(
+                path, url, int(bytes_received), int(size) if size else None, md5 or None)
+          except ValueError:
+            pass # probably a partially written line
+    except IOError:
+      pass
+    if self.exclusive:
+      self._rewrite()
+    fcntl.flock(self.owner_lock, fcntl.LOCK_SH)
+
+  def temp_path(self, path, url):
+    """Where the download of path from url goes while it's in progress"""
+    key = hashlib.md5("%s\t%s" % (path, url)).hexdigest()
+    return os.path.join(self.temp_dir, "%s_%s.tmp" % (os.path.basename(path), key))
+
+  def start(self, path, url, size=None, md5=None):
+    """Records that path is being downloaded from url; returns its temp_path
+
+    What's already in temp_path is kept if its expected size and md5
+    haven't changed; otherwise it's emptied so that the download starts
+    from the beginning.  Partial downloads from other URLs are left for
+    later.  Returns None if another process is downloading path from url
+    (so the download should go somewhere of its own)."""
+    temp_path = self.temp_path(path, url)
+    with self.lock:
+      if not self._own(temp_path):
+        logging.info("Another process is downloading %s from %s" % (path, url))
+        return None
+      entry = self.entries.get(temp_path)
+      if entry is not None and self._resumable(entry, temp_path, size, md5):
+        logging.info("Resuming download of %s from byte %s" % (path,
+                                                               os.path.getsize(temp_path)))
+        entry = entry._replace(size=size or entry.size, md5=md5 or entry.md5)
+      else:
+        self.owned[temp_path].truncate(0)
+        entry = JournalEntry(path, url, 0, size, md5)
+      self.entries[temp_path] = entry
+      self._append(entry)
+    return temp_path
+
+  def _resumable(self, entry, temp_path, size, md5):
+    try:
+      partial_size = os.path.getsize(temp_path)
+    except OSError:
+      return False
+    if size and entry.size and size != entry.size:
+      return False
+    if md5 and entry.md5 and md5 != entry.md5:
+      return False # the file has changed upstream
+    expected_size = size or entry.size
+    if expected_size is not None and partial_size > expected_size:
+      return False
+    # If less is there than we recorded, it wasn't written out before we
+    # stopped so we can't trust any of it
+    return partial_size >= entry.bytes_received
+
+  def progress(self, temp_path, bytes_received):
+    """Records how much has been written to temp_path
+
+    Less than before means the download had to start again."""
+    entry = self.entries.get(temp_path)
+    if entry is None or 0 <= bytes_received - entry.bytes_received < self.checkpoint_bytes:
+      return
+    with self.lock:
+      entry = self.entries.get(temp_path)
+      if entry is None:
+        return
+      entry = self.entries[temp_path] = entry._replace(bytes_received=bytes_received)
+      self._append(entry)
+
+  def finish(self, path):
+    """Forgets about path's downloads (it's been stored or thrown away)
+
+    What we'd downloaded from other URLs is removed."""
+    with self.lock:
+      if not self._forget(path):
+        return
+      with open(self.journal_path, 'a') as f:
+        f.write("%s\t-\n" % path)
+
+  def _forget(self, path):
+    temp_paths = [temp_path for temp_path, entry in self.entries.items()
+                  if entry.path == path]
+    for temp_path in temp_paths:
+      del self.entries[temp_path]
+      self._disown(temp_path, remove=True)
+    return bool(temp_paths)
+
+  def interrupted(self):
+    """Returns the paths of downloads which haven't finished
+
+    Downloads which another process is working on are left out; we take
+    the rest on."""
+    with self.lock:
+      return sorted(set(entry.path for temp_path, entry in self.entries.items()
+                        if self._own(temp_path)))
+
+  def close(self):
+    """Lets other processes carry on with our unfinished downloads"""
+    with self.lock:
+      for temp_path in list(self.owned):
+        self._disown(temp_path)
+    self.owner_lock.close()
+
+  def collect(self, keep=()):
+    """Removes files in tmp/ which aren't the temp_path of an unfinished download
+
+    They were left behind by downloads which were interrupted before
+    they were journaled (or by older versions of genbankfs).  Files in
+    keep (e.g. the warning files) are left alone.  Nothing is removed if
+    another process is using the cache because its temporary files
+    might not be in the journal yet.  Returns the number of files
+    removed."""
+    if not self.exclusive:
+      logging.info("Not tidying %s while another process uses it" % self.temp_dir)
+      return 0
+    with self.lock:
+      keep = set(keep) | set(self.entries)
+    try:
+      filenames = os.listdir(self.temp_dir)
+    except OSError:
+      return 0
+    removed = 0
+    for filename in filenames:
+      temp_path = os.path.join(self.temp_dir, filename)
+      if temp_path in keep or not os.path.isfile(temp_path):
+        continue
+      self._remove_quietly(temp_path)
+      removed += 1
+    if removed:
+      logging.info("Removed %s abandoned files from %s" % (removed, self.temp_dir))
+    return removed
+
+  def _own(self, temp_path):
+    """Locks temp_path (creating it if need be); False if someone else has"""
+    if temp_path in self.owned:
+      return True
+    if not os.path.isdir(self.temp_dir):
+      os.makedirs(self.temp_dir, 0755)
+    f = open(temp_path, 'ab')
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      f.close()
+      return False
+    self.owned[temp_path] = f
+    return True
+
+  def _disown(self, temp_path, remove=False):
+    f = self.owned.pop(temp_path, None)
+    if f is None:
+      return
+    try:
+      # unless it's been moved into the cache and something else has
+      # taken its place
+      if remove and os.stat(temp_path).st_ino == os.fstat(f.fileno()).st_ino:
+        os.remove(temp_path)
+    except OSError:
+      pass
+    f.close()
+
+  def _append(self, entry):
+    with open(self.journal_path, 'a') as f:
+      f.write(self._line(entry))
+
+  def _line(self, entry):
+    return "%s\t%s\t%s\t%s\t%s\n" % (entry.path, entry.url, entry.bytes_received,
+                                     entry.size or '', entry.md5 or '')
+
+  def _rewrite(self):
+    temp_path = self.journal_path + '.tmp'
+    try:
+      with open(temp_path, 'w') as f:
+        f.writelines(self._line(entry) for entry in self.entries.values())
+      os.rename(temp_path, self.journal_path)
+    except (IOError, OSError):
+      logging.info("Couldn't rewrite %s" % self.journal_path)
+
+  def _remove_quietly(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
@@ -0,0 +1,74 @@
+"""Memory maps of cached files, shared between their open handles
+
+Reading a hot genome with pread costs a syscall and a few copies for
+each chunk FUSE asks for.  Files which are completely cached don't
+change, so each is mapped once (per inode, so deduplicated files share
+a mapping) and reads are served from the mapping: either as a slice or,
+with read_view, as a buffer which can be copied straight into FUSE's."""
+
+import mmap
+import os
+
+from threading import Lock
+
+class MappedFile(object):
+  """A read only mapping of a whole file and how many handles are using it"""
+  def __init__(self, key, fd, size):
+    self.key = key
+    self.size = size
+    self.mmap = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    self.users = 0
+
+  def read(self, size, offset):
+    return self.mmap[offset:offset + size]
+
+  def view(self, size, offset):
+    """Like read but returns a buffer of the mapping rather than copying it"""
+    return buffer(self.mmap, min(offset, self.size), size)
+
+  def close(self):
+    self.mmap.close()
+
+class MappedFiles(object):
+  """The mappings of a cache's open files
+
+  Each handle acquires its file's mapping when it's opened and releases
+  it when it's closed; the mapping is unmapped when its last handle is
+  released.  Files with open handles aren't evicted so nothing which is
+  mapped is ever removed from the cache (and if it was replaced, the
+  mapping would still have the old inode, as the handles do)."""
+  def __init__(self):
+    self.files = {} # (st_dev, st_ino) -> MappedFile
+    self.lock = Lock()
+
+  def acquire(self, fd):
+    """Returns a MappedFile for fd (or None if it can't be mapped)"""
+    st = os.fstat(fd)
+    if st.st_size == 0:
+      return None # empty files can't be mapped
+    key = (st.st_dev, st.st_ino)
+    with self.lock:
+      mapped = self.files.get(key)
+      if mapped is None:
+        try:
+          mapped = MappedFile(key, fd, st.st_size)
+        except (EnvironmentError, ValueError):
+          return None
+        self.files[key] = mapped
+      mapped.users += 1
+    return mapped
+
+  def release(self, mapped):
+    with self.lock:
+      mapped.users -= 1
+      if mapped.users > 0:
+        return
+      del self.files[mapped.key]
+    mapped.close()
+
+  def mapped_bytes(self):
+    with self.lock:
+      return sum(mapped.size for mapped in self.files.values())
+
+  def __len__(self):
+    return len(self.files)
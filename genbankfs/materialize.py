@@ -0,0 +1,65 @@
+"""Downloads every file matching a query into the cache ahead of time
+
+Batch jobs which know which accessions they need can fill the cache
+before they start rather than waiting for each file as it's opened."""
+
+import logging
+
+from collections import Counter
+from time import time
+
+from .cache import accession_files
+
+def parse_terms(term_strings):
+  """Turns ['genus=streptococcus', ...] into {'genus': 'streptococcus', ...}"""
+  terms = {}
+  for term in term_strings:
+    folder, equals, value = term.partition('=')
+    if not equals or not value:
+      raise ValueError("Expected folder=value but got '%s'" % term)
+    terms[folder] = value
+  return terms
+
+def matching_paths(searcher, files=None, **terms):
+  """Returns the cache paths of the files in each accession matching terms
+
+  files is a list of file names (e.g. '{accession}_genomic.fna.gz') and
+  defaults to all of them"""
+  unknown_folders = set(terms).difference(searcher.folders)
+  if unknown_folders:
+    raise ValueError("Can't search by %s; try one of %s" % (", ".join(sorted(unknown_folders)),
+                                                           ", ".join(searcher.folders)))
+  accessions = sorted(set(searcher.query(**terms)['accession_slug']))
+  return ["%s/%s" % (accession, filename.format(accession=accession))
+          for accession in accessions
+          for filename in (files or accession_files)]
+
+def materialize(searcher, cache, files=None, timeout=3600, **terms):
+  """Downloads the files of every accession matching terms into cache
+
+  Downloads are queued as prefetches so they go through the cache's
+  download threads and queue like everything else.  Returns a Counter of
+  'cached' (already there), 'downloaded', 'failed' and 'skipped' (not
+  available or still downloading timeout seconds after they were all
+  queued)"""
+  results = Counter()
+  downloads = []
+  for path in matching_paths(searcher, files, **terms):
+    if cache.is_cached(path):
+      results['cached'] += 1
+      continue
+    download = cache.prefetch(path, block=True)
+    if download is None:
+      results['skipped'] += 1
+    else:
+      downloads.append(download)
+  logging.info("Waiting for %s downloads" % len(downloads))
+  deadline = time() + timeout
+  for download in downloads:
+    if not download.wait(lambda: False, timeout=max(deadline - time(), 0)):
+      results['skipped'] += 1
+    elif download.failed:
+      results['failed'] += 1
+    else:
+      results['downloaded'] += 1
+  return results
@@ -0,0 +1,246 @@
+"""Counters and histograms for watching a running mount
+
+Everything is kept in memory and rendered in Prometheus' text format,
+either over HTTP (MetricsServer) or by reading /.stats in the mount.
+Each OS thread records values in its own counters and histograms,
+which are only added up when they're rendered, so recording a value
+is a dictionary lookup and a few additions without a lock and
+instrumentation can be left on under load."""
+
+import logging
+
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from thread import get_ident
+from threading import Lock, Thread
+from time import time
+
+# Upper bounds of histogram buckets
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+throughput_buckets = tuple(4**i * 64*1024 for i in xrange(9)) # bytes per second
+
+class Histogram(object):
+  """Counts of observations no bigger than each bucket's upper bound"""
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # the last is for anything bigger
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def copy(self):
+    histogram = Histogram(self.buckets)
+    histogram.add(self)
+    return histogram
+
+  def add(self, other):
+    """Adds other's observations (which used the same buckets) to ours"""
+    for i, count in enumerate(list(other.counts)):
+      self.counts[i] += count
+    self.sum += other.sum
+    self.count += other.count
+
+  def quantile(self, q):
+    """The upper bound of the bucket holding the q'th quantile"""
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for bound, count in zip(self.buckets, self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return float('inf')
+
+class _Timer(object):
+  def __init__(self, metrics, name, labels):
+    self.metrics = metrics
+    self.name = name
+    self.labels = labels
+
+  def __enter__(self):
+    self.started = time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.metrics.observe(self.name, time() - self.started, **self.labels)
+
+class _Shard(object):
+  """The counters and histograms recorded by one thread"""
+  def __init__(self):
+    self.counters = {} # (name, labels) -> value
+    self.histograms = {} # (name, labels) -> Histogram
+
+  def add_to(self, counters, histograms):
+    for key, value in self.counters.items():
+      counters[key] = counters.get(key, 0) + value
+    for key, histogram in self.histograms.items():
+      total = histograms.get(key)
+      if total is None:
+        histograms[key] = histogram.copy()
+      else:
+        total.add(histogram)
+
+class Metrics(object):
+  """A registry of named counters, histograms and gauges
+
+  Each metric can have labels (keyword arguments) and a line of help
+  (see describe).  Gauges are functions which are called when the
+  metrics are rendered.
+
+  Shards are kept by thread ident rather than in a threading.local
+  because libfuse calls in from threads Python didn't start, which look
+  like a new thread every time.  Only the thread with a shard's ident
+  writes to it; a new thread which is given a finished thread's ident
+  carries on adding to its shard."""
+  def __init__(self):
+    self.gauges = {} # (name, labels) -> function
+    self.descriptions = {}
+    self.shards = {} # thread ident -> _Shard
+    self.lock = Lock() # for adding shards
+
+  def describe(self, name, description):
+    self.descriptions[name] = description
+
+  def _shard(self):
+    ident = get_ident()
+    shard = self.shards.get(ident)
+    if shard is None:
+      with self.lock:
+        shard = self.shards[ident] = _Shard()
+    return shard
+
+  def inc(self, name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    counters = self._shard().counters
+    counters[key] = counters.get(key, 0) + value
+
+  def observe(self, name, value, buckets=latency_buckets, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histograms = self._shard().histograms
+    histogram = histograms.get(key)
+    if histogram is None:
+      histogram = histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+  def _totals(self):
+    """Returns every thread's counters and histograms added together"""
+    with self.lock:
+      shards = self.shards.values()
+    counters, histograms = {}, {}
+    for shard in shards:
+      shard.add_to(counters, histograms)
+    return counters, histograms
+
+  def timed(self, name, **labels):
+    """A context manager which observes how long its block took"""
+    return _Timer(self, name, labels)
+
+  def gauge(self, name, func, **labels):
+    self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+  def value(self, name, **labels):
+    counters, histograms = self._totals()
+    return counters.get((name, tuple(sorted(labels.items()))), 0)
+
+  def histogram(self, name, **labels):
+    counters, histograms = self._totals()
+    return histograms.get((name, tuple(sorted(labels.items()))))
+
+  def render(self):
+    """The current values in Prometheus' text exposition format"""
+    counters, histograms = self._totals()
+    counters = sorted(counters.items())
+    histograms = [(key, histogram.counts, histogram.sum, histogram.count,
+                   histogram.buckets)
+                  for key, histogram in sorted(histograms.items())]
+    gauges = []
+    for key, func in sorted(self.gauges.items()):
+      try:
+        gauges.append((key, func()))
+      except Exception:
+        logging.exception("Couldn't work out %s" % key[0])
+    lines = []
+    described = set()
+    def header(name, kind):
+      if name not in described:
+        described.add(name)
+        if name in self.descriptions:
+          lines.append("# HELP %s %s" % (name, self.descriptions[name]))
+        lines.append("# TYPE %s %s" % (name, kind))
+    for (name, labels), value in counters:
+      header(name, 'counter')
+      lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+    for (name, labels), value in gauges:
+      header(name, 'gauge')
+      lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+    for (name, labels), counts, total, count, buckets in histograms:
+      header(name, 'histogram')
+      cumulative = 0
+      for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+        cumulative += bucket_count
+        lines.append("%s_bucket%s %s" % (name, _labels(labels + (('le', bound),)),
+                                         cumulative))
+      lines.append("%s_sum%s %s" % (name, _labels(labels), _number(total)))
+      lines.append("%s_count%s %s" % (name, _labels(labels), count))
+    return "\n".join(lines) + "\n"
+
+def _labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+  """Serves metrics.render() over HTTP for Prometheus to scrape"""
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, metrics, address=('', 0)):
+    self.metrics = metrics
+    self.thread = None
+    HTTPServer.__init__(self, address, _MetricsRequestHandler)
+
+  def start(self):
+    self.thread = Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = self.server.metrics.render()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
@@ -0,0 +1,249 @@
+"""Where the cache gets files from
+
+Lots of nodes running genbankfs tend to want the same genomes.  Rather
+than each of them downloading everything from NCBI, a cache can look in
+a directory shared between nodes (e.g. on NFS or Lustre) and then ask
+other nodes' caches (peers) before going upstream.  Each tier is tried
+in turn with its own timeout."""
+
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import urllib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import namedtuple
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+from time import time
+
+from .eviction import reserved_names
+
+class Source(namedtuple("Source", "url timeout origin")):
+  """A URL to try for a file and the origin which suggested it"""
+  pass
+
+class SharedDirectoryOrigin(object):
+  """A cache directory shared between nodes
+
+  Files are copied out of it rather than used in place so that reads
+  don't go over the network.  If write_back is set, files which had to
+  be fetched from further along the chain are copied into it for other
+  nodes to use."""
+  name = 'shared'
+
+  def __init__(self, root_dir, timeout=60, write_back=False):
+    self.root_dir = os.path.realpath(root_dir)
+    self.timeout = timeout
+    self.write_back = write_back
+
+  def locate(self, path):
+    shared_path = os.path.join(self.root_dir, path)
+    if os.path.isfile(shared_path):
+      return 'file://' + urllib.pathname2url(shared_path)
+    return None
+
+  def store(self, path, cache_path):
+    """Copies a file into the shared directory unless it's already there"""
+    shared_path = os.path.join(self.root_dir, path)
+    if os.path.isfile(shared_path):
+      return
+    shared_dir = os.path.dirname(shared_path)
+    try:
+      if not os.path.isdir(shared_dir):
+        os.makedirs(shared_dir, 0755)
+    except OSError:
+      pass # another node made it
+    try:
+      # other nodes only see the file once it's complete
+      with tempfile.NamedTemporaryFile(mode='wb', dir=shared_dir, prefix='.shared_',
+                                       suffix='.tmp', delete=False) as f:
+        with open(cache_path, 'rb') as cached_file:
+          shutil.copyfileobj(cached_file, f, 1024**2)
+      os.chmod(f.name, 0644)
+      os.rename(f.name, shared_path)
+    except (IOError, OSError) as e:
+      logging.info("Couldn't copy %s to the shared cache: %s" % (path, e))
+      return
+    logging.info("Copied %s to the shared cache" % path)
+
+class PeerOrigin(object):
+  """Another node's cache, served over HTTP by a CacheServer
+
+  Peers which can't be reached (or fail other than by answering that
+  they don't have a file) are skipped for retry_delay seconds"""
+  name = 'peer'
+
+  def __init__(self, base_url, timeout=10, retry_delay=60):
+    self.base_url = base_url.rstrip('/')
+    self.timeout = timeout
+    self.retry_delay = retry_delay
+    self.down_until = 0
+
+  def locate(self, path):
+    if time() < self.down_until:
+      return None
+    return "%s/%s" % (self.base_url, urllib.quote(path))
+
+  def failed(self, error):
+    if getattr(error, 'status', None) is None:
+      logging.info("Skipping peer %s for %ss: %s" % (self.base_url, self.retry_delay,
+                                                     error))
+      self.down_until = time() + self.retry_delay
+
+class UpstreamOrigin(object):
+  """Where files really come from; lookup_func maps paths to URLs"""
+  name = 'upstream'
+
+  def __init__(self, lookup_func, timeout=600):
+    self.lookup = lookup_func
+    self.timeout = timeout
+
+  def locate(self, path):
+    return self.lookup(path)
+
+class OriginChain(object):
+  """The origins to try for a file, in order
+
+  The last origin should be an UpstreamOrigin.  Calling the chain with a
+  path returns the file's upstream URL (raising an exception if there
+  isn't one) which identifies it wherever it's actually fetched from."""
+  def __init__(self, origins):
+    self.origins = list(origins)
+    self.upstream = self.origins[-1]
+
+  def __call__(self, path):
+    return self.upstream.locate(path)
+
+  def sources(self, path):
+    """Returns the Sources to try for path, best first"""
+    sources = []
+    for origin in self.origins:
+      url = origin.locate(path)
+      if url is not None:
+        sources.append(Source(url, origin.timeout, origin))
+    return sources
+
+  def failed(self, source, error):
+    if hasattr(source.origin, 'failed'):
+      source.origin.failed(error)
+
+  def writes_back(self, source):
+    """True if files from source are copied to an origin before it"""
+    return any(getattr(origin, 'write_back', False)
+               for origin in self._before(source))
+
+  def fetched(self, path, cache_path, source):
+    """Writes a file back to the origins before the one it came from"""
+    for origin in self._before(source):
+      if getattr(origin, 'write_back', False):
+        origin.store(path, cache_path)
+
+  def _before(self, source):
+    for origin in self.origins:
+      if origin is source.origin:
+        return
+      yield origin
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+  """Serves the files in a cache directory to peers over HTTP
+
+  Only complete files in accession directories are served; there are no
+  directory listings and nothing is downloaded on a peer's behalf."""
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, root_dir, address=('', 0)):
+    self.root_dir = os.path.realpath(root_dir)
+    self.thread = None
+    self.connections = set()
+    self.connections_lock = Lock()
+    HTTPServer.__init__(self, address, _CacheRequestHandler)
+
+  @property
+  def url(self):
+    host, port = self.server_address[:2]
+    return "http://%s:%s" % (host if host not in ('', '0.0.0.0') else '127.0.0.1', port)
+
+  def start(self):
+    self.thread = Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    """Stops serving, dropping any connections peers have kept open"""
+    self.shutdown()
+    self.server_close()
+    with self.connections_lock:
+      connections = list(self.connections)
+    for connection in connections:
+      try:
+        connection.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+  def process_request(self, request, client_address):
+    with self.connections_lock:
+      self.connections.add(request)
+    ThreadingMixIn.process_request(self, request, client_address)
+
+  def shutdown_request(self, request):
+    with self.connections_lock:
+      self.connections.discard(request)
+    HTTPServer.shutdown_request(self, request)
+
+  def handle_error(self, request, client_address):
+    logging.debug("Problem serving %s" % (client_address,), exc_info=True)
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def cached_path(self, url_path):
+    """Returns the file a request is for or None if we shouldn't serve it"""
+    path = urllib.unquote(url_path.split('?')[0]).lstrip('/')
+    parts = path.split('/')
+    if len(parts) != 2 or parts[0] in reserved_names or '..' in parts or '' in parts:
+      return None
+    cache_path = os.path.join(self.root_dir, *parts)
+    if not os.path.isfile(cache_path):
+      return None
+    return cache_path
+
+class _CacheRequestHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  timeout = 300 # for idle connections
+
+  def do_HEAD(self):
+    self._send(body=False)
+
+  def do_GET(self):
+    self._send(body=True)
+
+  def _send(self, body):
+    cache_path = self.server.cached_path(self.path)
+    try:
+      f = open(cache_path, 'rb') if cache_path else None
+    except IOError:
+      f = None
+    if f is None:
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    with f:
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+      self.end_headers()
+      if body:
+        shutil.copyfileobj(f, self.wfile, 1024**2)
+
+  def log_message(self, format, *args):
+    logging.debug("Peer request from %s: %s" % (self.client_address[0], format % args))
@@ -0,0 +1,180 @@
+"""Decides which queued network job runs next
+
+Someone running head on a small file shouldn't wait behind hundreds of
+large prefetches, and one process listing thousands of directories
+shouldn't starve another process which wants one file.  Jobs are
+downloads (or any other callable, e.g. size lookups) in one of three
+classes which are always served in order: things which are being read
+right now, prefetches and background work."""
+
+import itertools
+
+from collections import Counter, deque
+from Queue import Full
+from threading import Condition
+from time import time
+
+# Classes of job, most important first
+foreground_priority = 0
+prefetch_priority = 1
+background_priority = 2
+
+class ScheduledJob(object):
+  """A job in the scheduler
+
+  host is the server it will use and size is the number of bytes it's
+  expected to transfer (if known)."""
+  def __init__(self, job, priority, host, pid, size, sequence):
+    self.job = job
+    self.priority = priority
+    self.host = host
+    self.pid = pid
+    self.size = size
+    self.sequence = sequence
+    self.queued_at = time()
+
+class DownloadScheduler(object):
+  """A queue of jobs for a pool of download threads
+
+  Jobs are taken from the most important class which has a job that can
+  run.  Within a class the processes which asked for jobs take turns,
+  and each process's smallest job goes first (jobs of unknown size go
+  after those of known size, in the order they were queued) unless one
+  has been waiting for more than max_wait seconds.  No more than
+  per_host jobs run against each host at once.
+
+  max_queued maps each class to the number of jobs it can hold; when
+  a class is full put raises Queue.Full."""
+  def __init__(self, max_queued, per_host=2, max_wait=60):
+    self.max_queued = dict(max_queued)
+    self.per_host = per_host
+    self.max_wait = max_wait
+    self.condition = Condition()
+    self.queues = dict((priority, {}) for priority in self.max_queued) # pid -> jobs
+    self.turns = dict((priority, deque()) for priority in self.max_queued)
+    self.counts = Counter()
+    self.entries = {} # id(job) -> ScheduledJob
+    self.running = Counter() # host -> running jobs
+    self.sequence = itertools.count()
+    self.closed = False
+
+  def qsize(self, priority=None):
+    """The number of jobs waiting to run (in a class or in total)"""
+    if priority is None:
+      return sum(self.counts.values())
+    return self.counts[priority]
+
+  def full(self, priority):
+    return self.counts[priority] >= self.max_queued[priority]
+
+  def put(self, job, priority, host=None, pid=None, size=None, block=False):
+    """Queues job; waits for space in its class if block is set"""
+    with self.condition:
+      while self.full(priority) or self.closed:
+        if not block or self.closed:
+          raise Full
+        self.condition.wait()
+      entry = ScheduledJob(job, priority, host, pid, size, next(self.sequence))
+      self._add(entry)
+      self.condition.notify_all()
+      return entry
+
+  def promote(self, job, priority, pid=None):
+    """Moves a queued job up to a more important class
+
+    Returns False if the job isn't waiting to run"""
+    with self.condition:
+      entry = self.entries.get(id(job))
+      if entry is None or entry.job is not job:
+        return False
+      if entry.priority > priority:
+        self._remove(entry)
+        entry.priority = priority
+        entry.pid = pid
+        self._add(entry)
+        self.condition.notify_all()
+      return True
+
+  def discard(self, job):
+    """Removes a job which hasn't started; returns False if it isn't queued"""
+    with self.condition:
+      entry = self.entries.get(id(job))
+      if entry is None or entry.job is not job:
+        return False
+      self._remove(entry)
+      self.condition.notify_all()
+      return True
+
+  def close(self):
+    """Stops taking jobs; returns the ScheduledJobs which were still queued
+
+    Anyone waiting in get is given None and put raises Queue.Full."""
+    with self.condition:
+      self.closed = True
+      entries = self.entries.values()
+      for entry in entries:
+        self._remove(entry)
+      self.condition.notify_all()
+      return entries
+
+  def get(self):
+    """Waits for a job which can run, marks it as running and returns it
+
+    Returns None once the scheduler has been closed"""
+    with self.condition:
+      while True:
+        if self.closed:
+          return None
+        entry = self._next()
+        if entry is not None:
+          self._remove(entry)
+          self.running[entry.host] += 1
+          self.condition.notify_all()
+          return entry
+        self.condition.wait()
+
+  def done(self, entry):
+    """Called when a job returned by get has finished"""
+    with self.condition:
+      self.running[entry.host] -= 1
+      self.condition.notify_all()
+
+  def _can_run(self, entry):
+    return entry.host is None or self.running[entry.host] < self.per_host
+
+  def _next(self):
+    now = time()
+    def rank(entry):
+      if now - entry.queued_at > self.max_wait:
+        return (0, 0, entry.sequence)
+      if entry.size is None:
+        return (2, 0, entry.sequence)
+      return (1, entry.size, entry.sequence)
+    for priority in sorted(self.queues):
+      turns = self.turns[priority]
+      for pid in list(turns):
+        runnable = [entry for entry in self.queues[priority][pid]
+                    if self._can_run(entry)]
+        if runnable:
+          turns.remove(pid)
+          turns.append(pid)
+          return min(runnable, key=rank)
+    return None
+
+  def _add(self, entry):
+    jobs = self.queues[entry.priority].get(entry.pid)
+    if jobs is None:
+      jobs = self.queues[entry.priority][entry.pid] = []
+      self.turns[entry.priority].append(entry.pid)
+    jobs.append(entry)
+    self.counts[entry.priority] += 1
+    self.entries[id(entry.job)] = entry
+
+  def _remove(self, entry):
+    jobs = self.queues[entry.priority][entry.pid]
+    jobs.remove(entry)
+    if not jobs:
+      del self.queues[entry.priority][entry.pid]
+      self.turns[entry.priority].remove(entry.pid)
+    self.counts[entry.priority] -= 1
+    del self.entries[id(entry.job)]
@@ -1,65 +1,151 @@
-import numexpr
+import logging
+import os
 
+import numpy as np
 import pandas as pd
 
 from boltons.strutils import slugify
 
+from . import snapshot
+from .index import FolderIndex, PrefixTable, intersect
+
 class GenbankSearch(object):
-  def __init__(self, input_file):
-    self.database = pd.read_csv(input_file, delimiter='\t')
-    self.folders = ['species_taxid',
-                    'taxid',
-                    'organism_name',
-                    'genus',
-                    'species',
-                    'accession']
+  """Searches an NCBI style assembly summary by slugs of its folders
+
+  Only the columns which folders are made from are read.  Each folder's
+  slugs are kept as integer codes into a sorted table of its distinct
+  values and accession URLs as codes into a table of their directories
+  (see PrefixTable), so nothing holds a Python object per row.
+
+  If snapshot_root is given, the compiled indexes are saved there and
+  memory mapped next time the same summary is loaded."""
+  folders = ['species_taxid',
+             'taxid',
+             'organism_name',
+             'genus',
+             'species',
+             'accession']
+  source_columns = ['species_taxid', 'taxid', 'organism_name', 'ftp_path']
+
+  def __init__(self, input_file, snapshot_root=None):
+    if snapshot_root is None:
+      self._build(input_file)
+      return
+    digest = snapshot.source_digest(input_file, snapshot_root)
+    snapshot_dir = os.path.join(snapshot_root, digest)
+    loaded = snapshot.load_snapshot(snapshot_dir, self.folders)
+    if loaded:
+      logging.info("Loaded metadata snapshot from %s" % snapshot_dir)
+      self.indexes, self.urls = loaded
+    else:
+      self._build(input_file)
+      snapshot.save_snapshot(snapshot_dir, self.indexes, self.urls)
+
+  def _build(self, input_file):
+    database = pd.read_csv(input_file, delimiter='\t', usecols=self.source_columns)
+    self._add_slug_columns(database)
+    self.indexes = {folder: FolderIndex.from_column(database[folder+'_slug'])
+                    for folder in self.folders}
+    # The url of each accession (in accession code order).  If there are
+    # duplicate accessions, the last one wins
+    accession_index = self.indexes['accession']
+    last_rows = accession_index.rows[accession_index.offsets[1:] - 1]
+    self.urls = PrefixTable.from_strings(database['ftp_path'].values[last_rows],
+                                         accession_index.values)
+
+  def _add_slug_columns(self, database):
     column_map = zip(['species_taxid',
                        'taxid',
                        'organism_name'],
                        self.folders)
     for original_column, slug_column in column_map:
-      self.database[slug_column+'_slug'] = map(self._slug,
-                                               self.database[original_column])
-    self.database['genus_slug'] = map(self._get_genus,
-                                        self.database['organism_name'])
-    self.database['species_slug'] = map(self._get_species,
-                                        self.database['organism_name'])
-    self.database['accession_slug'] = map(self._get_accession,
-                                          self.database['ftp_path'])
+      database[slug_column+'_slug'] = self._map_distinct(self._slug,
+                                                         database[original_column])
+    genus_names = self._map_distinct(self._genus_name,
+                                     database['organism_name'])
+    species_names = self._map_distinct(self._species_name,
+                                       database['organism_name'])
+    database['genus_slug'] = self._map_distinct(self._slug, genus_names)
+    database['species_slug'] = self._map_distinct(self._slug, species_names)
+    database['accession_slug'] = self._map_distinct(self._get_accession,
+                                                    database['ftp_path'])
+
+  @property
+  def row_count(self):
+    return len(self.indexes['accession'].codes)
 
   def query(self, **terms):
-    relevant_terms = {key+'_slug': self._slug(value)
-                        for key,value in terms.items()
-                        if key in self.folders}
-    query_str = " & ".join(["{} == '{}'".format(key, value) for key,value in
-                       relevant_terms.items()])
-    if not query_str:
-      return self.database
-    return self.database.query(query_str)
+    """Returns the slugs and ftp_path of each row which matches terms"""
+    rows = self._matching_rows(**terms)
+    if rows is None:
+      rows = np.arange(self.row_count)
+    columns = [folder+'_slug' for folder in self.folders] + ['ftp_path']
+    data = {folder+'_slug': self.indexes[folder].take(rows)
+            for folder in self.folders}
+    data['ftp_path'] = self.urls.take(self.indexes['accession'].codes[rows])
+    return pd.DataFrame(data, index=rows, columns=columns)
 
   def list(self, folder, **terms):
     if not folder in self.folders:
       raise ValueError("{} not in folders".format(folder))
-    return list(set(self.query(**terms)[folder+'_slug']))
+    return self.indexes[folder].distinct(self._matching_rows(**terms))
+
+  def listing(self, folder, **terms):
+    """Like list but returns a Listing, which can be paged through"""
+    if not folder in self.folders:
+      raise ValueError("{} not in folders".format(folder))
+    return self.indexes[folder].listing(self._matching_rows(**terms))
+
+  def exists(self, **terms):
+    """True if any row matches every term"""
+    rows = self._matching_rows(**terms)
+    return rows is None or len(rows) > 0
+
+  def _matching_rows(self, **terms):
+    """Returns the ids of rows matching every term (or None if no terms)"""
+    # accessions are listed as they are rather than as slugs
+    row_sets = [self.indexes[key].lookup(value if key == 'accession' else self._slug(value))
+                for key,value in terms.items()
+                if key in self.folders]
+    if not row_sets:
+      return None
+    return intersect(row_sets)
+
+  def _map_distinct(self, func, column):
+    """Applies func to column, calling it once per distinct value"""
+    codes, distinct_values = pd.factorize(column)
+    results = [func(value) for value in distinct_values]
+    if (codes < 0).any():
+      results.append(func(np.nan)) # missing values have a code of -1
+    return np.array(results, dtype=object)[codes]
 
   def _slug(self, value):
     return slugify(str(value), lower=True)
 
-  def _get_genus(self, species_name):
+  def _genus_name(self, species_name):
     genus, species = species_name.split(" ", 2)[:2]
-    return self._slug(genus)
+    return genus
 
-  def _get_species(self, species_name):
+  def _species_name(self, species_name):
     genus, species = species_name.split(" ", 2)[:2]
-    return self._slug("%s_%s" % (genus, species))
+    return "%s_%s" % (genus, species)
+
+  def _get_genus(self, species_name):
+    return self._slug(self._genus_name(species_name))
+
+  def _get_species(self, species_name):
+    return self._slug(self._species_name(species_name))
 
   def _get_accession(self, ftp_path):
     return ftp_path.split('/')[-1]
 
   def build_url_lookup(self):
-    accession_data = self.database[['accession_slug', 'ftp_path']]
-    accession_map = dict(accession_data.values)
+    accession_index = self.indexes['accession']
+    urls = self.urls
     def url_lookup(path):
       accession, filename = path.split('/')
-      return "/".join([accession_map[accession], filename])
+      code = accession_index.code(accession)
+      if code is None:
+        raise KeyError(accession)
+      return "/".join([urls[code], filename])
     return url_lookup
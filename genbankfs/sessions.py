@@ -0,0 +1,319 @@
+"""Persistent FTP and HTTP sessions
+
+Logging in to an FTP server (or setting up a TCP connection to a web
+server) costs several round trips which is often more than it takes to
+transfer a small file.  Each thread keeps a pool of sessions, one per
+server, which are reused for every file fetched from that server and
+reconnected if they've gone stale.  Failures are raised as
+SessionErrors (which are IOErrors)."""
+
+import ftplib
+import httplib
+import mimetools
+import posixpath
+import socket
+import urllib
+
+from StringIO import StringIO
+from thread import get_ident
+from threading import Lock
+from time import time
+from urlparse import urljoin, urlparse
+
+class SessionError(IOError):
+  status = None # set if the server answered with an unsuccessful status
+
+_network_errors = (httplib.HTTPException, socket.error, EOFError)
+
+class HTTPTransfer(object):
+  """A response from an HTTPSession which looks a bit like urllib's"""
+  def __init__(self, session, response):
+    self.session = session
+    self.response = response
+    self.status = response.status
+
+  def info(self):
+    return self.response.msg
+
+  def getheader(self, name, default=None):
+    return self.response.getheader(name, default)
+
+  def read(self, size=-1):
+    try:
+      if size < 0:
+        return self.response.read()
+      return self.response.read(size)
+    except _network_errors as e:
+      # e.g. IncompleteRead if a chunked response was cut off
+      self.session.close()
+      raise SessionError("HTTP transfer failed: %s" % e)
+
+  def close(self):
+    self.response.close()
+
+class HTTPSession(object):
+  """A kept alive connection to a web server
+
+  Requests which fail because the server has hung up on us are retried
+  once on a new connection.  Responses must be read to the end before
+  the next request is made."""
+  def __init__(self, scheme, netloc, timeout=600):
+    self.connection_class = (httplib.HTTPSConnection if scheme == 'https'
+                             else httplib.HTTPConnection)
+    self.netloc = netloc
+    self.timeout = timeout
+    self.connection = None
+    self.connections = 0
+    self.last_used = time()
+
+  def request(self, method, path, headers=None):
+    for attempt in xrange(2):
+      try:
+        if self.connection is None:
+          self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+          self.connections += 1
+        self.connection.request(method, path, headers=headers or {})
+        response = self.connection.getresponse()
+        self.last_used = time()
+        return HTTPTransfer(self, response)
+      except _network_errors as e:
+        self.close()
+        if attempt:
+          raise SessionError("Could not request %s from %s: %s" % (path, self.netloc, e))
+
+  def set_timeout(self, timeout):
+    self.timeout = timeout
+    if self.connection is not None and self.connection.sock is not None:
+      self.connection.sock.settimeout(timeout)
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+class FTPTransfer(object):
+  """A file being retrieved by an FTPSession
+
+  size is the size of the whole file (if the server told us)"""
+  def __init__(self, session, connection, size, rest):
+    self.session = session
+    self.connection = connection
+    self.size = size
+    self.finished = False
+    self.headers = "" if size is None else "Content-Length: %d\n" % (size - rest)
+
+  def info(self):
+    return mimetools.Message(StringIO(self.headers))
+
+  def read(self, size=-1):
+    if size < 0:
+      return "".join(iter(lambda: self.read(64*1024), ""))
+    try:
+      data = self.connection.recv(size)
+    except socket.error as e:
+      self.session.close()
+      raise SessionError("FTP transfer failed: %s" % e)
+    if not data:
+      self.finished = True
+    return data
+
+  def close(self):
+    if self.connection is None:
+      return
+    self.connection.close()
+    self.connection = None
+    if not self.finished:
+      # The server's replies to an aborted transfer vary so it isn't
+      # safe to carry on using the control connection
+      self.session.close()
+      return
+    try:
+      self.session.ftp.voidresp()
+    except ftplib.all_errors:
+      self.session.close()
+
+class FTPSession(object):
+  """A logged in connection to an FTP server
+
+  The session remembers its working directory so that files in the
+  same directory don't need a CWD each.  Commands which fail because the
+  server has hung up on us are retried once on a new connection."""
+  def __init__(self, host, port, user, password, timeout=600):
+    self.host = host
+    self.port = port
+    self.user = user
+    self.password = password
+    self.timeout = timeout
+    self.ftp = None
+    self.directory = None
+    self.connections = 0
+    self.last_used = time()
+
+  def _connect(self):
+    self.ftp = ftplib.FTP(timeout=self.timeout)
+    self.connections += 1
+    try:
+      self.ftp.connect(self.host, self.port)
+      self.ftp.login(self.user, self.password)
+      self.ftp.voidcmd('TYPE I')
+    except:
+      self.close()
+      raise
+
+  def _run(self, action, path):
+    """Calls action(ftp, filename) in path's directory, reconnecting if needed"""
+    directory, filename = posixpath.split(path)
+    for attempt in xrange(2):
+      try:
+        if self.ftp is None:
+          self._connect()
+        if directory != self.directory:
+          self.ftp.cwd(directory or '/')
+          self.directory = directory
+        result = action(self.ftp, filename)
+        self.last_used = time()
+        return result
+      except ftplib.error_perm as e:
+        raise SessionError("Could not fetch %s: %s" % (path, e))
+      except ftplib.all_errors as e:
+        self.close()
+        if attempt:
+          raise SessionError("Could not fetch %s: %s" % (path, e))
+
+  def retrieve(self, path, rest=0):
+    """Starts retrieving path (from byte rest); returns an FTPTransfer"""
+    def start(ftp, filename):
+      try:
+        size = ftp.size(filename)
+      except ftplib.error_perm:
+        size = None
+      connection = ftp.transfercmd('RETR ' + filename, rest=rest or None)
+      return FTPTransfer(self, connection, size, rest)
+    return self._run(start, path)
+
+  def listing(self, path):
+    """Returns the LIST output for a directory"""
+    def list_directory(ftp, filename):
+      lines = []
+      ftp.retrlines('LIST', lines.append)
+      return "\n".join(lines)
+    return self._run(list_directory, posixpath.join(path, ''))
+
+  def set_timeout(self, timeout):
+    self.timeout = timeout
+    if self.ftp is not None:
+      self.ftp.timeout = timeout # used for data connections
+      self.ftp.sock.settimeout(timeout)
+
+  def close(self):
+    if self.ftp is not None:
+      try:
+        self.ftp.close()
+      except ftplib.all_errors:
+        pass
+    self.ftp = None
+    self.directory = None
+
+class SessionPool(object):
+  """One session per server for one thread
+
+  Sessions which haven't been used for idle_timeout seconds are
+  reconnected rather than risking a server which has hung up on us"""
+  def __init__(self, timeout=600, idle_timeout=60, max_redirects=5):
+    self.timeout = timeout
+    self.idle_timeout = idle_timeout
+    self.max_redirects = max_redirects
+    self.sessions = {}
+    self.last_used = time()
+
+  @staticmethod
+  def supports(url):
+    scheme = urlparse(url).scheme
+    return scheme in ('ftp', 'http', 'https') and scheme not in urllib.getproxies()
+
+  def session(self, url, timeout=None):
+    self.last_used = time()
+    parsed = urlparse(url)
+    if parsed.scheme == 'ftp':
+      key = ('ftp', parsed.hostname, parsed.port or ftplib.FTP_PORT,
+             parsed.username or 'anonymous', parsed.password or '')
+    else:
+      key = (parsed.scheme, parsed.netloc)
+    session = self.sessions.get(key)
+    if session is None:
+      if parsed.scheme == 'ftp':
+        session = FTPSession(*key[1:], timeout=self.timeout)
+      else:
+        session = HTTPSession(parsed.scheme, parsed.netloc, timeout=self.timeout)
+      self.sessions[key] = session
+    elif time() - session.last_used > self.idle_timeout:
+      session.close()
+    if timeout is not None:
+      session.set_timeout(timeout)
+    return session
+
+  def open(self, url, headers=None, rest=0, timeout=None):
+    """Opens url for reading, optionally from byte rest (FTP) or with headers (HTTP)
+
+    HTTP redirects are followed; other unsuccessful responses raise a
+    SessionError."""
+    for redirect in xrange(self.max_redirects + 1):
+      parsed = urlparse(url)
+      session = self.session(url, timeout)
+      path = urllib.unquote(parsed.path)
+      if parsed.scheme == 'ftp':
+        return session.retrieve(path, rest)
+      request_path = parsed.path + ('?' + parsed.query if parsed.query else '')
+      response = session.request('GET', request_path or '/', headers)
+      if response.status in (200, 206):
+        return response
+      response.read()
+      location = response.getheader('location')
+      if response.status in (301, 302, 303, 307) and location:
+        url = urljoin(url, location)
+        continue
+      error = SessionError("Could not fetch %s: HTTP %s" % (url, response.status))
+      error.status = response.status
+      raise error
+    raise SessionError("Too many redirects fetching %s" % url)
+
+  def listing(self, url, timeout=None):
+    """Returns the LIST output of an FTP directory"""
+    return self.session(url, timeout).listing(urllib.unquote(urlparse(url).path))
+
+  def head(self, url, timeout=None):
+    """Returns the headers of an HTTP url (or None if it isn't there)"""
+    parsed = urlparse(url)
+    response = self.session(url, timeout).request('HEAD', parsed.path or '/')
+    response.read()
+    if response.status != 200:
+      return None
+    return response.info()
+
+  def close(self):
+    for session in self.sessions.values():
+      session.close()
+    self.sessions = {}
+
+_pools = {} # thread ident -> SessionPool
+_pools_lock = Lock()
+
+def thread_sessions():
+  """Returns the calling thread's SessionPool
+
+  Pools are kept by thread ident rather than in a threading.local
+  because libfuse calls in from threads Python didn't start, which look
+  like a new thread every time.  Pools which haven't been used for
+  their idle_timeout (so whose sessions would be reconnected anyway)
+  are dropped when a new one is made; their connections are closed
+  once nothing is reading from them."""
+  ident = get_ident()
+  pool = _pools.get(ident)
+  if pool is None:
+    with _pools_lock:
+      now = time()
+      for other, idle_pool in _pools.items():
+        if now - idle_pool.last_used > idle_pool.idle_timeout:
+          del _pools[other]
+      pool = _pools[ident] = SessionPool()
+  return pool
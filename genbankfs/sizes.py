@@ -0,0 +1,178 @@
+"""Finds the sizes of files before they are downloaded
+
+Shells and other tools want to know how big a file is long before they
+read it.  The sizes of files which aren't in the cache are looked up in
+the background and saved in the cache root so that getattr can return
+them without going anywhere near the network."""
+
+import logging
+
+from collections import defaultdict
+from functools import partial
+from Queue import Queue, Full, Empty
+from threading import Lock, Thread
+from time import time
+from urlparse import urlparse
+
+from .scheduler import background_priority
+from .sessions import thread_sessions
+
+class SizeIndex(object):
+  """Sizes of files (by path relative to the cache root)
+
+  The index is kept in memory and appended to a tab separated file so
+  that it survives restarts; later lines override earlier ones"""
+  def __init__(self, index_path):
+    self.index_path = index_path
+    self.sizes = {}
+    self.lock = Lock()
+    try:
+      with open(index_path) as f:
+        for line in f:
+          try:
+            path, size = line.rstrip('\n').split('\t')
+            self.sizes[path] = int(size)
+          except ValueError:
+            pass # probably a partially written line
+    except IOError:
+      pass
+
+  def get(self, path):
+    return self.sizes.get(path)
+
+  def update(self, sizes):
+    new_sizes = dict((path, size) for path, size in sizes.items()
+                     if self.sizes.get(path) != size)
+    if not new_sizes:
+      return
+    with self.lock:
+      self.sizes.update(new_sizes)
+      with open(self.index_path, 'a') as f:
+        f.writelines("%s\t%s\n" % item for item in new_sizes.items())
+
+def parse_ftp_listing(listing):
+  """Returns {filename: size} for the regular files in a LIST response"""
+  sizes = {}
+  for line in listing.splitlines():
+    parts = line.split(None, 8)
+    if len(parts) == 9 and parts[0].startswith('-'):
+      try:
+        sizes[parts[8]] = int(parts[4])
+      except ValueError:
+        pass
+  return sizes
+
+class SizeDiscovery(object):
+  """Looks up the sizes of files in the background
+
+  Requests are batched by accession.  For FTP origins a single directory
+  listing gives the size of every file in an accession; for HTTP origins
+  each requested file gets a HEAD request.  Both reuse the discovery
+  thread's sessions.
+  Lookups which fail aren't retried for retry_delay seconds.
+
+  If a scheduler is given, batches are run by its download threads as
+  background jobs rather than by our own thread.  stop waits for the
+  lookups which are running to finish and drops the rest."""
+  def __init__(self, size_index, lookup_func, batch_size=50, threads=1,
+               max_pending=10000, timeout=60, retry_delay=300, scheduler=None):
+    self.sizes = size_index
+    self.scheduler = scheduler
+    self.lookup = lookup_func
+    self.batch_size = batch_size
+    self.timeout = timeout
+    self.retry_delay = retry_delay
+    self.queue = Queue(maxsize=max_pending)
+    self.pending = set()
+    self.failed = {}
+    self.lock = Lock()
+    self.stopped = False
+    self.threads = [Thread(target=self._discover_queued) for i in xrange(threads)]
+    for thread in self.threads:
+      thread.daemon = True
+      thread.start()
+
+  def stop(self):
+    with self.lock:
+      self.stopped = True
+    for thread in self.threads:
+      self.queue.put(None) # wakes the threads up
+    for thread in self.threads:
+      thread.join()
+
+  def request(self, path):
+    """Asks for the size of path to be found (without waiting for it)"""
+    with self.lock:
+      if self.stopped or path in self.pending or self.failed.get(path, 0) > time():
+        return
+      try:
+        self.queue.put_nowait(path)
+      except Full:
+        return
+      self.pending.add(path)
+
+  def _discover_queued(self):
+    while True:
+      batch = [self.queue.get()]
+      try:
+        while len(batch) < self.batch_size:
+          batch.append(self.queue.get_nowait())
+      except Empty:
+        pass
+      if self.stopped:
+        return
+      by_accession = defaultdict(list)
+      for path in batch:
+        accession, _, filename = path.partition('/')
+        by_accession[accession].append(filename)
+      for accession, filenames in by_accession.items():
+        if self.scheduler is None:
+          self._discover(accession, filenames)
+          continue
+        try:
+          self.scheduler.put(partial(self._discover, accession, filenames),
+                             background_priority, host=self._host(accession))
+        except Full:
+          with self.lock:
+            self.pending.difference_update("%s/%s" % (accession, filename)
+                                           for filename in filenames)
+
+  def _discover(self, accession, filenames):
+    try:
+      self.sizes.update(self.fetch_sizes(accession, filenames))
+    except Exception:
+      logging.info("Couldn't find the sizes of files in %s" % accession)
+    paths = ["%s/%s" % (accession, filename) for filename in filenames]
+    with self.lock:
+      for path in paths:
+        self.pending.discard(path)
+        if self.sizes.get(path) is None:
+          self.failed[path] = time() + self.retry_delay
+
+  def _host(self, accession):
+    try:
+      return urlparse(self.lookup("%s/" % accession)).netloc
+    except Exception:
+      return None
+
+  def fetch_sizes(self, accession, filenames):
+    """Returns {path: size} for (at least) filenames in accession"""
+    directory_url = self.lookup("%s/" % accession)
+    if urlparse(directory_url).scheme == 'ftp':
+      sizes = self._ftp_sizes(directory_url)
+    else:
+      sizes = self._http_sizes(directory_url, filenames)
+    return dict(("%s/%s" % (accession, filename), size)
+                for filename, size in sizes.items())
+
+  def _ftp_sizes(self, directory_url):
+    return parse_ftp_listing(thread_sessions().listing(directory_url,
+                                                       timeout=self.timeout))
+
+  def _http_sizes(self, directory_url, filenames):
+    sizes = {}
+    for filename in filenames:
+      headers = thread_sessions().head(directory_url + filename, timeout=self.timeout)
+      if headers is not None and headers.getheader('content-length') is not None:
+        sizes[filename] = int(headers.getheader('content-length'))
+    return sizes
@@ -0,0 +1,123 @@
+"""Saves the compiled metadata from GenbankSearch for fast remounts
+
+Snapshots are directories of .npy files named after the hash of the
+assembly summary they were built from.  They are memory mapped when
+they are loaded so there's nothing to parse and the pages are shared
+by every process which mounts the same metadata."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .index import FolderIndex, PrefixTable, StringTable
+
+snapshot_version = 2
+
+def source_digest(input_file, snapshot_root):
+  """Returns the sha1 of input_file and rewinds it
+
+  Hashes of files on disk are remembered against their path, size and
+  modification time so that we don't have to read them again"""
+  stat_key = None
+  sources_path = os.path.join(snapshot_root, 'sources.json')
+  name = getattr(input_file, 'name', None)
+  if name and os.path.isfile(name):
+    st = os.stat(name)
+    stat_key = "%s:%s:%s" % (os.path.realpath(name), st.st_size, st.st_mtime)
+    digest = _read_json(sources_path, {}).get(stat_key)
+    if digest:
+      return digest
+  sha1 = hashlib.sha1()
+  for block in iter(lambda: input_file.read(1024**2), ''):
+    sha1.update(block)
+  input_file.seek(0)
+  digest = sha1.hexdigest()
+  if stat_key:
+    sources = _read_json(sources_path, {})
+    sources[stat_key] = digest
+    _write_json_atomically(sources_path, sources)
+  return digest
+
+def save_snapshot(snapshot_dir, indexes, urls):
+  """Saves folder indexes and accession urls (a PrefixTable) to snapshot_dir
+
+  The snapshot is written to a temporary directory which is then
+  renamed so other processes never see a partial snapshot"""
+  parent_dir = os.path.dirname(snapshot_dir)
+  if not os.path.isdir(parent_dir):
+    os.makedirs(parent_dir, 0755)
+  temp_dir = tempfile.mkdtemp(prefix=os.path.basename(snapshot_dir) + '_',
+                              suffix='.tmp', dir=parent_dir)
+  try:
+    for folder, index in indexes.items():
+      _save_strings(temp_dir, folder + '.values', index.values)
+      for name in ['codes', 'rows', 'offsets']:
+        np.save(os.path.join(temp_dir, "%s.%s.npy" % (folder, name)),
+                getattr(index, name))
+    _save_strings(temp_dir, 'url_prefixes', urls.prefixes)
+    np.save(os.path.join(temp_dir, 'url_prefixes.codes.npy'), urls.codes)
+    manifest = dict(version=snapshot_version, folders=sorted(indexes.keys()))
+    with open(os.path.join(temp_dir, 'manifest.json'), 'w') as f:
+      json.dump(manifest, f)
+    os.rename(temp_dir, snapshot_dir)
+  except OSError:
+    # Probably another process saved the same snapshot first
+    logging.info("Could not save metadata snapshot to %s" % snapshot_dir)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+def load_snapshot(snapshot_dir, folders):
+  """Memory maps a snapshot; returns (indexes, urls) or None if unusable"""
+  manifest = _read_json(os.path.join(snapshot_dir, 'manifest.json'), None)
+  if manifest is None or manifest.get('version') != snapshot_version:
+    return None
+  if not set(folders).issubset(manifest['folders']):
+    return None
+  try:
+    indexes = {}
+    for folder in folders:
+      values = _load_strings(snapshot_dir, folder + '.values')
+      arrays = [_load(os.path.join(snapshot_dir, "%s.%s.npy" % (folder, name)))
+                for name in ['codes', 'rows', 'offsets']]
+      indexes[folder] = FolderIndex(values, *arrays)
+    urls = PrefixTable(_load_strings(snapshot_dir, 'url_prefixes'),
+                       _load(os.path.join(snapshot_dir, 'url_prefixes.codes.npy')),
+                       indexes['accession'].values)
+  except (IOError, ValueError):
+    logging.info("Could not load metadata snapshot from %s" % snapshot_dir)
+    return None
+  return indexes, urls
+
+def _save_strings(directory, name, table):
+  np.save(os.path.join(directory, name + '.blob.npy'), table.blob)
+  np.save(os.path.join(directory, name + '.offsets.npy'), table.offsets)
+
+def _load_strings(directory, name):
+  return StringTable(_load(os.path.join(directory, name + '.blob.npy')),
+                     _load(os.path.join(directory, name + '.offsets.npy')))
+
+def _load(path):
+  try:
+    return np.load(path, mmap_mode='r')
+  except ValueError:
+    return np.load(path) # empty arrays can't be memory mapped
+
+def _read_json(path, default):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return default
+
+def _write_json_atomically(path, data):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory, 0755)
+  with tempfile.NamedTemporaryFile(mode='w', dir=directory, suffix='.tmp',
+                                   delete=False) as f:
+    json.dump(data, f)
+  os.rename(f.name, path)
@@ -0,0 +1,173 @@
+"""Caches the parts of files which have actually been read
+
+Rather than downloading a whole file before it can be read, a sparse
+file is filled in block by block with ranged requests (HTTP Range or
+FTP REST) as reads ask for them.  A bitmap of the blocks which have
+arrived is kept next to it so that partial files survive restarts."""
+
+import logging
+import os
+import urllib
+
+from threading import Condition, Lock
+
+from .sessions import SessionError, SessionPool, thread_sessions
+
+class RangeError(IOError):
+  pass
+
+def fetch_range(url, start, end, timeout=600):
+  """Fetches bytes start to end (exclusive) of url
+
+  Returns (offset, data, total_size).  offset is normally start but
+  servers which don't support ranges send the whole file from 0.
+  total_size is None if the server didn't say how big the file is.
+  Requests reuse the calling thread's sessions."""
+  if not SessionPool.supports(url):
+    return _urllib_range(url)
+  try:
+    if url.startswith('ftp:'):
+      return _ftp_range(url, start, end, timeout)
+    return _http_range(url, start, end, timeout)
+  except SessionError as e:
+    raise RangeError(str(e))
+
+def _http_range(url, start, end, timeout):
+  response = thread_sessions().open(url, headers={'Range': 'bytes=%s-%s' % (start, end - 1)},
+                                    timeout=timeout)
+  content_range = response.getheader('Content-Range')
+  data = response.read()
+  if response.status == 206 and content_range:
+    total_size = content_range.rsplit('/', 1)[1].strip()
+    return start, data, int(total_size) if total_size.isdigit() else None # e.g. '*'
+  return 0, data, len(data)
+
+def _ftp_range(url, start, end, timeout):
+  transfer = thread_sessions().open(url, rest=start, timeout=timeout)
+  try:
+    if transfer.size is not None:
+      end = min(end, transfer.size)
+    chunks = []
+    received = 0
+    while received < end - start:
+      chunk = transfer.read(min(64*1024, end - start - received))
+      if not chunk:
+        break
+      chunks.append(chunk)
+      received += len(chunk)
+    if transfer.size is not None and end == transfer.size:
+      transfer.read(1) # see the end of the file so the session can be reused
+  finally:
+    transfer.close()
+  return start, "".join(chunks), transfer.size
+
+def _urllib_range(url):
+  try:
+    response = urllib.urlopen(url)
+  except IOError as e:
+    raise RangeError("Could not fetch %s: %s" % (url, e))
+  try:
+    data = response.read()
+  finally:
+    response.close()
+  return 0, data, len(data)
+
+class SparseFile(object):
+  """A file which is filled in one block at a time
+
+  The data lives at data_path (at the right offsets) and which blocks
+  are present is recorded in a bitmap at data_path + '.blocks'.  users
+  counts the file handles which are reading it."""
+  def __init__(self, data_path, size, block_size):
+    self.users = 0
+    self.data_path = data_path
+    self.bitmap_path = data_path + '.blocks'
+    self.size = size
+    self.block_size = block_size
+    self.block_count = (size + block_size - 1) // block_size
+    self.bitmap = bytearray((self.block_count + 7) // 8)
+    try:
+      with open(self.bitmap_path, 'rb') as f:
+        bitmap = bytearray(f.read())
+      if len(bitmap) == len(self.bitmap):
+        self.bitmap = bitmap
+    except IOError:
+      pass
+    directory = os.path.dirname(data_path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory, 0755)
+    self.fd = os.open(data_path, os.O_RDWR | os.O_CREAT, 0644)
+    if os.fstat(self.fd).st_size != size:
+      os.ftruncate(self.fd, size)
+    self.lock = Lock()
+    self.fetched = Condition(self.lock)
+    self.fetching = set()
+
+  def has_block(self, block):
+    return bool(self.bitmap[block // 8] & (1 << (block % 8)))
+
+  def complete(self):
+    return all(self.has_block(block) for block in xrange(self.block_count))
+
+  def missing_ranges(self, start, end):
+    """Returns (first_block, last_block) runs which are needed for start:end
+
+    Blocks which another thread is fetching are waited for rather than
+    returned"""
+    first_block = start // self.block_size
+    last_block = min(self.block_count, (end + self.block_size - 1) // self.block_size)
+    with self.lock:
+      while any(block in self.fetching for block in xrange(first_block, last_block)):
+        self.fetched.wait()
+      runs = []
+      for block in xrange(first_block, last_block):
+        if self.has_block(block):
+          continue
+        if runs and runs[-1][1] == block:
+          runs[-1][1] = block + 1
+        else:
+          runs.append([block, block + 1])
+        self.fetching.add(block)
+      return runs
+
+  def write(self, offset, data):
+    """Writes data at offset and marks the whole blocks it covers"""
+    with self.lock:
+      os.lseek(self.fd, offset, 0)
+      os.write(self.fd, data)
+      first_block = (offset + self.block_size - 1) // self.block_size
+      end = offset + len(data)
+      for block in xrange(first_block, self.block_count):
+        block_end = min((block + 1) * self.block_size, self.size)
+        if block_end > end:
+          break
+        self.bitmap[block // 8] |= 1 << (block % 8)
+      with open(self.bitmap_path, 'wb') as f:
+        f.write(self.bitmap)
+
+  def finished_fetching(self, first_block, last_block):
+    with self.lock:
+      self.fetching.difference_update(xrange(first_block, last_block))
+      self.fetched.notify_all()
+
+  def fill(self, url, start, end, timeout=600):
+    """Makes sure that bytes start:end are present, fetching them if not
+
+    Returns the number of bytes fetched"""
+    runs = self.missing_ranges(start, end)
+    fetched = 0
+    try:
+      for first_block, last_block in runs:
+        range_start = first_block * self.block_size
+        range_end = min(last_block * self.block_size, self.size)
+        logging.info("Fetching bytes %s-%s of %s" % (range_start, range_end, url))
+        offset, data, total_size = fetch_range(url, range_start, range_end, timeout)
+        self.write(offset, data)
+        fetched += len(data)
+    finally:
+      for first_block, last_block in runs:
+        self.finished_fetching(first_block, last_block)
+    return fetched
+
+  def close(self):
+    os.close(self.fd)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+"""Counts the calls the kernel makes into a mount with different options
+
+Mounts genbankfs for real (with scripts/genbankfs-start, so this needs
+FUSE) over a local fake NCBI once for each of these sets of options:
+
+  default   FUSE's defaults (attributes are cached for a second and
+            pages are dropped when a file is opened)
+  attrs     --entry-timeout and --attr-timeout of an hour
+  pages     attrs plus --auto-cache
+  kernel    attrs plus --kernel-cache
+
+In each, some accessions are listed with ls -l and their genomes read
+(which downloads them) before the same is done --repeats more times.
+The FUSE operations genbankfs handled during the repeats are counted
+from its metrics.
+
+  python -m genbankfs.tests.bench_kernel_cache --accessions 20 --repeats 5
+"""
+
+import argparse
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import urllib2
+
+from time import sleep, time
+
+from genbankfs.tests.fake_origin import HTTPOrigin
+from genbankfs.tests.synthetic import (accession_name, write_accession_files,
+                                       write_assembly_summary)
+
+start_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                            'scripts', 'genbankfs-start')
+hour = ['--entry-timeout', '3600', '--attr-timeout', '3600']
+configurations = [('default', []),
+                  ('attrs', hour),
+                  ('pages', hour + ['--auto-cache']),
+                  ('kernel', hour + ['--kernel-cache'])]
+operations = ['getattr', 'readdir', 'open', 'read', 'release']
+op_count = re.compile(r'^genbankfs_fuse_op_seconds_count\{op="(\w+)"\} (\d+)$', re.M)
+
+def free_port():
+  s = socket.socket()
+  try:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+  finally:
+    s.close()
+
+def op_counts(metrics_url):
+  stats = urllib2.urlopen(metrics_url, timeout=10).read()
+  return dict((op, int(count)) for op, count in op_count.findall(stats))
+
+def ls_and_read(mount_point, accessions, chunk_size=128*1024):
+  for accession in accessions:
+    accession_dir = os.path.join(mount_point, 'accession', accession)
+    for filename in os.listdir(accession_dir):
+      os.stat(os.path.join(accession_dir, filename))
+    with open(os.path.join(accession_dir, "%s_genomic.fna.gz" % accession), 'rb') as f:
+      while f.read(chunk_size):
+        pass
+
+def wait_for_mount(process, mount_point, timeout=120):
+  deadline = time() + timeout
+  while not os.path.ismount(mount_point):
+    if process.poll() is not None:
+      raise RuntimeError("genbankfs-start exited with %s" % process.returncode)
+    if time() > deadline:
+      raise RuntimeError("%s wasn't mounted after %ss" % (mount_point, timeout))
+    sleep(0.1)
+
+def run(name, options, summary_path, cache_dir, temp_dir, accessions, repeats):
+  """Returns the ops genbankfs handled during the repeats and how long they took"""
+  mount_point = tempfile.mkdtemp(prefix="mount_%s_" % name, dir=temp_dir)
+  port = free_port()
+  metrics_url = "http://127.0.0.1:%s/metrics" % port
+  with open(os.path.join(temp_dir, "%s.log" % name), 'w') as log:
+    process = subprocess.Popen([sys.executable, start_script, summary_path, mount_point,
+                                '--cache', cache_dir, '--no-snapshot',
+                                '--no-size-discovery', '--metrics-port', str(port)] + options,
+                               stdout=log, stderr=subprocess.STDOUT)
+  try:
+    wait_for_mount(process, mount_point)
+    ls_and_read(mount_point, accessions)
+    before = op_counts(metrics_url)
+    start = time()
+    for i in xrange(repeats):
+      ls_and_read(mount_point, accessions)
+    duration = time() - start
+    after = op_counts(metrics_url)
+  finally:
+    subprocess.call(['fusermount', '-u', mount_point])
+    process.wait()
+  return dict((op, after.get(op, 0) - before.get(op, 0)) for op in operations), duration
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Counts FUSE calls with different kernel caching options")
+  parser.add_argument("--accessions", type=int, default=20)
+  parser.add_argument("--genome-size", type=int, default=2,
+                      help="MB of sequence in each genome")
+  parser.add_argument("--repeats", type=int, default=5)
+  parser.add_argument("--configuration", action='append',
+                      choices=[name for name, options in configurations])
+  args = parser.parse_args(argv)
+  chosen = args.configuration or [name for name, options in configurations]
+
+  temp_dir = tempfile.mkdtemp(prefix="genbankfs_bench_kernel_cache_")
+  try:
+    origin_dir = os.path.join(temp_dir, 'origin')
+    accessions = [accession_name(row) for row in xrange(args.accessions)]
+    for i, accession in enumerate(accessions):
+      write_accession_files(origin_dir, accession, args.genome_size * 1024**2, seed=i)
+    with HTTPOrigin(origin_dir) as origin:
+      summary_path = os.path.join(temp_dir, 'assembly_summary.txt')
+      with open(summary_path, 'w') as f:
+        write_assembly_summary(f, args.accessions, ftp_root=origin.url)
+      # shared so that only the first configuration downloads anything
+      cache_dir = os.path.join(temp_dir, 'cache')
+      print("%s accessions listed and read %s times" % (args.accessions, args.repeats))
+      print("%-8s %s %9s" % ("", " ".join("%8s" % op for op in operations), "seconds"))
+      for name, options in configurations:
+        if name not in chosen:
+          continue
+        counts, duration = run(name, options, summary_path, cache_dir, temp_dir,
+                               accessions, args.repeats)
+        print("%-8s %s %9.2f" % (name, " ".join("%8d" % counts[op] for op in operations),
+                                 duration))
+        sys.stdout.flush()
+  finally:
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
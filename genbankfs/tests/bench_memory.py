@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+"""Benchmarks the memory held by GenbankSearch's metadata
+
+Each representation is built in a child process and the growth in its
+resident set size is reported alongside the bytes its data structures
+claim to use:
+
+  dataframe  the whole summary with object slug columns and a dict
+             from accession to URL (how metadata used to be held)
+  compact    GenbankSearch's indexes and URL prefix table
+  snapshot   the same memory mapped from a snapshot (only pages which
+             have been touched are resident, and they're shared)
+
+  python -m genbankfs.tests.bench_memory [rows]
+"""
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+import numpy as np
+import pandas as pd
+
+from genbankfs import GenbankSearch
+from genbankfs.tests.synthetic import write_assembly_summary
+
+def resident_bytes():
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def dataframe(summary_path):
+  database = pd.read_csv(summary_path, delimiter='\t')
+  GenbankSearch.__new__(GenbankSearch)._add_slug_columns(database)
+  urls = dict(zip(database['accession_slug'], database['ftp_path']))
+  structure_bytes = database.memory_usage(deep=True).sum()
+  structure_bytes += sys.getsizeof(urls) + sum(sys.getsizeof(url) for url in urls.values())
+  return (database, urls), structure_bytes
+
+def compact(summary_path, snapshot_root=None):
+  with open(summary_path) as f:
+    searcher = GenbankSearch(f, snapshot_root=snapshot_root)
+  arrays = [searcher.urls.prefixes.blob, searcher.urls.prefixes.offsets, searcher.urls.codes]
+  for index in searcher.indexes.values():
+    arrays += [index.values.blob, index.values.offsets, index.codes, index.rows, index.offsets]
+  return searcher, sum(np.asarray(array).nbytes for array in arrays)
+
+def snapshot(summary_path, snapshot_root):
+  return compact(summary_path, snapshot_root)
+
+def measure(results, name, build, args):
+  gc.collect()
+  before = resident_bytes()
+  held, structure_bytes = build(*args)
+  gc.collect()
+  results.put((name, resident_bytes() - before, structure_bytes))
+
+def main(argv):
+  rows = int(argv[0]) if argv else 500000
+  temp_dir = tempfile.mkdtemp(prefix="genbankfs_bench_memory_")
+  try:
+    summary_path = os.path.join(temp_dir, 'assembly_summary.txt')
+    with open(summary_path, 'w') as f:
+      write_assembly_summary(f, rows)
+    snapshot_root = os.path.join(temp_dir, 'metadata')
+    compact(summary_path, snapshot_root) # so that there's a snapshot to load
+    print("%s rows" % rows)
+    print("%-10s %12s %14s" % ("", "RSS MB", "structures MB"))
+    for name, build, args in [('dataframe', dataframe, (summary_path,)),
+                              ('compact', compact, (summary_path,)),
+                              ('snapshot', snapshot, (summary_path, snapshot_root))]:
+      results = Queue()
+      child = Process(target=measure, args=(results, name, build, args))
+      child.start()
+      child.join()
+      try:
+        name, rss, structure_bytes = results.get(timeout=1)
+      except Empty:
+        continue # the child will have printed why
+      print("%-10s %12.1f %14.1f" % (name, rss / 1024.0**2, structure_bytes / 1024.0**2))
+  finally:
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
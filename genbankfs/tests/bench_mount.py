@@ -0,0 +1,222 @@
+#!/usr/bin/env python2
+"""Load tests a mount against a local fake NCBI
+
+Builds a synthetic assembly summary whose accessions are served by a
+local HTTP (or FTP) origin with tunable latency and bandwidth, then
+drives GenbankFuse and GenbankCache directly (no kernel mount needed)
+through some typical workloads:
+
+  stat       getattr on random accession files
+  ls         listings of the top level folders and ls -l of /genus
+  walk       ls -lR (or find) of one species_taxid's tree
+  read_cold  parallel reads of genomes which have to be downloaded
+  read_hot   the same reads again, from the cache
+
+Each reports operations per second, p50 and p99 latency and the
+process' peak RSS so far.
+
+  python -m genbankfs.tests.bench_mount --rows 100000 --latency 0.05
+"""
+
+import argparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+
+from threading import Thread
+from time import time
+
+from genbankfs import GenbankCache, GenbankFuse, GenbankSearch
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin
+from genbankfs.tests.synthetic import (accession_name, assembly_summary,
+                                       write_accession_files)
+
+chunk_size = 128 * 1024
+
+class Result(object):
+  """Latencies of the operations in a scenario"""
+  def __init__(self, name, latencies, duration, extra=''):
+    self.name = name
+    self.latencies = sorted(latencies)
+    self.duration = duration
+    self.extra = extra
+
+  def percentile(self, q):
+    if not self.latencies:
+      return 0
+    return self.latencies[int(q * (len(self.latencies) - 1))]
+
+  def report(self):
+    ops = len(self.latencies)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return "%-10s %8d %10.0f %9.3f %9.3f %9.0f  %s" % (
+      self.name, ops, ops / self.duration if self.duration else 0,
+      self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, peak_rss,
+      self.extra)
+
+header = "%-10s %8s %10s %9s %9s %9s" % ("scenario", "ops", "ops/s", "p50 ms",
+                                         "p99 ms", "RSS MB")
+
+def timed_calls(calls):
+  """Runs each (func, args) and returns their latencies"""
+  latencies = []
+  for func, args in calls:
+    start = time()
+    func(*args)
+    latencies.append(time() - start)
+  return latencies
+
+def in_threads(func, work, threads):
+  """Splits work between threads running func(items) -> latencies"""
+  latencies = []
+  def run(items):
+    latencies.extend(func(items))
+  workers = [Thread(target=run, args=(work[i::threads],)) for i in xrange(threads)]
+  start = time()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return latencies, time() - start
+
+def list_directory(fuse, path):
+  """Reads a directory a page at a time, like the kernel does"""
+  names = []
+  offset = 0
+  while True:
+    entries = fuse('readdir', path, None, offset)
+    if not entries:
+      return names
+    for name, attributes, offset in entries:
+      names.append(name)
+
+def stat_scenario(fuse, rows, count, threads):
+  paths = ["/accession/%s/README.txt" % accession_name(random.randrange(rows))
+           for i in xrange(count)]
+  work = [(fuse, ('getattr', path)) for path in paths]
+  latencies, duration = in_threads(timed_calls, work, threads)
+  return Result('stat', latencies, duration)
+
+def ls_scenario(fuse):
+  start = time()
+  work = [(list_directory, (fuse, '/' + folder)) for folder in fuse.searcher.folders]
+  latencies = timed_calls(work)
+  genera = list_directory(fuse, '/genus')
+  latencies += timed_calls((fuse, ('getattr', '/genus/' + genus))
+                           for genus in genera if genus not in ('.', '..'))
+  return Result('ls', latencies, time() - start)
+
+def walk_scenario(fuse, max_depth):
+  latencies = []
+  def walk(path, depth):
+    started = time()
+    entries = list_directory(fuse, path)
+    latencies.append(time() - started)
+    for entry in entries:
+      if entry in ('.', '..'):
+        continue
+      child = path.rstrip('/') + '/' + entry
+      started = time()
+      attributes = fuse('getattr', child)
+      latencies.append(time() - started)
+      if attributes['st_mode'] & 040000 and depth < max_depth:
+        walk(child, depth + 1)
+  species_taxid = [entry for entry in list_directory(fuse, '/species_taxid')
+                   if entry not in ('.', '..')][0]
+  start = time()
+  walk('/species_taxid/' + species_taxid, 1)
+  return Result('walk', latencies, time() - start)
+
+def read_scenario(name, fuse, accessions, threads):
+  """Reads each accession's genome through the cache in FUSE sized chunks"""
+  cache = fuse.cache
+  def read_files(accessions):
+    latencies = []
+    for accession in accessions:
+      path = fuse.parse_path("/accession/%s/%s_genomic.fna.gz" % (accession,
+                                                                  accession)).file_path
+      fh = cache.open(path, os.O_RDONLY)
+      try:
+        offset = 0
+        while True:
+          start = time()
+          data = cache.read(chunk_size, offset, fh)
+          latencies.append(time() - start)
+          if not data:
+            break
+          offset += len(data)
+      finally:
+        cache.release(fh)
+    return latencies
+  served = cache.metrics.value('genbankfs_served_bytes_total')
+  latencies, duration = in_threads(read_files, accessions, threads)
+  served = cache.metrics.value('genbankfs_served_bytes_total') - served
+  return Result(name, latencies, duration, "%.1f MB/s" % (served / duration / 1024**2))
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Load tests GenbankFuse and GenbankCache")
+  parser.add_argument("--rows", type=int, default=100000)
+  parser.add_argument("--genera", type=int, default=500)
+  parser.add_argument("--species-per-genus", type=int, default=20)
+  parser.add_argument("--strains-per-species", type=int, default=50)
+  parser.add_argument("--files", type=int, default=8,
+                      help="Accessions to generate genomes for and read")
+  parser.add_argument("--genome-size", type=int, default=4,
+                      help="MB of sequence in each genome")
+  parser.add_argument("--latency", type=float, default=0.02,
+                      help="Seconds the origin takes to respond")
+  parser.add_argument("--bandwidth", type=float, default=None,
+                      help="MB/s the origin sends each file at")
+  parser.add_argument("--ftp", action='store_true', help="Use an FTP origin")
+  parser.add_argument("--threads", type=int, default=4)
+  parser.add_argument("--stats", type=int, default=20000,
+                      help="getattr calls in the stat scenario")
+  parser.add_argument("--walk-depth", type=int, default=4)
+  parser.add_argument("--event-loop", action='store_true')
+  parser.add_argument("--scenario", action='append',
+                      choices=['stat', 'ls', 'walk', 'read_cold', 'read_hot'])
+  args = parser.parse_args(argv)
+  scenarios = args.scenario or ['stat', 'ls', 'walk', 'read_cold', 'read_hot']
+
+  temp_dir = tempfile.mkdtemp(prefix="genbankfs_bench_mount_")
+  try:
+    origin_dir = os.path.join(temp_dir, 'origin')
+    accessions = [accession_name(row) for row in xrange(min(args.files, args.rows))]
+    for i, accession in enumerate(accessions):
+      write_accession_files(origin_dir, accession, args.genome_size * 1024**2, seed=i)
+    bandwidth = args.bandwidth and args.bandwidth * 1024**2
+    origin_class = FTPOrigin if args.ftp else HTTPOrigin
+    with origin_class(origin_dir, latency=args.latency, bandwidth=bandwidth) as origin:
+      start = time()
+      summary = assembly_summary(args.rows, genera=args.genera,
+                                 species_per_genus=args.species_per_genus,
+                                 strains_per_species=args.strains_per_species,
+                                 ftp_root=origin.url)
+      searcher = GenbankSearch(summary)
+      cache = GenbankCache(os.path.join(temp_dir, 'cache'), searcher.build_url_lookup(),
+                           discover_sizes=False, event_loop=args.event_loop)
+      fuse = GenbankFuse(searcher, cache, paged=True)
+      print("%s rows loaded in %.1fs" % (args.rows, time() - start))
+      print(header)
+      try:
+        for scenario in scenarios:
+          if scenario == 'stat':
+            result = stat_scenario(fuse, args.rows, args.stats, args.threads)
+          elif scenario == 'ls':
+            result = ls_scenario(fuse)
+          elif scenario == 'walk':
+            result = walk_scenario(fuse, args.walk_depth)
+          else:
+            result = read_scenario(scenario, fuse, accessions, args.threads)
+          print(result.report())
+          sys.stdout.flush()
+      finally:
+        cache.close()
+  finally:
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
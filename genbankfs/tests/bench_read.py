@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+"""Benchmarks parallel reads of files which are already in the cache
+
+Each reader thread has its own file and reads it in FUSE sized chunks,
+copying each into a buffer as fusepy does for the kernel.  Compares:
+
+  locked  a global lock around lseek and read (how reads used to work)
+  pread   positional reads (GenbankCache.read with map_files unset)
+  mapped  slices of a shared memory map (GenbankCache.read)
+  view    buffers of the memory map copied straight into the kernel's
+          buffer (GenbankCache.read_view, as PagedFUSE mounts do)
+
+Each is reported in MB/s and CPU seconds used per GB read.
+
+  python -m genbankfs.tests.bench_read [file_size_mb]
+"""
+
+import ctypes
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+from threading import Lock, Thread, local
+from time import time
+
+from genbankfs import GenbankCache
+from genbankfs.genbank_fuse import _buffer_address
+
+chunk_size = 128 * 1024
+
+def make_cache_dir(file_count, file_size):
+  root_dir = tempfile.mkdtemp(prefix="genbankfs_bench_read_")
+  block = os.urandom(1024 * 1024)
+  for i in xrange(file_count):
+    os.makedirs(os.path.join(root_dir, "acc_%s" % i))
+    with open(os.path.join(root_dir, "acc_%s" % i, "genome.fna"), 'wb') as f:
+      for j in xrange(file_size // len(block)):
+        f.write(block)
+  return root_dir
+
+def into_buffer(read):
+  """Copies what read returns into a buffer, like FUSE.read does"""
+  buffers = local()
+  def copying_read(size, offset, fh):
+    buf = getattr(buffers, 'buf', None)
+    if buf is None:
+      buf = buffers.buf = ctypes.create_string_buffer(chunk_size)
+    address, length = _buffer_address(read(size, offset, fh))
+    ctypes.memmove(buf, address, length)
+  return copying_read
+
+def read_all(read, fh, file_size):
+  for offset in xrange(0, file_size, chunk_size):
+    read(chunk_size, offset, fh)
+
+def locked_reader():
+  rwlock = Lock()
+  def read(size, offset, fh):
+    with rwlock:
+      os.lseek(fh, offset, 0)
+      return os.read(fh, size)
+  return read
+
+def cpu_seconds():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+def measure(cache, read, readers, file_size):
+  """Returns MB/s and CPU seconds per GB"""
+  handles = [cache.open("acc_%s/genome.fna" % i, os.O_RDONLY)
+             for i in xrange(readers)]
+  threads = [Thread(target=read_all, args=(into_buffer(read), fh, file_size))
+             for fh in handles]
+  start = time()
+  start_cpu = cpu_seconds()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  duration = time() - start
+  cpu = cpu_seconds() - start_cpu
+  for fh in handles:
+    cache.release(fh)
+  total_bytes = readers * file_size
+  return total_bytes / duration / 1024**2, cpu / (total_bytes / 1024.0**3)
+
+def main(argv):
+  file_size = int(argv[0] if argv else 64) * 1024**2
+  reader_counts = [1, 2, 4, 8]
+  root_dir = make_cache_dir(max(reader_counts), file_size)
+  try:
+    pread_cache = GenbankCache(root_dir, lambda path: None, map_files=False)
+    mapped_cache = GenbankCache(root_dir, lambda path: None)
+    methods = [('locked', pread_cache, locked_reader()),
+               ('pread', pread_cache, pread_cache.read),
+               ('mapped', mapped_cache, mapped_cache.read),
+               ('view', mapped_cache, mapped_cache.read_view)]
+    print("%7s  %s" % ("", "  ".join("%16s" % name for name, cache, read in methods)))
+    print("readers  %s" % "  ".join("%16s" % "MB/s  CPU s/GB" for method in methods))
+    for readers in reader_counts:
+      results = [measure(cache, read, readers, file_size) for name, cache, read in methods]
+      print("%7d  %s" % (readers, "  ".join("%9.0f %6.2f" % result for result in results)))
+      sys.stdout.flush()
+  finally:
+    shutil.rmtree(root_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
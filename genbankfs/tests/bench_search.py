@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+"""Benchmarks directory listings against a synthetic assembly summary
+
+Compares GenbankSearch.list with the old approach of building a query
+string and scanning the whole DataFrame for every listing.
+
+  python -m genbankfs.tests.bench_search [rows]
+"""
+
+import sys
+
+from time import time
+
+from genbankfs import GenbankSearch
+from genbankfs.tests.synthetic import assembly_summary
+
+def scan_list(searcher, database, folder, **terms):
+  relevant_terms = {key+'_slug': searcher._slug(value)
+                      for key,value in terms.items()}
+  query_str = " & ".join(["{} == '{}'".format(key, value) for key,value in
+                     relevant_terms.items()])
+  result = database.query(query_str) if query_str else database
+  return list(set(result[folder+'_slug']))
+
+def time_per_call(func, repeats):
+  start = time()
+  for i in xrange(repeats):
+    func()
+  return (time() - start) / repeats
+
+def main(argv):
+  rows = int(argv[0]) if argv else 300000
+  start = time()
+  searcher = GenbankSearch(assembly_summary(rows))
+  print("Loaded %s rows in %.1fs" % (rows, time() - start))
+  database = searcher.query()
+
+  genus = searcher.list('genus')[0]
+  species = searcher.list('species', genus=genus)[0]
+  taxid = searcher.list('taxid', genus=genus, species=species)[0]
+  listings = [
+    ('genus', {}),
+    ('species', dict(genus=genus)),
+    ('taxid', dict(genus=genus, species=species)),
+    ('accession', dict(genus=genus, species=species, taxid=taxid)),
+  ]
+  print("%-62s %10s %10s" % ("listing", "index ms", "scan ms"))
+  for folder, terms in listings:
+    expected = scan_list(searcher, database, folder, **terms)
+    assert sorted(searcher.list(folder, **terms)) == sorted(expected)
+    index_time = time_per_call(lambda: searcher.list(folder, **terms), 20)
+    scan_time = time_per_call(lambda: scan_list(searcher, database, folder, **terms), 3)
+    path = "/".join("%s/%s" % item for item in sorted(terms.items()))
+    print("%-62s %10.3f %10.3f" % ("/".join(filter(None, [path, folder])),
+                                   index_time * 1000, scan_time * 1000))
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+"""Benchmarks fetching whole accessions with and without persistent sessions
+
+Local FTP and HTTP stand-ins add latency to every reply (and every new
+HTTP connection) to mimic the round trips to NCBI.  Each accession has
+the usual seven small files.  A new urllib connection per file (the old
+approach) is compared with reusing a SessionPool.
+
+  python -m genbankfs.tests.bench_sessions [accessions] [latency_ms]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import urllib
+
+from time import time
+
+from genbankfs.sessions import SessionPool
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin, make_accession
+
+accession_files = ["%s" + suffix for suffix in [
+  "_assembly_report.txt", "_assembly_stats.txt", "_genomic.fna.gz",
+  "_genomic.gbff.gz", "_genomic.gff.gz", "_protein.faa.gz"]] + ["md5checksums.txt"]
+
+def make_origin(root_dir, accession_count):
+  accessions = ["GCA_%09d.1" % i for i in xrange(accession_count)]
+  for accession in accessions:
+    make_accession(root_dir, accession,
+                   dict((name.replace('%s', accession), os.urandom(4096))
+                        for name in accession_files))
+  return accessions
+
+def urllib_fetch(url):
+  urllib.urlcleanup()
+  source = urllib.urlopen(url)
+  try:
+    return source.read()
+  finally:
+    source.close()
+
+def session_fetcher():
+  pool = SessionPool()
+  def fetch(url):
+    source = pool.open(url)
+    try:
+      return source.read()
+    finally:
+      source.close()
+  return fetch
+
+def measure(origin, accessions, fetch):
+  requests = 0
+  start = time()
+  for accession in accessions:
+    for name in accession_files:
+      fetch("%s/%s/%s" % (origin.url, accession, name.replace('%s', accession)))
+      requests += 1
+  duration = time() - start
+  return duration / len(accessions) * 1000, origin.connections
+
+def main(argv):
+  accession_count = int(argv[0]) if argv else 10
+  latency = float(argv[1] if len(argv) > 1 else 5) / 1000
+  root_dir = tempfile.mkdtemp(prefix="genbankfs_bench_sessions_")
+  try:
+    accessions = make_origin(root_dir, accession_count)
+    print("origin  fetcher   ms/accession  connections")
+    for name, origin_class, kwargs in [('ftp', FTPOrigin, {}),
+                                       ('http', HTTPOrigin, dict(keep_alive=True))]:
+      for fetcher_name, fetch in [('urllib', urllib_fetch),
+                                  ('session', session_fetcher())]:
+        with origin_class(root_dir, latency=latency, **kwargs) as origin:
+          ms, connections = measure(origin, accessions, fetch)
+        print("%-6s  %-8s  %13.1f  %11d" % (name, fetcher_name, ms, connections))
+  finally:
+    shutil.rmtree(root_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+"""Benchmarks GenbankSearch start up on a synthetic assembly summary
+
+Compares the time taken to derive the slug columns with the old
+approach of slugifying every row and checks that they're identical.
+Also reports the total start up time (parsing, slugs and indexes) and
+the time to remount from a snapshot.
+
+  python -m genbankfs.tests.bench_startup [rows]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+from time import time
+
+import pandas as pd
+
+from genbankfs import GenbankSearch
+from genbankfs.tests.synthetic import assembly_summary
+
+def row_by_row_slugs(searcher, database):
+  slugs = {}
+  for column, folder in [('species_taxid', 'species_taxid'),
+                         ('taxid', 'taxid'),
+                         ('organism_name', 'organism_name')]:
+    slugs[folder] = map(searcher._slug, database[column])
+  slugs['genus'] = map(searcher._get_genus, database['organism_name'])
+  slugs['species'] = map(searcher._get_species, database['organism_name'])
+  slugs['accession'] = map(searcher._get_accession, database['ftp_path'])
+  return slugs
+
+def main(argv):
+  rows = int(argv[0]) if argv else 500000
+  summary = assembly_summary(rows)
+
+  start = time()
+  searcher = GenbankSearch(summary)
+  startup_time = time() - start
+
+  summary.seek(0)
+  database = pd.read_csv(summary, delimiter='\t')
+  start = time()
+  searcher._add_slug_columns(database)
+  slug_time = time() - start
+
+  start = time()
+  slugs = row_by_row_slugs(searcher, database)
+  row_by_row_time = time() - start
+
+  for folder, expected in slugs.items():
+    assert list(database[folder+'_slug']) == expected, folder
+  print("%s rows: start up %.1fs; slug columns %.1fs (row by row %.1fs)" % (
+        rows, startup_time, slug_time, row_by_row_time))
+
+  temp_dir = tempfile.mkdtemp(prefix="genbankfs_bench_startup_")
+  try:
+    summary_path = os.path.join(temp_dir, 'assembly_summary.txt')
+    with open(summary_path, 'w') as f:
+      f.write(summary.getvalue())
+    snapshot_root = os.path.join(temp_dir, 'metadata')
+    with open(summary_path) as f:
+      GenbankSearch(f, snapshot_root=snapshot_root)
+    start = time()
+    with open(summary_path) as f:
+      GenbankSearch(f, snapshot_root=snapshot_root)
+    print("Remount from snapshot %.3fs" % (time() - start))
+  finally:
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,308 @@
+"""Local stand-ins for the NCBI servers for tests and benchmarks"""
+
+import os
+import posixpath
+import socket
+import urllib
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import StreamRequestHandler, ThreadingMixIn, ThreadingTCPServer
+from StringIO import StringIO
+from threading import Thread
+from time import sleep, time
+
+def send_throttled(write, source, bandwidth=None, chunk_size=64*1024):
+  """Copies the file like source to write at up to bandwidth bytes per second"""
+  started = time()
+  sent = 0
+  while True:
+    chunk = source.read(chunk_size)
+    if not chunk:
+      break
+    write(chunk)
+    sent += len(chunk)
+    if bandwidth:
+      delay = sent / float(bandwidth) - (time() - started)
+      if delay > 0:
+        sleep(delay)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    pass # clients hanging up on us are part of the tests
+
+class ThreadingFTPServer(ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def handle_error(self, request, client_address):
+    pass
+
+class HTTPOrigin(object):
+  """Serves the files in root_dir over HTTP on a random local port
+
+  Each request (and each new connection) is delayed by latency seconds
+  and responses are sent at up to bandwidth bytes per second (if set).
+  The method, path and Range header of each request are recorded in
+  requests and new connections are counted in connections.  Single byte
+  ranges are supported unless ranges is False.  Connections are kept
+  alive if keep_alive is set."""
+  def __init__(self, root_dir, latency=0, ranges=True, keep_alive=False, bandwidth=None):
+    self.root_dir = root_dir
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.ranges = ranges
+    self.requests = []
+    self.connections = 0
+    origin = self
+    class Handler(SimpleHTTPRequestHandler):
+      disable_nagle_algorithm = True
+      if keep_alive:
+        protocol_version = 'HTTP/1.1'
+
+      def setup(self):
+        origin.connections += 1
+        if origin.latency:
+          sleep(origin.latency)
+        SimpleHTTPRequestHandler.setup(self)
+
+      def send_head(self):
+        byte_range = self.headers.getheader('Range')
+        origin.requests.append((self.command, self.path, byte_range))
+        if origin.latency:
+          sleep(origin.latency)
+        if byte_range and origin.ranges:
+          return self.send_range(byte_range)
+        return SimpleHTTPRequestHandler.send_head(self)
+
+      def send_range(self, byte_range):
+        try:
+          f = open(self.translate_path(self.path), 'rb')
+        except IOError:
+          self.send_error(404, "File not found")
+          return None
+        size = os.fstat(f.fileno()).st_size
+        start, end = byte_range.split('=', 1)[1].split('-')
+        start = int(start)
+        end = min(int(end) if end else size - 1, size - 1)
+        if start >= size:
+          f.close()
+          self.send_response(416)
+          self.send_header("Content-Range", "bytes */%s" % size)
+          self.send_header("Content-Length", "0")
+          self.end_headers()
+          return None
+        f.seek(start)
+        data = f.read(end - start + 1)
+        f.close()
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, size))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return StringIO(data)
+
+      def copyfile(self, source, outputfile):
+        send_throttled(outputfile.write, source, origin.bandwidth)
+
+      def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?')[0]))
+        return os.path.join(origin.root_dir, *filter(None, path.split('/')))
+
+      def log_message(self, *args):
+        pass
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.thread = Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+
+  @property
+  def url(self):
+    return "http://127.0.0.1:%s" % self.server.server_address[1]
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+class FTPOrigin(object):
+  """Serves the files in root_dir over anonymous, passive mode FTP
+
+  Only the commands which ftplib needs to log in, change directory and
+  fetch or list files are supported.  Each reply is delayed by latency
+  seconds to stand in for the round trip to a real server and data is
+  sent at up to bandwidth bytes per second (if set).  Commands are
+  recorded in commands and connections are counted in connections.
+  SIZE isn't supported if sizes is False."""
+  def __init__(self, root_dir, latency=0, bandwidth=None, sizes=True):
+    self.root_dir = root_dir
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.sizes = sizes
+    self.commands = []
+    self.connections = 0
+    origin = self
+    class Handler(StreamRequestHandler):
+      disable_nagle_algorithm = True
+
+      def handle(self):
+        origin.connections += 1
+        self.cwd = '/'
+        self.rest = 0
+        self.passive = None
+        self.reply('220 Fake FTP origin')
+        while True:
+          line = self.rfile.readline()
+          if not line:
+            break
+          command, _, argument = line.strip().partition(' ')
+          command = command.upper()
+          origin.commands.append((command, argument))
+          method = getattr(self, 'ftp_' + command, None)
+          if method is None:
+            self.reply('502 %s not implemented' % command)
+          elif method(argument) is False:
+            break
+        if self.passive is not None:
+          self.passive.close()
+
+      def reply(self, message):
+        if origin.latency:
+          sleep(origin.latency)
+        self.wfile.write(message + '\r\n')
+
+      def local_path(self, argument):
+        path = posixpath.normpath(posixpath.join(self.cwd, argument))
+        return path, os.path.join(origin.root_dir, *filter(None, path.split('/')))
+
+      def ftp_USER(self, argument):
+        self.reply('331 Any password will do')
+
+      def ftp_PASS(self, argument):
+        self.reply('230 Logged in')
+
+      def ftp_TYPE(self, argument):
+        self.reply('200 Type set to %s' % argument)
+
+      def ftp_NOOP(self, argument):
+        self.reply('200 OK')
+
+      def ftp_PWD(self, argument):
+        self.reply('257 "%s"' % self.cwd)
+
+      def ftp_CWD(self, argument):
+        path, local_path = self.local_path(argument)
+        if os.path.isdir(local_path):
+          self.cwd = path
+          self.reply('250 Directory changed')
+        else:
+          self.reply('550 No such directory')
+
+      def ftp_SIZE(self, argument):
+        path, local_path = self.local_path(argument)
+        if not origin.sizes:
+          self.reply('502 SIZE not implemented')
+        elif os.path.isfile(local_path):
+          self.reply('213 %s' % os.path.getsize(local_path))
+        else:
+          self.reply('550 No such file')
+
+      def ftp_REST(self, argument):
+        self.rest = int(argument)
+        self.reply('350 Restarting at %s' % self.rest)
+
+      def ftp_PASV(self, argument):
+        if self.passive is not None:
+          self.passive.close()
+        self.passive = socket.socket()
+        self.passive.bind(('127.0.0.1', 0))
+        self.passive.listen(1)
+        port = self.passive.getsockname()[1]
+        self.reply('227 Entering Passive Mode (127,0,0,1,%s,%s)' % (port >> 8, port & 255))
+
+      def ftp_RETR(self, argument):
+        path, local_path = self.local_path(argument)
+        rest, self.rest = self.rest, 0
+        if not os.path.isfile(local_path):
+          self.reply('550 No such file')
+          return
+        with open(local_path, 'rb') as f:
+          f.seek(rest)
+          self.send_data(f.read())
+
+      def ftp_LIST(self, argument):
+        path, local_path = self.local_path(argument)
+        if not os.path.isdir(local_path):
+          self.reply('550 No such directory')
+          return
+        lines = []
+        for filename in sorted(os.listdir(local_path)):
+          file_path = os.path.join(local_path, filename)
+          mode = 'dr-xr-xr-x' if os.path.isdir(file_path) else '-r--r--r--'
+          lines.append("%s   1 ftp      anonymous %8s Jun 10  2015 %s\r\n" %
+                       (mode, os.path.getsize(file_path), filename))
+        self.send_data("".join(lines))
+
+      def ftp_QUIT(self, argument):
+        self.reply('221 Goodbye')
+        return False
+
+      def send_data(self, data):
+        if self.passive is None:
+          self.reply('425 Use PASV first')
+          return
+        self.reply('150 Opening data connection')
+        connection, address = self.passive.accept()
+        self.passive.close()
+        self.passive = None
+        try:
+          send_throttled(connection.sendall, StringIO(data), origin.bandwidth)
+        except socket.error:
+          self.reply('426 Transfer aborted')
+        else:
+          self.reply('226 Transfer complete')
+        finally:
+          connection.close()
+
+    self.server = ThreadingFTPServer(('127.0.0.1', 0), Handler)
+    self.thread = Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+
+  @property
+  def url(self):
+    return "ftp://127.0.0.1:%s" % self.server.server_address[1]
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+def make_accession(root_dir, accession, files):
+  """Creates an accession directory in root_dir containing files
+
+  files maps filenames to their contents"""
+  accession_dir = os.path.join(root_dir, accession)
+  os.makedirs(accession_dir)
+  for filename, contents in files.items():
+    with open(os.path.join(accession_dir, filename), 'wb') as f:
+      f.write(contents)
+  return accession_dir
@@ -0,0 +1,24 @@
+"""Calls Python from threads which Python didn't start, like libfuse does
+
+Each call looks to the threading module like a new thread (with an
+empty threading.local) even though the OS may reuse the thread."""
+
+import ctypes
+import ctypes.util
+
+_pthread = ctypes.CDLL(ctypes.util.find_library('pthread'))
+_start_routine = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p)
+
+def call_from_foreign_threads(func, times):
+  """Calls func() times times, each from a new pthread; returns the results"""
+  results = []
+  def run(arg):
+    results.append(func())
+    return None
+  callback = _start_routine(run)
+  for i in xrange(times):
+    thread = ctypes.c_ulong()
+    if _pthread.pthread_create(ctypes.byref(thread), None, callback, None):
+      raise OSError("Couldn't start a thread")
+    _pthread.pthread_join(thread, None)
+  return results
@@ -0,0 +1,87 @@
+"""Generates fake assembly_summary.txt files for tests and benchmarks
+
+Also the files of accessions in them, for fake origins to serve."""
+
+import gzip
+import hashlib
+import os
+
+from random import Random
+from StringIO import StringIO
+
+columns = ['assembly_accession', 'bioproject', 'taxid', 'species_taxid',
+           'organism_name', 'asm_name', 'ftp_path']
+
+syllables = ['ba', 'cil', 'lus', 'strep', 'to', 'coc', 'cus', 'myco', 'bac',
+             'ter', 'ium', 'sal', 'mo', 'nel', 'la', 'pseu', 'do', 'mon',
+             'as', 'chla', 'my', 'dia', 'vib', 'ri', 'o', 'lis', 'te', 'ria']
+
+def _word(random, length):
+  return "".join(random.choice(syllables) for i in xrange(length))
+
+def write_assembly_summary(output_file, rows, genera=500, species_per_genus=20,
+                           strains_per_species=50, seed=1,
+                           ftp_root="ftp://ftp.ncbi.nlm.nih.gov/genomes/all"):
+  """Writes a tab separated assembly summary with rows rows
+
+  The taxonomic fan-out is controlled by the number of genera, species
+  in each genus and strains (organism names) of each species"""
+  random = Random(seed)
+  genus_names = [_word(random, 3).capitalize() for i in xrange(genera)]
+  species_names = [_word(random, 3) for i in xrange(species_per_genus)]
+  output_file.write("\t".join(columns) + "\n")
+  for row in xrange(rows):
+    genus_id = random.randrange(genera)
+    species_id = random.randrange(species_per_genus)
+    strain_id = random.randrange(strains_per_species)
+    species_taxid = 1000 + genus_id * species_per_genus + species_id
+    taxid = 1000000 + species_taxid * strains_per_species + strain_id
+    organism_name = "%s %s %s-%s" % (genus_names[genus_id],
+                                     species_names[species_id],
+                                     _word(random, 1).upper(), strain_id)
+    asm_name = "ASM%sv1" % row
+    assembly_accession = "GCA_%09d.1" % row
+    ftp_path = "%s/%s_%s" % (ftp_root, assembly_accession, asm_name)
+    output_file.write("\t".join([assembly_accession, "PRJNA%s" % row,
+                                 str(taxid), str(species_taxid),
+                                 organism_name, asm_name, ftp_path]) + "\n")
+
+def accession_name(row):
+  """The accession directory of row in write_assembly_summary's output"""
+  return "GCA_%09d.1_ASM%sv1" % (row, row)
+
+def write_accession_files(root_dir, accession, genome_size, seed=1):
+  """Writes an accession's files with about genome_size bytes of sequence
+
+  Returns the accession's directory"""
+  random = Random(seed)
+  accession_dir = os.path.join(root_dir, accession)
+  if not os.path.isdir(accession_dir):
+    os.makedirs(accession_dir)
+  line = "".join(random.choice('ACGT') for i in xrange(4096))
+  for suffix in ['genomic.fna.gz', 'genomic.gbff.gz', 'genomic.gff.gz']:
+    with gzip.open(os.path.join(accession_dir, "%s_%s" % (accession, suffix)), 'wb',
+                   compresslevel=1) as f:
+      f.write(">%s\n" % accession)
+      for i in xrange(genome_size // len(line)):
+        # rotate so that the file doesn't compress to nothing
+        offset = random.randrange(len(line))
+        f.write(line[offset:] + line[:offset] + "\n")
+  for suffix in ['assembly_stats.txt', 'assembly_report.txt']:
+    with open(os.path.join(accession_dir, "%s_%s" % (accession, suffix)), 'w') as f:
+      f.write("# Assembly name: %s\n" % accession)
+  with open(os.path.join(accession_dir, 'README.txt'), 'w') as f:
+    f.write("Synthetic accession for benchmarks\n")
+  with open(os.path.join(accession_dir, 'md5checksums.txt'), 'w') as checksums:
+    for filename in sorted(os.listdir(accession_dir)):
+      if filename != 'md5checksums.txt':
+        with open(os.path.join(accession_dir, filename), 'rb') as f:
+          checksums.write("%s  ./%s\n" % (hashlib.md5(f.read()).hexdigest(), filename))
+  return accession_dir
+
+def assembly_summary(rows, **kwargs):
+  """Returns a fake assembly summary as a file like object"""
+  output_file = StringIO()
+  write_assembly_summary(output_file, rows, **kwargs)
+  output_file.seek(0)
+  return output_file
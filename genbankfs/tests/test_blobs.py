@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from genbankfs.blobs import BlobStore
+from genbankfs.eviction import CacheEvictor
+
+class TestBlobStore(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="blobs_for_tests_",
+                                     suffix="_tmp")
+    os.makedirs(os.path.join(self.temp_dir, 'tmp'))
+    self.store = BlobStore(self.temp_dir)
+
+  def add(self, path, contents, store=None):
+    temp_file = tempfile.NamedTemporaryFile(dir=os.path.join(self.temp_dir, 'tmp'),
+                                            delete=False)
+    with temp_file:
+      temp_file.write(contents)
+    (store or self.store).store(temp_file.name, hashlib.md5(contents).hexdigest(), path)
+
+  def read(self, path):
+    with open(os.path.join(self.temp_dir, path)) as f:
+      return f.read()
+
+  def blobs(self):
+    return list(self.store._blob_paths())
+
+  def test_identical_files_are_stored_once(self):
+    self.add('GCA_1.1/README.txt', 'readme' * 100)
+    self.add('GCA_1.2/README.txt', 'readme' * 100)
+    self.add('GCA_1.2/other', 'other')
+    self.assertEqual(self.read('GCA_1.2/README.txt'), 'readme' * 100)
+    self.assertEqual(len(self.blobs()), 2)
+    self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+    stats = self.store.stats()
+    self.assertEqual((stats['blobs'], stats['hits'], stats['misses']), (2, 1, 2))
+    self.assertEqual(stats['saved_bytes'], 600)
+
+  def test_unlink_is_reference_counted(self):
+    self.add('GCA_1.1/README.txt', 'readme')
+    self.add('GCA_1.2/README.txt', 'readme')
+    self.store.unlink('GCA_1.1/README.txt')
+    self.assertEqual(len(self.blobs()), 1)
+    self.assertEqual(self.read('GCA_1.2/README.txt'), 'readme')
+    BlobStore(self.temp_dir).unlink('GCA_1.2/README.txt') # after a restart
+    self.assertEqual(self.blobs(), [])
+
+  def test_collect(self):
+    self.add('GCA_1.1/README.txt', 'readme')
+    os.remove(os.path.join(self.temp_dir, 'GCA_1.1/README.txt'))
+    self.assertEqual(self.store.collect(), 1)
+    self.assertEqual(self.blobs(), [])
+
+  def test_evictor_counts_shared_files_once(self):
+    self.add('GCA_1.1/README.txt', 'r' * 100)
+    self.add('GCA_1.2/README.txt', 'r' * 100)
+    self.add('GCA_1.2/other', 'o' * 100)
+    evictor = CacheEvictor(self.temp_dir, max_bytes=150, low_water=1.0,
+                           blob_store=self.store)
+    evictor.scan()
+    self.assertEqual(evictor.total_bytes, 200)
+    for path, last_access in [('GCA_1.1/README.txt', 1), ('GCA_1.2/README.txt', 2),
+                              ('GCA_1.2/other', 3)]:
+      evictor.files[path][1] = last_access
+    # both links have to go before the space comes back
+    self.assertEqual(evictor.evict(), ['GCA_1.1/README.txt', 'GCA_1.2/README.txt'])
+    self.assertEqual(evictor.total_bytes, 100)
+    self.assertEqual(len(self.blobs()), 1)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,7 +17,7 @@ def get_download_mock(download_trigger):
   class DownloadMock(object):
     def __init__(self, *args, **kwargs):
       self.temp_files = []
-    def retrieve_tempfile(self, url, temp_dir, *args, **kwargs):
+    def retrieve_tempfile(self, url, temp_dir, progress=None, *args, **kwargs):
       download_trigger.wait()
       output_file = tempfile.NamedTemporaryFile(mode='w',
                                                 prefix="fake_download_",
@@ -26,10 +26,34 @@ def get_download_mock(download_trigger):
                                                 delete=False)
       output_file.write("This is a fake file")
       output_file.close()
+      if progress:
+        progress(output_file.name, len("This is a fake file"))
       self.temp_files.append(output_file)
       return output_file, None
   return DownloadMock
 
+def get_streaming_download_mock(chunks, chunk_triggers, download_count):
+  class StreamingDownloadMock(object):
+    def __init__(self, *args, **kwargs):
+      pass
+    def retrieve_tempfile(self, url, temp_dir, progress=None, *args, **kwargs):
+      download_count.append(url)
+      output_file = tempfile.NamedTemporaryFile(mode='w',
+                                                prefix="fake_download_",
+                                                suffix=".tmp",
+                                                dir=temp_dir,
+                                                delete=False)
+      bytes_written = 0
+      for chunk, trigger in zip(chunks, chunk_triggers):
+        trigger.wait()
+        output_file.write(chunk)
+        output_file.flush()
+        bytes_written += len(chunk)
+        progress(output_file.name, bytes_written)
+      output_file.close()
+      return output_file, None
+  return StreamingDownloadMock
+
 class TestParsePath(unittest.TestCase):
   def setUp(self):
     self.download_trigger = Event()
@@ -42,8 +66,7 @@ class TestParsePath(unittest.TestCase):
 
   def queue_contents(self, path, queue):
     fh = self.cache.open(path, os.O_RDONLY)
-    os.lseek(fh, 0, 0)
-    contents = os.read(fh, 1000)
+    contents = self.cache.read(1000, 0, fh)
     queue.put(contents)
   
   def list_contents(self, queue):
@@ -60,6 +83,23 @@ class TestParsePath(unittest.TestCase):
     expected = "This is a fake file"
     self.assertEqual(actual, expected)
 
+  def test_read_is_positional(self):
+    self.download_trigger.set()
+    fh = self.cache.open('foo', os.O_RDONLY)
+    self.assertEqual(self.cache.read(4, 10, fh), "fake")
+    self.assertEqual(self.cache.read(4, 0, fh), "This")
+    self.assertEqual(os.lseek(fh, 0, os.SEEK_CUR), 0)
+    self.assertEqual(self.cache.read(100, 15, fh), "file")
+    self.assertEqual(self.cache.read(100, 1000, fh), "")
+
+  def test_release(self):
+    self.download_trigger.set()
+    fh = self.cache.open('foo', os.O_RDONLY)
+    self.assertIn(fh, self.cache.handles)
+    self.cache.release(fh)
+    self.assertNotIn(fh, self.cache.handles)
+    self.assertRaises(OSError, os.fstat, fh)
+
   def test_open_10(self):
     queue = Queue()
     threads = [Thread(target=self.queue_contents, args=("foo_%s" % i, queue))
@@ -69,7 +109,7 @@ class TestParsePath(unittest.TestCase):
     contents = self.list_contents(queue)
     self.assertEqual(contents, [])
     time.sleep(0.1)
-    self.assertEqual(self.cache.download_queue.qsize(), 8)
+    self.assertEqual(self.cache.scheduler.qsize(), 8)
     self.download_trigger.set()
     for thread in threads:
       thread.join()
@@ -86,7 +126,7 @@ class TestParsePath(unittest.TestCase):
     contents = self.list_contents(queue)
     self.assertEqual(contents, [])
     time.sleep(0.1)
-    self.assertEqual(self.cache.download_queue.qsize(), 10)
+    self.assertEqual(self.cache.scheduler.qsize(), 10)
     self.download_trigger.set()
     for thread in threads:
       thread.join()
@@ -105,7 +145,7 @@ class TestParsePath(unittest.TestCase):
     error_message = genbankfs.cache.download_queue_warning
     error_message = error_message % {'max_downloads': 10}
     self.assertEqual(contents, [error_message])
-    self.assertEqual(self.cache.download_queue.qsize(), 10)
+    self.assertEqual(self.cache.scheduler.qsize(), 10)
     self.download_trigger.set()
     for thread in threads:
       thread.join()
@@ -124,7 +164,7 @@ class TestParsePath(unittest.TestCase):
     error_message = genbankfs.cache.download_queue_warning
     error_message = error_message % {'max_downloads': 10}
     self.assertEqual(contents, [error_message]*88)
-    self.assertEqual(self.cache.download_queue.qsize(), 10)
+    self.assertEqual(self.cache.scheduler.qsize(), 10)
     self.download_trigger.set()
     for thread in threads:
       thread.join()
@@ -133,12 +173,108 @@ class TestParsePath(unittest.TestCase):
     self.assertEqual(contents, expected)
 
     # expect 12 downloads (10 queued, 2 from threads)
-    # plus a directory for the tmp files
+    # plus a directory for the tmp files, the size index, the
+    # download journal and its lock and the blob store and its index
     cache_contents = os.listdir(self.temp_dir)
-    self.assertEqual(len(cache_contents), 13)
+    self.assertEqual(len(cache_contents), 18)
+
+  def test_prefetches_dont_block_reads(self):
+    running = [self.cache.prefetch("running_%s" % i) for i in xrange(2)]
+    deadline = time.time() + 5
+    while self.cache.scheduler.qsize() and time.time() < deadline:
+      time.sleep(0.01)
+    prefetches = [self.cache.prefetch("prefetch_%s" % i) for i in xrange(11)]
+    self.assertEqual(prefetches.count(None), 1) # the prefetch queue is full
+    queue = Queue()
+    reader = Thread(target=self.queue_contents, args=("foo", queue))
+    reader.start()
+    time.sleep(0.1)
+    self.assertEqual(self.list_contents(queue), [])
+    self.assertEqual(self.cache.scheduler.qsize(), 11)
+    self.download_trigger.set()
+    reader.join()
+    self.assertEqual(self.list_contents(queue), ["This is a fake file"])
+    # so that tearDown doesn't remove the cache under them
+    for download in running + prefetches:
+      if download is not None:
+        download.wait(lambda: False, timeout=5)
 
   def tearDown(self):
     self.download_trigger.set()
+    self.cache.close()
+    shutil.rmtree(self.temp_dir)
+    genbankfs.cache.DownloadWithExceptions = self.original_DownloadWithExceptions
+
+class TestStreaming(unittest.TestCase):
+  def setUp(self):
+    self.chunk_triggers = [Event(), Event()]
+    self.download_count = []
+    self.original_DownloadWithExceptions = genbankfs.cache.DownloadWithExceptions
+    genbankfs.cache.DownloadWithExceptions = get_streaming_download_mock(["first ", "second"],
+                                                                         self.chunk_triggers,
+                                                                         self.download_count)
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="cache_for_tests_",
+                                     suffix="_tmp")
+    self.cache = GenbankCache(self.temp_dir, lambda p: "www.fake.com" + p, 10)
+
+  def test_read_before_download_finishes(self):
+    self.chunk_triggers[0].set()
+    fh = self.cache.open('foo', os.O_RDONLY)
+    self.assertEqual(self.cache.read(6, 0, fh), "first ")
+    self.assertFalse(os.path.isfile(os.path.join(self.temp_dir, 'foo')))
+    self.chunk_triggers[1].set()
+    self.assertEqual(self.cache.read(100, 6, fh), "second")
+    self.cache.release(fh)
+    time.sleep(0.1)
+    self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, 'foo')))
+
+  def test_read_blocks_for_missing_range(self):
+    self.chunk_triggers[0].set()
+    fh = self.cache.open('foo', os.O_RDONLY)
+    queue = Queue()
+    reader = Thread(target=lambda: queue.put(self.cache.read(6, 6, fh)))
+    reader.start()
+    time.sleep(0.1)
+    self.assertTrue(queue.empty())
+    self.chunk_triggers[1].set()
+    reader.join()
+    self.assertEqual(queue.get_nowait(), "second")
+
+  def test_shared_download(self):
+    self.chunk_triggers[0].set()
+    fh_1 = self.cache.open('foo', os.O_RDONLY)
+    fh_2 = self.cache.open('foo', os.O_RDONLY)
+    self.chunk_triggers[1].set()
+    self.assertEqual(self.cache.read(100, 0, fh_1), "first second")
+    self.assertEqual(self.cache.read(100, 0, fh_2), "first second")
+    self.assertEqual(len(self.download_count), 1)
+
+  def test_metrics(self):
+    for trigger in self.chunk_triggers:
+      trigger.set()
+    fh = self.cache.open('foo', os.O_RDONLY)
+    self.assertEqual(self.cache.read(100, 0, fh), "first second")
+    for i in xrange(100):
+      if self.cache.is_cached('foo'):
+        break
+      time.sleep(0.01)
+    fh = self.cache.open('foo', os.O_RDONLY)
+    self.assertEqual(self.cache.read(5, 0, fh), "first")
+    metrics = self.cache.metrics
+    self.assertEqual(metrics.value('genbankfs_cache_opens_total', result='miss'), 1)
+    self.assertEqual(metrics.value('genbankfs_cache_opens_total', result='hit'), 1)
+    self.assertEqual(metrics.value('genbankfs_served_bytes_total'), 17)
+    self.assertEqual(metrics.value('genbankfs_downloaded_bytes_total', origin='upstream'), 12)
+    self.assertEqual(metrics.value('genbankfs_downloads_total', result='ok'), 1)
+    self.assertEqual(metrics.histogram('genbankfs_queue_wait_seconds',
+                                       priority='foreground').count, 1)
+    self.assertIn('genbankfs_queue_depth{priority="foreground"} 0\n', metrics.render())
+
+  def tearDown(self):
+    for trigger in self.chunk_triggers:
+      trigger.set()
+    self.cache.close()
     shutil.rmtree(self.temp_dir)
     genbankfs.cache.DownloadWithExceptions = self.original_DownloadWithExceptions
 
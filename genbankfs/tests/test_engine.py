@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Queue import Queue
+
+from genbankfs import GenbankCache
+from genbankfs.engine import Cancelled, DownloadEngine
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin, make_accession
+
+class TestEngine(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="engine_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    self.files = dict(("file_%s" % i, str(i) * (20000 * i)) for i in xrange(1, 10))
+    make_accession(self.origin_dir, 'GCA_1', self.files)
+    self.engine = DownloadEngine(max_transfers=4, timeout=5)
+
+  def fetch_all(self, urls):
+    results = Queue()
+    progress = {}
+    def record_progress(temp_path, bytes_written):
+      progress[temp_path] = bytes_written
+    def finished(url):
+      def callback(temp_file, error):
+        self.engine.release_slot()
+        if temp_file is not None:
+          with open(temp_file.name) as f:
+            contents = f.read()
+          temp_file.close()
+          results.put((url, contents))
+        else:
+          results.put((url, error))
+      return callback
+    for url in urls:
+      self.engine.acquire_slot()
+      self.engine.fetch(url, os.path.join(self.temp_dir, 'tmp'), record_progress,
+                        finished(url))
+    contents = dict(results.get(timeout=10) for url in urls)
+    return contents, progress
+
+  def check_downloads(self, origin):
+    urls = ["%s/GCA_1/%s" % (origin.url, filename) for filename in sorted(self.files)]
+    contents, progress = self.fetch_all(urls)
+    for filename, expected in self.files.items():
+      self.assertEqual(contents["%s/GCA_1/%s" % (origin.url, filename)], expected)
+    self.assertEqual(sorted(progress.values()), sorted(map(len, self.files.values())))
+    self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+    missing, _ = self.fetch_all([origin.url + "/GCA_1/missing"])
+    self.assertIsInstance(missing.values()[0], IOError)
+
+  def test_http(self):
+    with HTTPOrigin(self.origin_dir, keep_alive=True) as origin:
+      self.check_downloads(origin)
+      # The second round reuses the connections from the first
+      connections = origin.connections
+      self.fetch_all([origin.url + "/GCA_1/file_1"])
+      self.assertEqual(origin.connections, connections)
+
+  def test_ftp(self):
+    with FTPOrigin(self.origin_dir) as origin:
+      self.check_downloads(origin)
+      commands = [command for command, argument in origin.commands]
+      self.assertEqual(commands.count('RETR'), len(self.files) + 1)
+      self.assertEqual(commands.count('USER'), origin.connections)
+      self.assertTrue(origin.connections <= 4) # one per slot
+
+  def test_cancel(self):
+    with HTTPOrigin(self.origin_dir, latency=1) as origin:
+      results = Queue()
+      task = self.engine.fetch(origin.url + "/GCA_1/file_1", os.path.join(self.temp_dir, 'tmp'),
+                               lambda *args: None,
+                               lambda temp_file, error: results.put((temp_file, error)))
+      self.engine.cancel(task)
+      temp_file, error = results.get(timeout=5)
+      self.assertIsNone(temp_file)
+      self.assertIsInstance(error, Cancelled)
+      self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+
+  def test_timeout(self):
+    self.engine = DownloadEngine(timeout=0.2)
+    with HTTPOrigin(self.origin_dir, latency=1) as origin:
+      contents, _ = self.fetch_all([origin.url + "/GCA_1/file_1"])
+      self.assertIsInstance(contents.values()[0], IOError)
+
+  def test_cache(self):
+    with FTPOrigin(self.origin_dir) as origin:
+      cache = GenbankCache(os.path.join(self.temp_dir, 'cache'),
+                           lambda p: origin.url + '/' + p, 10, event_loop=True,
+                           max_transfers=4)
+      try:
+        for filename, expected in sorted(self.files.items()):
+          fh = cache.open('GCA_1/' + filename, os.O_RDONLY)
+          self.assertEqual(cache.read(len(expected) + 1, 0, fh), expected)
+          cache.release(fh)
+        self.assertTrue(cache.is_cached('GCA_1/file_9'))
+      finally:
+        cache.close()
+
+  def tearDown(self):
+    self.engine.stop()
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from genbankfs import GenbankCache
+from genbankfs.eviction import CacheEvictor
+from genbankfs.tests.fake_origin import HTTPOrigin, make_accession
+
+def wait_for(predicate, timeout=5):
+  deadline = time.time() + timeout
+  while not predicate() and time.time() < deadline:
+    time.sleep(0.01)
+  return predicate()
+
+class TestEviction(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="eviction_for_tests_",
+                                     suffix="_tmp")
+    self.cache_dir = os.path.join(self.temp_dir, 'cache')
+    make_accession(self.cache_dir, 'GCA_1', {'a': 'a' * 100, 'b': 'b' * 100})
+    make_accession(self.cache_dir, 'GCA_2', {'c': 'c' * 100})
+    make_accession(self.cache_dir, 'partial', {'d': 'd' * 1000})
+
+  def set_access_times(self, evictor, times):
+    for path, last_access in times.items():
+      evictor.files[path][1] = last_access
+
+  def cached_files(self):
+    return sorted(os.path.join(os.path.basename(directory), filename)
+                  for directory, _, filenames in os.walk(self.cache_dir)
+                  for filename in filenames
+                  if not directory.endswith('partial'))
+
+  def test_scan(self):
+    evictor = CacheEvictor(self.cache_dir, max_bytes=1000)
+    evictor.scan()
+    self.assertEqual(sorted(evictor.files), ['GCA_1/a', 'GCA_1/b', 'GCA_2/c'])
+    self.assertEqual(evictor.total_bytes, 300)
+    self.assertFalse(evictor.over_capacity())
+
+  def test_lru(self):
+    evictor = CacheEvictor(self.cache_dir, max_bytes=150)
+    evictor.scan()
+    self.set_access_times(evictor, {'GCA_1/a': 3, 'GCA_1/b': 1, 'GCA_2/c': 2})
+    self.assertEqual(evictor.evict(), ['GCA_1/b', 'GCA_2/c'])
+    self.assertEqual(self.cached_files(), ['GCA_1/a'])
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'GCA_2')))
+    self.assertEqual(evictor.total_bytes, 100)
+
+  def test_max_files(self):
+    evictor = CacheEvictor(self.cache_dir, max_files=2, low_water=1.0)
+    evictor.scan()
+    self.set_access_times(evictor, {'GCA_1/a': 1, 'GCA_1/b': 3, 'GCA_2/c': 2})
+    self.assertEqual(evictor.evict(), ['GCA_1/a'])
+
+  def test_size_policy(self):
+    with open(os.path.join(self.cache_dir, 'GCA_1', 'a'), 'w') as f:
+      f.write('a' * 1000)
+    evictor = CacheEvictor(self.cache_dir, max_bytes=1000, policy='size')
+    evictor.scan()
+    now = time.time()
+    self.set_access_times(evictor, {'GCA_1/a': now - 10, 'GCA_1/b': now - 50,
+                                    'GCA_2/c': now - 60})
+    self.assertEqual(evictor.evict(), ['GCA_1/a'])
+
+  def test_pinned_files_are_kept(self):
+    evictor = CacheEvictor(self.cache_dir, max_bytes=150,
+                           pinned_func=lambda: set(['GCA_1/b']))
+    evictor.scan()
+    self.set_access_times(evictor, {'GCA_1/a': 3, 'GCA_1/b': 1, 'GCA_2/c': 2})
+    self.assertEqual(evictor.evict(), ['GCA_2/c', 'GCA_1/a'])
+    self.assertEqual(self.cached_files(), ['GCA_1/b'])
+
+  def test_access_times_are_persisted(self):
+    evictor = CacheEvictor(self.cache_dir, max_bytes=1000)
+    evictor.scan()
+    self.set_access_times(evictor, {'GCA_1/a': 3, 'GCA_1/b': 1, 'GCA_2/c': 2})
+    evictor.save()
+    reloaded = CacheEvictor(self.cache_dir, max_bytes=1000)
+    reloaded.scan()
+    self.assertEqual(reloaded.files['GCA_1/b'][:2], [100, 1])
+    self.assertEqual(reloaded.files['GCA_1/a'][:2], [100, 3])
+
+  def test_admission(self):
+    evictor = CacheEvictor(self.cache_dir, max_bytes=1000)
+    evictor.scan()
+    make_accession(self.cache_dir, 'GCA_3', {'big': 'x' * 600})
+    evictor.add('GCA_3/big', 600)
+    self.assertTrue(evictor.wake.is_set())
+    evictor.touch('GCA_3/big') # doesn't let it in
+    self.assertEqual(evictor.unadmitted, 1)
+    self.assertEqual(evictor.evict(), ['GCA_3/big'])
+    self.assertEqual(evictor.total_bytes, 300)
+    self.assertEqual(evictor.unadmitted, 0)
+
+  def test_cache_keeps_open_files(self):
+    origin_dir = os.path.join(self.temp_dir, 'origin')
+    make_accession(origin_dir, 'GCA_4', {'x': 'x' * 200, 'y': 'y' * 200})
+    with HTTPOrigin(origin_dir) as origin:
+      lookup = lambda path: "%s/%s" % (origin.url, path)
+      cache = GenbankCache(self.cache_dir, lookup, discover_sizes=False,
+                           max_cache_bytes=500)
+      self.assertTrue(cache.evictor.loaded.wait(5))
+      cache.evictor.touch('GCA_1/a')
+      fh = cache.open('GCA_4/x', os.O_RDONLY)
+      self.assertEqual(cache.read(200, 0, fh), 'x' * 200)
+      self.assertTrue(wait_for(lambda: 'GCA_4/x' in cache.evictor.files))
+      fh2 = cache.open('GCA_4/y', os.O_RDONLY)
+      self.assertEqual(cache.read(200, 0, fh2), 'y' * 200)
+      self.assertTrue(wait_for(lambda: not cache.evictor.over_capacity(0.9)))
+      self.assertTrue(os.path.isfile(os.path.join(self.cache_dir, 'GCA_4', 'x')))
+      self.assertTrue(os.path.isfile(os.path.join(self.cache_dir, 'GCA_4', 'y')))
+      cache.release(fh)
+      cache.release(fh2)
+      cache.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
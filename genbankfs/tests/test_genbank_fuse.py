@@ -1,11 +1,16 @@
 #!/usr/bin/env python2
 
+import ctypes
+import os
 import unittest
 
+from errno import ENOENT
+from fuse import FUSE, FuseOSError
 from mock import patch, MagicMock
 
-from genbankfs import GenbankFuse
-from genbankfs.genbank_fuse import PathParseResult
+from genbankfs import GenbankFuse, GenbankSearch
+from genbankfs.genbank_fuse import PagedFUSE, PathParseResult
+from genbankfs.tests.synthetic import assembly_summary
 
 def fake_path_join(*args):
   return '/'.join(args)
@@ -152,5 +157,234 @@ class TestParsePath(unittest.TestCase):
     expected = PathParseResult('ABC/README.txt', None, [], expected_query)
     self.assertEqual(result, expected)
 
+  def test_decompressed_views(self):
+    listing = list(self.fuse.listdir('/accession/ABC'))
+    self.assertIn('ABC_genomic.fna.gz', listing)
+    self.assertIn('ABC_genomic.fna', listing)
+    self.assertNotIn('README.txt.gz', listing)
+    result = self.fuse.parse_path('/accession/ABC/ABC_genomic.gff')
+    self.assertEqual(result.file_path, 'ABC/ABC_genomic.gff')
+
+class TestCaching(unittest.TestCase):
+  def setUp(self):
+    self.searcher = MagicMock()
+    self.searcher.folders = ['species_taxid',
+                             'taxid',
+                             'organism_name',
+                             'genus',
+                             'species',
+                             'accession']
+    self.searcher.listing.return_value = ['1000', '1001']
+    self.fuse = GenbankFuse(self.searcher, MagicMock(), parse_cache_size=2)
+
+  def test_parse_path_is_cached(self):
+    first = self.fuse.parse_path('/genus/foo/taxid')
+    second = self.fuse.parse_path('/genus/foo/taxid')
+    self.assertIs(first, second)
+    stats = self.fuse.cache_stats()['parse_path']
+    self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+  def test_parse_path_cache_is_bounded(self):
+    for path in ['/genus', '/taxid', '/species', '/genus']:
+      self.fuse.parse_path(path)
+    stats = self.fuse.cache_stats()['parse_path']
+    self.assertEqual(stats['size'], 2)
+    self.assertEqual((stats['hits'], stats['misses']), (0, 4))
+
+  def test_readdir_is_cached(self):
+    expected = ['.', '..', '1000', '1001']
+    self.assertEqual(list(self.fuse.listdir('/genus/foo/taxid')), expected)
+    self.assertEqual(list(self.fuse.listdir('/genus/foo/./taxid')), expected)
+    self.assertEqual(self.searcher.listing.call_count, 1)
+    self.fuse.readdir('/genus/bar/taxid', None)
+    self.assertEqual(self.searcher.listing.call_count, 2)
+    stats = self.fuse.cache_stats()['readdir']
+    self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+  def test_stats_file(self):
+    self.fuse('readdir', '/genus/foo/taxid', None)
+    fh = self.fuse('open', '/.stats', os.O_RDONLY)
+    other_fh = self.fuse('open', '/.stats', os.O_RDONLY)
+    self.fuse('getattr', '/.stats')
+    attributes = self.fuse('getattr', '/.stats', fh)
+    stats = self.fuse('read', '/.stats', 10**6, 0, fh)
+    other_stats = self.fuse('read', '/.stats', 10**6, 0, other_fh)
+    # each handle has its own snapshot and its size
+    self.assertEqual(attributes['st_size'], len(stats))
+    self.assertNotEqual(stats, other_stats)
+    self.assertEqual(self.fuse('getattr', '/.stats', other_fh)['st_size'], len(other_stats))
+    self.fuse('release', '/.stats', fh)
+    self.fuse('release', '/.stats', other_fh)
+    self.assertIn('genbankfs_fuse_op_seconds_count{op="readdir"} 1\n', stats)
+    self.assertIn('genbankfs_search_seconds_count{folder="taxid"} 1\n', stats)
+    # the directory and its parent (for the inode of ..)
+    self.assertIn('genbankfs_parse_path_seconds_count 2\n', stats)
+    self.assertEqual(self.fuse.stats_files, {})
+
+class TestAttributes(unittest.TestCase):
+  def setUp(self):
+    self.searcher = MagicMock()
+    self.searcher.folders = ['species_taxid', 'taxid', 'genus', 'accession']
+    self.cache = MagicMock()
+    self.cache.getattr.return_value = dict(st_size=10, st_mtime=1)
+    self.fuse = GenbankFuse(self.searcher, self.cache)
+
+  def test_inodes_are_stable(self):
+    other_fuse = GenbankFuse(self.searcher, self.cache)
+    paths = ['/genus', '/genus/foo', '/genus/foo/taxid', '/taxid/1/genus/foo',
+             '/accession/ABC/README.txt']
+    inodes = [self.fuse.getattr(path)['st_ino'] for path in paths]
+    self.assertEqual(inodes, [other_fuse.getattr(path)['st_ino'] for path in paths])
+    self.assertEqual(len(set(inodes)), len(paths))
+    self.assertTrue(all(inode > 1 for inode in inodes))
+    self.assertEqual(self.fuse.getattr('/')['st_ino'], 1)
+    self.assertEqual(dict((name, attributes['st_ino']) for name, attributes, offset
+                          in self.fuse.readdir('/genus', None))['..'], 1)
+    self.assertEqual(self.fuse.getattr('/genus/foo/./taxid/')['st_ino'], inodes[2])
+    # the same file has the same inode wherever it's listed
+    self.assertEqual(self.fuse.getattr('/genus/foo/accession/ABC/README.txt')['st_ino'],
+                     inodes[4])
+    self.assertNotEqual(self.fuse.getattr('/accession/ABC/ABC_genomic.fna.gz')['st_ino'],
+                        inodes[4])
+
+  def test_timestamps_are_fixed(self):
+    first = self.fuse.getattr('/genus/foo')
+    with patch('genbankfs.genbank_fuse.time', return_value=self.fuse.mount_time + 60):
+      second = self.fuse.getattr('/genus/bar')
+    for key in ['st_mtime', 'st_ctime', 'st_atime']:
+      self.assertEqual(first[key], self.fuse.mount_time)
+      self.assertEqual(second[key], self.fuse.mount_time)
+    attributes = self.fuse.getattr('/accession/ABC/README.txt')
+    self.assertEqual(attributes['st_mtime'], 1)
+    self.assertEqual(self.cache.getattr.return_value, dict(st_size=10, st_mtime=1))
+
+class TestPagedReaddir(unittest.TestCase):
+  def setUp(self):
+    self.searcher = GenbankSearch(assembly_summary(1000, genera=5))
+    cache = MagicMock()
+    cache.getattr.return_value = dict(st_mode=(0100000 | 0444), st_size=10)
+    self.fuse = GenbankFuse(self.searcher, cache, readdir_page_size=100, paged=True)
+
+  def test_pages(self):
+    names = []
+    offset = 0
+    pages = 0
+    while True:
+      entries = self.fuse('readdir', '/accession', None, offset)
+      if not entries:
+        break
+      self.assertLessEqual(len(entries), 100)
+      for name, attributes, next_offset in entries:
+        self.assertEqual(next_offset, offset + 1)
+        names.append(name)
+        offset = next_offset
+      pages += 1
+    self.assertEqual(pages, 11)
+    self.assertEqual(names, ['.', '..'] + self.searcher.list('accession'))
+    self.assertEqual(names[150:155], list(self.fuse.listdir('/accession'))[150:155])
+    self.assertEqual(self.fuse('readdir', '/accession', None, 1000)[0][0], names[1000])
+
+  def test_unpaged(self):
+    # as fusepy's FUSE calls it, without an offset
+    self.fuse.paged = False
+    entries = self.fuse('readdir', '/accession', None)
+    self.assertEqual([name for name, attributes, offset in entries],
+                     ['.', '..'] + self.searcher.list('accession'))
+    self.assertEqual(set(offset for name, attributes, offset in entries), set([0]))
+    self.assertEqual(len(list(self.fuse.listdir('/accession'))), 1002)
+
+  def test_attributes_are_inline(self):
+    genus = self.searcher.list('genus')[0]
+    for path in ['/', '/genus/%s/species' % genus, '/accession/%s' % self.searcher.list('accession')[0]]:
+      for name, attributes, offset in self.fuse.readdir(path, None)[1:]:
+        child_attributes = self.fuse.getattr(os.path.join(path, name))
+        self.assertEqual(attributes['st_ino'], child_attributes['st_ino'])
+        self.assertEqual(attributes['st_mode'] & 040000, child_attributes['st_mode'] & 040000)
+    self.assertEqual(self.fuse.readdir('/', None)[0][1]['st_ino'], self.fuse.getattr('/')['st_ino'])
+
+  def test_listed_paths_exist_without_searching(self):
+    genus = self.searcher.list('genus')[0]
+    species = list(self.fuse.listdir('/genus/%s/species' % genus))[2:]
+    with patch.object(self.searcher, 'exists', wraps=self.searcher.exists) as exists:
+      for name in species:
+        self.fuse.getattr('/genus/%s/species/%s' % (genus, name))
+    # only the genus is looked up, the species are found in the listing
+    self.assertTrue(species)
+    self.assertEqual([kwargs.keys() for args, kwargs in exists.call_args_list],
+                     [['genus']] * len(species))
+
+class TestPagedFUSE(unittest.TestCase):
+  def test_sets_paged(self):
+    operations = GenbankFuse(GenbankSearch(assembly_summary(10)), MagicMock())
+    self.assertFalse(operations.paged)
+    with patch.object(FUSE, '__init__', return_value=None) as mount:
+      PagedFUSE(operations, '/mnt', foreground=True)
+    self.assertTrue(operations.paged)
+    mount.assert_called_once_with(operations, '/mnt', foreground=True)
+
+  def test_reads_strings_unless_paged(self):
+    cache = MagicMock()
+    cache.read.return_value = 'GTAC'
+    cache.read_view.return_value = buffer('ACGTACGT', 2, 4)
+    operations = GenbankFuse(GenbankSearch(assembly_summary(10)), cache)
+    self.assertEqual(operations('read', '/accession/ABC/README.txt', 4, 2, 3), 'GTAC')
+    cache.read.assert_called_once_with(4, 2, 3)
+    operations.paged = True
+    self.assertIsInstance(operations('read', '/accession/ABC/README.txt', 4, 2, 3), buffer)
+    cache.read_view.assert_called_once_with(4, 2, 3)
+
+  def test_read_copies_buffers(self):
+    fuse = PagedFUSE.__new__(PagedFUSE) # without mounting anything
+    fuse._decode_optional_path = lambda path: path
+    reads = []
+    def operations(op, *args):
+      reads.append((op,) + args)
+      return buffer('ACGTACGT', 2, 4)
+    fuse.operations = operations
+    buf = ctypes.create_string_buffer(8)
+    fip = MagicMock()
+    fip.contents.fh = 3
+    self.assertEqual(fuse.read('/accession/ABC/README.txt', buf, 8, 2, fip), 4)
+    self.assertEqual(buf.raw[:4], 'GTAC')
+    self.assertEqual(reads, [('read', '/accession/ABC/README.txt', 8, 2, 3)])
+    fuse.operations = lambda op, *args: ''
+    self.assertEqual(fuse.read('/accession/ABC/README.txt', buf, 8, 10, fip), 0)
+
+class TestMissingPaths(unittest.TestCase):
+  def setUp(self):
+    self.searcher = MagicMock()
+    self.searcher.folders = ['taxid', 'genus', 'accession']
+    known_queries = [{'genus': 'foo'}, {'genus': 'foo', 'taxid': '1000'},
+                     {'accession': 'ABC'}, {'genus': 'foo', 'accession': 'ABC'}]
+    self.searcher.exists.side_effect = lambda **query: query in known_queries
+    self.fuse = GenbankFuse(self.searcher, MagicMock())
+
+  def assertMissing(self, op, path, *args):
+    with self.assertRaises(FuseOSError) as context:
+      self.fuse(op, path, *args)
+    self.assertEqual(context.exception.errno, ENOENT)
+
+  def test_missing_paths(self):
+    for path in ['/.git', '/genus/bar', '/genus/foo/.git', '/genus/foo/taxid/2000',
+                 '/genus/foo/genus/foo', '/accession/ABC/taxid',
+                 '/accession/ABC/nonsense.txt', '/accession/ABC/README.txt/foo',
+                 '/genus/foo/taxid/1000/NONSENSE/accession/ABC/README.txt']:
+      self.assertMissing('getattr', path)
+      self.assertMissing('readdir', path, None)
+      self.assertMissing('open', path, os.O_RDONLY)
+    for path in ['/', '/genus', '/genus/foo', '/genus/foo/taxid/1000',
+                 '/genus/foo/taxid/1000/accession', '/genus/foo/accession/ABC',
+                 '/accession/ABC/README.txt']:
+      self.fuse('getattr', path)
+
+  def test_missing_paths_are_cached(self):
+    for i in xrange(3):
+      self.assertMissing('getattr', '/genus/bar/.git')
+    self.assertEqual(self.searcher.exists.call_count, 1)
+    stats = self.fuse.cache_stats()['missing']
+    self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 1, 1))
+    self.fuse('getattr', '/genus/foo')
+    self.assertEqual(self.fuse.cache_stats()['missing']['size'], 1)
+
 if __name__ == '__main__':
   unittest.main()
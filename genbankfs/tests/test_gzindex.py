@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+
+import gzip
+import os
+import random
+import shutil
+import string
+import tempfile
+import unittest
+
+from genbankfs import GenbankCache
+from genbankfs.cache import pread
+from genbankfs.gzindex import WINDOW_SIZE, GzipIndex, GzipIndexError, GzipReader
+from genbankfs.tests.fake_origin import HTTPOrigin, make_accession
+
+def random_sequence(length, seed=1):
+  hex_digits = '%0*x' % (length, random.Random(seed).getrandbits(4 * length))
+  return hex_digits.translate(string.maketrans('0123456789abcdef', 'ACGTACGTACGTACGT'))
+
+def gzip_members(path, members):
+  """Writes each string in members as a separate gzip member"""
+  with open(path, 'wb') as f:
+    for member in members:
+      compressed = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1)
+      compressed.write(member)
+      compressed.close()
+
+class TestGzipIndex(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="gzindex_for_tests_",
+                                     suffix="_tmp")
+    self.data = random_sequence(3 * 1024**2)
+    self.gzip_path = os.path.join(self.temp_dir, 'data.gz')
+    gzip_members(self.gzip_path, [self.data[:10**6], self.data[10**6:]])
+
+  def reader(self, index):
+    fh = os.open(self.gzip_path, os.O_RDONLY)
+    self.addCleanup(os.close, fh)
+    return GzipReader(index, lambda offset, size: pread(fh, size, offset))
+
+  def test_random_reads(self):
+    index = GzipIndex.build(self.gzip_path, span=128*1024)
+    self.assertEqual(index.size, len(self.data))
+    self.assertTrue(len(index.points) > 10)
+    # windows are kept compressed
+    self.assertLess(max(len(point[3]) for point in index.points), WINDOW_SIZE // 2)
+    reader = self.reader(index)
+    generator = random.Random(2)
+    for i in xrange(100):
+      offset = generator.randint(0, len(self.data))
+      size = generator.randint(1, 300000)
+      self.assertEqual(reader.read(size, offset), self.data[offset:offset + size])
+    self.assertEqual(reader.read(100, len(self.data)), '')
+
+  def test_sequential_reads(self):
+    reader = self.reader(GzipIndex.build(self.gzip_path, span=128*1024))
+    chunks = []
+    while True:
+      chunk = reader.read(128*1024, sum(map(len, chunks)))
+      if not chunk:
+        break
+      chunks.append(chunk)
+    self.assertEqual(''.join(chunks), self.data)
+
+  def test_save_and_load(self):
+    index_path = os.path.join(self.temp_dir, 'index', 'data.gz.idx')
+    GzipIndex.build(self.gzip_path, span=128*1024).save(index_path)
+    index = GzipIndex.load(index_path)
+    self.assertTrue(index.matches(self.gzip_path))
+    self.assertEqual(self.reader(index).read(1000, 2 * 10**6),
+                     self.data[2 * 10**6:2 * 10**6 + 1000])
+    with open(self.gzip_path, 'ab') as f:
+      f.write('changed')
+    self.assertFalse(index.matches(self.gzip_path))
+    self.assertIsNone(GzipIndex.load(self.gzip_path))
+    with open(index_path, 'r+b') as f:
+      f.truncate(os.path.getsize(index_path) - 10)
+    self.assertIsNone(GzipIndex.load(index_path))
+
+  def test_truncated(self):
+    with open(self.gzip_path, 'r+b') as f:
+      f.truncate(os.path.getsize(self.gzip_path) // 2)
+    self.assertRaises(GzipIndexError, GzipIndex.build, self.gzip_path)
+
+  def test_cache_view(self):
+    origin_dir = os.path.join(self.temp_dir, 'origin')
+    make_accession(origin_dir, 'GCA_1', {})
+    shutil.copy(self.gzip_path, os.path.join(origin_dir, 'GCA_1', 'GCA_1_genomic.fna.gz'))
+    with HTTPOrigin(origin_dir) as origin:
+      cache = GenbankCache(os.path.join(self.temp_dir, 'cache'),
+                           lambda p: origin.url + '/' + p, discover_sizes=False,
+                           verify_checksums=False)
+      cache.release(cache.open('GCA_1/GCA_1_genomic.fna.gz', os.O_RDONLY))
+      # getattr doesn't decompress the whole file to find out its size
+      self.assertEqual(cache.getattr('GCA_1/GCA_1_genomic.fna')['st_size'],
+                       cache.unknown_size)
+      fh = cache.open('GCA_1/GCA_1_genomic.fna', os.O_RDONLY)
+      self.assertEqual(cache.read(1000, 1500000, fh), self.data[1500000:1501000])
+      self.assertEqual(cache.getattr('GCA_1/GCA_1_genomic.fna')['st_size'], len(self.data))
+      self.assertTrue(cache.is_cached('GCA_1/GCA_1_genomic.fna.gz'))
+      cache.release(fh)
+      self.assertEqual(cache.gzip_locks, {})
+      cache.close()
+    index_path = os.path.join(self.temp_dir, 'cache', 'gzindex', 'GCA_1',
+                              'GCA_1_genomic.fna.gz.idx')
+    self.assertTrue(GzipIndex.load(index_path).size, len(self.data))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
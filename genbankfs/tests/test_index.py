@@ -0,0 +1,66 @@
+#!/usr/bin/env python2
+
+import unittest
+
+import numpy as np
+
+from genbankfs.index import FolderIndex, PrefixTable, StringTable, intersect
+
+class TestFolderIndex(unittest.TestCase):
+  def setUp(self):
+    self.index = FolderIndex.from_column(['b', 'a', 'c', 'a', 'b', 'a'])
+
+  def test_lookup(self):
+    self.assertEqual(list(self.index.lookup('a')), [1, 3, 5])
+    self.assertEqual(list(self.index.lookup('b')), [0, 4])
+    self.assertEqual(list(self.index.lookup('c')), [2])
+    self.assertEqual(list(self.index.lookup('d')), [])
+    self.assertEqual(list(self.index.lookup('0')), [])
+
+  def test_code(self):
+    self.assertEqual(self.index.code('a'), 0)
+    self.assertEqual(self.index.code('c'), 2)
+    self.assertEqual(self.index.code('bb'), None)
+
+  def test_distinct(self):
+    self.assertEqual(self.index.distinct(), ['a', 'b', 'c'])
+    self.assertEqual(self.index.distinct(np.array([0, 1, 4])), ['a', 'b'])
+    self.assertEqual(self.index.distinct(np.array([], dtype=np.int32)), [])
+
+  def test_listing(self):
+    listing = self.index.listing()
+    self.assertEqual((len(listing), listing[:], listing[1:5]), (3, ['a', 'b', 'c'], ['b', 'c']))
+    self.assertTrue('c' in listing)
+    self.assertFalse('d' in listing)
+    listing = self.index.listing(np.array([2, 3, 5]))
+    self.assertEqual((len(listing), listing[:], listing[1:]), (2, ['a', 'c'], ['c']))
+    self.assertEqual((listing[2:], listing[5:9]), ([], []))
+    self.assertTrue('a' in listing)
+    self.assertFalse('b' in listing)
+    self.assertRaises(TypeError, lambda: listing[0])
+
+class TestPrefixTable(unittest.TestCase):
+  def test_urls(self):
+    accessions = StringTable.from_strings(['GCA_1.1_A', 'GCA_2.1_B', 'GCA_3.1_C'])
+    urls = ['ftp://host/all/GCA/000/GCA_1.1_A', 'ftp://host/all/GCA/001/GCA_2.1_B',
+            'ftp://host/all/GCA/000/GCA_3.1_C']
+    table = PrefixTable.from_strings(urls, accessions)
+    self.assertEqual(list(table.prefixes), ['ftp://host/all/GCA/000/',
+                                            'ftp://host/all/GCA/001/'])
+    self.assertEqual(list(table.codes), [0, 1, 0])
+    self.assertEqual(len(table), 3)
+    self.assertEqual(table[1], urls[1])
+    self.assertEqual(table.take(np.array([2, 0])), [urls[2], urls[0]])
+    self.assertRaises(ValueError, PrefixTable.from_strings, ['ftp://host/x'], accessions)
+
+class TestIntersect(unittest.TestCase):
+  def test_intersect(self):
+    row_sets = [np.array([1, 3, 5, 7, 9]), np.array([3, 4, 5]),
+                np.array([0, 3, 5, 10])]
+    self.assertEqual(list(intersect(row_sets)), [3, 5])
+    self.assertEqual(list(intersect([np.array([2, 4])])), [2, 4])
+    self.assertEqual(list(intersect([np.array([2, 4]), np.array([1, 3])])), [])
+    self.assertEqual(list(intersect([np.array([2, 4]), np.array([], dtype=int)])), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python2
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import genbankfs
+
+from genbankfs import GenbankCache
+from genbankfs.integrity import ChecksumIndex, Scrubber, parse_md5checksums
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin, make_accession
+
+def md5(contents):
+  return hashlib.md5(contents).hexdigest()
+
+class TestIntegrity(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="integrity_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    self.cache_dir = os.path.join(self.temp_dir, 'cache')
+    self.files = {'good': 'good file' * 1000, 'bad': 'bad file' * 1000}
+    checksums = "%s  ./good\n%s  ./bad\n" % (md5(self.files['good']), md5('not this'))
+    self.files['md5checksums.txt'] = checksums
+    make_accession(self.origin_dir, 'GCA_1', self.files)
+
+  def test_parse(self):
+    text = "\n".join(["d41d8cd98f00b204e9800998ecf8427e  ./README.txt",
+                      "C0FFEE00C0FFEE00C0FFEE00C0FFEE00 *GCA_1_genomic.fna.gz",
+                      "not a checksum"])
+    self.assertEqual(parse_md5checksums(text),
+                     {'README.txt': 'd41d8cd98f00b204e9800998ecf8427e',
+                      'GCA_1_genomic.fna.gz': 'c0ffee00c0ffee00c0ffee00c0ffee00'})
+
+  def test_index(self):
+    index_path = os.path.join(self.temp_dir, 'checksums.tsv')
+    with HTTPOrigin(self.origin_dir) as origin:
+      index = ChecksumIndex(index_path, lambda p: origin.url + '/' + p)
+      self.assertFalse(index.ready('GCA_1/good'))
+      self.assertIsNone(index.expected('GCA_1/good', fetch=False))
+      self.assertFalse(index.ready('GCA_1/good'))
+      self.assertEqual(index.expected('GCA_1/good'), md5(self.files['good']))
+      self.assertIsNone(index.expected('GCA_1/missing'))
+      self.assertIsNone(index.expected('GCA_2/good')) # no checksums file
+      self.assertTrue(index.ready('GCA_2/good')) # so we don't try again yet
+    index = ChecksumIndex(index_path, lambda p: None)
+    self.assertTrue(index.ready('GCA_1/good'))
+    self.assertEqual(index.expected('GCA_1/good'), md5(self.files['good']))
+
+  def check_cache(self, **kwargs):
+    with FTPOrigin(self.origin_dir) as origin:
+      cache = GenbankCache(self.cache_dir, lambda p: origin.url + '/' + p,
+                           streaming=False, **kwargs)
+      try:
+        fh = cache.open('GCA_1/good', os.O_RDONLY)
+        self.assertEqual(cache.read(100000, 0, fh), self.files['good'])
+        fh = cache.open('GCA_1/bad', os.O_RDONLY)
+        error_message = genbankfs.cache.download_error
+        self.assertEqual(cache.read(100000, 0, fh), error_message)
+        self.assertFalse(cache.is_cached('GCA_1/bad'))
+        retrieved = [argument for command, argument in origin.commands if command == 'RETR']
+        self.assertEqual(retrieved.count('md5checksums.txt'), 1)
+        self.assertEqual(retrieved.count('bad'), 3)
+        self.assertFalse([name for name in os.listdir(os.path.join(self.cache_dir, 'tmp'))
+                          if name.startswith('bad')])
+        if cache.engine is not None:
+          # checksums were fetched on the event loop rather than in a
+          # thread of their own
+          self.assertEqual(cache.job_threads, [])
+      finally:
+        cache.close()
+
+  def test_cache_retries_corrupt_downloads(self):
+    self.check_cache()
+
+  def test_event_loop_retries_corrupt_downloads(self):
+    self.check_cache(event_loop=True)
+
+  def test_scrubber(self):
+    cache_dir = os.path.join(self.temp_dir, 'scrubbed')
+    make_accession(cache_dir, 'GCA_1', {'good': self.files['good'],
+                                        'bad': 'bit rot'})
+    with HTTPOrigin(self.origin_dir) as origin:
+      index = ChecksumIndex(os.path.join(cache_dir, 'checksums.tsv'),
+                            lambda p: origin.url + '/' + p)
+      scrubber = Scrubber(cache_dir, index, rate=10**6)
+      self.assertEqual(scrubber.scan(), ['GCA_1/bad', 'GCA_1/good'])
+      self.assertFalse(scrubber.check('GCA_1/bad'))
+      self.assertTrue(scrubber.check('GCA_1/good'))
+    self.assertEqual(os.listdir(os.path.join(cache_dir, 'GCA_1')), ['good'])
+    scrubber.save()
+    self.assertEqual(Scrubber(cache_dir, index, rate=10**6).scan(), [])
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python2
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from Queue import Queue
+from functools import partial
+
+import genbankfs
+
+from genbankfs import GenbankCache
+from genbankfs.cache import DownloadWithExceptions
+from genbankfs.engine import DownloadEngine
+from genbankfs.journal import DownloadJournal
+from genbankfs.origins import CacheServer, OriginChain, PeerOrigin, UpstreamOrigin
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin, make_accession
+
+class TestDownloadJournal(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="journal_for_tests_",
+                                     suffix="_tmp")
+    os.makedirs(os.path.join(self.temp_dir, 'tmp'))
+
+  def write_partial(self, temp_path, contents):
+    with open(temp_path, 'wb') as f:
+      f.write(contents)
+
+  def test_entries_survive_restarts(self):
+    journal = DownloadJournal(self.temp_dir, checkpoint_bytes=10)
+    temp_path = journal.start('GCA_1/a', 'http://example.com/GCA_1/a', size=100, md5='abc')
+    journal.start('GCA_1/b', 'http://example.com/GCA_1/b')
+    journal.progress(temp_path, 5) # too soon to be recorded
+    journal.progress(temp_path, 20)
+    journal.finish('GCA_1/b')
+    journal.close()
+    journal = DownloadJournal(self.temp_dir)
+    self.assertEqual(journal.interrupted(), ['GCA_1/a'])
+    self.assertEqual(journal.entries[temp_path],
+                     ('GCA_1/a', 'http://example.com/GCA_1/a', 20, 100, 'abc'))
+    with open(journal.journal_path) as f:
+      self.assertEqual(len(f.readlines()), 1) # rewritten without the rest
+    journal.close()
+
+  def test_partial_downloads_are_kept_if_nothing_changed(self):
+    journal = DownloadJournal(self.temp_dir, checkpoint_bytes=1)
+    url = 'http://example.com/GCA_1/a'
+    temp_path = journal.start('GCA_1/a', url, size=100, md5='abc')
+    self.write_partial(temp_path, 'ACGT')
+    journal.progress(temp_path, 4)
+    self.assertEqual(journal.start('GCA_1/a', url, size=100), temp_path)
+    self.assertEqual(os.path.getsize(temp_path), 4)
+    # from somewhere else, which doesn't get in the way
+    mirror_path = journal.start('GCA_1/a', 'http://mirror.example.com/GCA_1/a', size=100)
+    self.assertNotEqual(mirror_path, temp_path)
+    self.assertEqual(journal.start('GCA_1/a', url, size=100), temp_path)
+    self.assertEqual(os.path.getsize(temp_path), 4)
+    # the file has changed upstream
+    journal.start('GCA_1/a', url, size=100, md5='def')
+    self.assertEqual(os.path.getsize(temp_path), 0)
+    # less than we'd recorded made it to disk
+    journal.progress(temp_path, 4)
+    self.write_partial(temp_path, 'AC')
+    journal.start('GCA_1/a', url, size=100, md5='def')
+    self.assertEqual(os.path.getsize(temp_path), 0)
+    # finishing tidies up whatever came from elsewhere
+    self.write_partial(mirror_path, 'ACGT')
+    os.remove(temp_path) # moved into the cache
+    journal.finish('GCA_1/a')
+    self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+    journal.close()
+
+  def test_collect(self):
+    journal = DownloadJournal(self.temp_dir)
+    temp_path = journal.start('GCA_1/a', 'http://example.com/GCA_1/a')
+    self.write_partial(temp_path, 'ACGT')
+    for filename in ['warning.tmp', 'orphan.tmp', 'a_1234.tmp']:
+      with open(os.path.join(self.temp_dir, 'tmp', filename), 'w') as f:
+        f.write('?')
+    self.assertEqual(journal.collect(keep=[os.path.join(self.temp_dir, 'tmp', 'warning.tmp')]),
+                     2)
+    self.assertEqual(sorted(os.listdir(os.path.join(self.temp_dir, 'tmp'))),
+                     sorted([os.path.basename(temp_path), 'warning.tmp']))
+    journal.close()
+
+  def test_other_processes(self):
+    url = 'http://example.com/GCA_1/a'
+    first = DownloadJournal(self.temp_dir, checkpoint_bytes=1)
+    temp_path = first.start('GCA_1/a', url)
+    self.write_partial(temp_path, 'ACGT')
+    first.progress(temp_path, 4)
+    self.write_partial(os.path.join(self.temp_dir, 'tmp', 'download.tmp'), '?')
+    # e.g. genbankfs-materialize next to a mount
+    second = DownloadJournal(self.temp_dir)
+    self.assertFalse(second.exclusive)
+    self.assertEqual(second.collect(), 0)
+    self.assertEqual(second.interrupted(), [])
+    self.assertIsNone(second.start('GCA_1/a', url))
+    with open(temp_path) as f:
+      self.assertEqual(f.read(), 'ACGT')
+    # once the first has gone, the second can carry on with its downloads
+    first.close()
+    self.assertEqual(second.interrupted(), ['GCA_1/a'])
+    self.assertEqual(second.start('GCA_1/a', url), temp_path)
+    self.assertEqual(os.path.getsize(temp_path), 4)
+    second.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+class TestResumingDownloads(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="journal_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    self.contents = os.urandom(300 * 1024)
+    make_accession(self.origin_dir, 'GCA_1', {'GCA_1_genomic.gbff.gz': self.contents})
+    self.resume_path = os.path.join(self.temp_dir, 'tmp', 'partial.tmp')
+    os.makedirs(os.path.dirname(self.resume_path))
+
+  def write_partial(self, size):
+    with open(self.resume_path, 'wb') as f:
+      f.write(self.contents[:size])
+
+  def progress(self, progress, temp_path, bytes_written):
+    progress.append((temp_path, bytes_written, os.path.getsize(temp_path)))
+
+  def retrieve(self, url):
+    """Returns the progress reported before anything was downloaded"""
+    progress = []
+    temp_file, headers = DownloadWithExceptions().retrieve_tempfile(
+      url, os.path.join(self.temp_dir, 'tmp'), progress=partial(self.progress, progress),
+      resume_path=self.resume_path)
+    self.check(temp_file)
+    self.assertEqual(progress[-1][:2], (self.resume_path, len(self.contents)))
+    return progress[0][1:]
+
+  def check(self, temp_file):
+    self.assertEqual(temp_file.name, self.resume_path)
+    self.assertEqual(temp_file.md5, hashlib.md5(self.contents).hexdigest())
+    with open(temp_file.name, 'rb') as f:
+      self.assertEqual(f.read(), self.contents)
+    temp_file.close()
+    self.assertFalse(os.path.exists(self.resume_path))
+
+  def test_http_resumes(self):
+    self.write_partial(100000)
+    with HTTPOrigin(self.origin_dir) as origin:
+      self.assertEqual(self.retrieve(origin.url + "/GCA_1/GCA_1_genomic.gbff.gz"),
+                       (100000, 100000))
+      self.assertEqual(origin.requests[-1][2], 'bytes=100000-')
+      # Starts again if what's there is too long (saying so before
+      # throwing it away so readers can give up on it)
+      self.write_partial(len(self.contents))
+      with open(self.resume_path, 'ab') as f:
+        f.write('extra')
+      self.assertEqual(self.retrieve(origin.url + "/GCA_1/GCA_1_genomic.gbff.gz"),
+                       (0, len(self.contents) + 5))
+
+  def test_http_without_ranges(self):
+    self.write_partial(100000)
+    with HTTPOrigin(self.origin_dir, ranges=False) as origin:
+      self.assertEqual(self.retrieve(origin.url + "/GCA_1/GCA_1_genomic.gbff.gz"),
+                       (0, 100000))
+
+  def test_ftp_resumes(self):
+    self.write_partial(100000)
+    with FTPOrigin(self.origin_dir) as origin:
+      self.assertEqual(self.retrieve(origin.url + "/GCA_1/GCA_1_genomic.gbff.gz"),
+                       (100000, 100000))
+      self.assertIn(('REST', '100000'), origin.commands)
+
+  def test_engine_resumes(self):
+    engine = DownloadEngine(timeout=5)
+    try:
+      for origin, first in [(HTTPOrigin(self.origin_dir), 100000),
+                            (HTTPOrigin(self.origin_dir, ranges=False), 0),
+                            (FTPOrigin(self.origin_dir), 100000)]:
+        self.write_partial(100000)
+        results = Queue()
+        progress = []
+        with origin:
+          engine.fetch(origin.url + "/GCA_1/GCA_1_genomic.gbff.gz", None,
+                       partial(self.progress, progress), lambda *args: results.put(args),
+                       resume_path=self.resume_path)
+          temp_file, error = results.get(timeout=10)
+        self.assertEqual(error, None)
+        self.check(temp_file)
+        self.assertIn((self.resume_path, first, 100000), progress)
+    finally:
+      engine.stop()
+
+  def test_failed_downloads_are_kept(self):
+    self.write_partial(100000)
+    with HTTPOrigin(self.origin_dir) as origin:
+      self.assertRaises(IOError, DownloadWithExceptions().retrieve_tempfile,
+                        origin.url + "/GCA_1/missing", os.path.join(self.temp_dir, 'tmp'),
+                        resume_path=self.resume_path)
+    self.assertEqual(os.path.getsize(self.resume_path), 100000)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+class TestCacheJournal(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="journal_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    self.cache_dir = os.path.join(self.temp_dir, 'cache')
+    self.contents = os.urandom(300 * 1024)
+    make_accession(self.origin_dir, 'GCA_1', {'GCA_1_genomic.gbff.gz': self.contents})
+
+  def wait_until_cached(self, cache, path, timeout=10):
+    deadline = time.time() + timeout
+    while not cache.is_cached(path) and time.time() < deadline:
+      time.sleep(0.05)
+    self.assertTrue(cache.is_cached(path))
+
+  def interrupt(self, url):
+    """Leaves the cache as if it was stopped part way through downloading url"""
+    if not os.path.isdir(os.path.join(self.cache_dir, 'tmp')):
+      os.makedirs(os.path.join(self.cache_dir, 'tmp'))
+    journal = DownloadJournal(self.cache_dir)
+    with open(journal.start('GCA_1/GCA_1_genomic.gbff.gz', url), 'wb') as f:
+      f.write(self.contents[:200000])
+    journal.close()
+    with open(os.path.join(self.cache_dir, 'tmp', 'abandoned.tmp'), 'w') as f:
+      f.write('?')
+
+  def test_interrupted_downloads_are_resumed(self):
+    path = 'GCA_1/GCA_1_genomic.gbff.gz'
+    with HTTPOrigin(self.origin_dir) as origin:
+      for event_loop in [False, True]:
+        self.interrupt("%s/%s" % (origin.url, path))
+        cache = GenbankCache(self.cache_dir, lambda path: "%s/%s" % (origin.url, path),
+                             discover_sizes=False, verify_checksums=False,
+                             event_loop=event_loop)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'tmp', 'abandoned.tmp')))
+        self.wait_until_cached(cache, path)
+        cache.close()
+        with open(os.path.join(self.cache_dir, path), 'rb') as f:
+          self.assertEqual(f.read(), self.contents)
+        self.assertEqual(origin.requests[-1], ('GET', '/' + path, 'bytes=200000-'))
+        self.assertEqual(cache.journal.interrupted(), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache_dir, 'tmp'))),
+                         sorted(os.path.basename(path) for path in cache.warning_files.values()))
+        os.remove(os.path.join(self.cache_dir, path))
+
+  def test_other_origins_leave_partial_downloads_alone(self):
+    path = 'GCA_1/GCA_1_genomic.gbff.gz'
+    empty_dir = os.path.join(self.temp_dir, 'peer')
+    os.makedirs(empty_dir)
+    with HTTPOrigin(self.origin_dir) as origin, CacheServer(empty_dir, ('127.0.0.1', 0)) as peer:
+      lookup = lambda path: "%s/%s" % (origin.url, path)
+      for event_loop in [False, True]:
+        self.interrupt(lookup(path))
+        cache = GenbankCache(self.cache_dir,
+                             OriginChain([PeerOrigin(peer.url), UpstreamOrigin(lookup)]),
+                             discover_sizes=False, verify_checksums=False,
+                             event_loop=event_loop)
+        self.wait_until_cached(cache, path)
+        cache.close()
+        with open(os.path.join(self.cache_dir, path), 'rb') as f:
+          self.assertEqual(f.read(), self.contents)
+        self.assertEqual(origin.requests[-1], ('GET', '/' + path, 'bytes=200000-'))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache_dir, 'tmp'))),
+                         sorted(os.path.basename(path) for path in cache.warning_files.values()))
+        os.remove(os.path.join(self.cache_dir, path))
+
+  def test_failed_downloads_carry_on(self):
+    path = 'GCA_1/GCA_1_genomic.gbff.gz'
+    original = genbankfs.cache.DownloadWithExceptions
+    class FlakyDownload(original):
+      """Gives up after two 64kB blocks the first time"""
+      failed = False
+      def retrieve_tempfile(self, url, temp_dir, progress=None, **kwargs):
+        if FlakyDownload.failed:
+          return original.retrieve_tempfile(self, url, temp_dir, progress, **kwargs)
+        FlakyDownload.failed = True
+        def interrupt(temp_path, bytes_written):
+          progress(temp_path, bytes_written)
+          if bytes_written >= 128 * 1024:
+            raise IOError("Connection reset")
+        return original.retrieve_tempfile(self, url, temp_dir, interrupt, **kwargs)
+    genbankfs.cache.DownloadWithExceptions = FlakyDownload
+    try:
+      with HTTPOrigin(self.origin_dir) as origin:
+        cache = GenbankCache(self.cache_dir, lambda path: "%s/%s" % (origin.url, path),
+                             discover_sizes=False, verify_checksums=False)
+        fh = cache.open(path, os.O_RDONLY)
+        self.assertEqual(cache.read(len(self.contents), 0, fh), self.contents)
+        cache.release(fh)
+        cache.close()
+        self.assertEqual([byte_range for method, url, byte_range in origin.requests],
+                         [None, 'bytes=%s-' % (128 * 1024)])
+    finally:
+      genbankfs.cache.DownloadWithExceptions = original
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from genbankfs import GenbankCache
+from genbankfs.mapping import MappedFiles
+
+class TestMappedFiles(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="mapping_for_tests_",
+                                     suffix="_tmp")
+    self.files = MappedFiles()
+    self.fds = []
+
+  def write(self, path, contents):
+    with open(os.path.join(self.temp_dir, path), 'wb') as f:
+      f.write(contents)
+
+  def open(self, path):
+    fd = os.open(os.path.join(self.temp_dir, path), os.O_RDONLY)
+    self.fds.append(fd)
+    return fd
+
+  def test_mappings_are_shared(self):
+    self.write('a', 'ACGT' * 1000)
+    os.link(os.path.join(self.temp_dir, 'a'), os.path.join(self.temp_dir, 'b'))
+    first = self.files.acquire(self.open('a'))
+    second = self.files.acquire(self.open('b'))
+    self.assertIs(first, second)
+    self.assertEqual((len(self.files), first.users), (1, 2))
+    self.assertEqual(self.files.mapped_bytes(), 4000)
+    self.assertEqual(first.read(6, 2), 'GTACGT')
+    self.assertEqual(str(first.view(6, 3998)), 'GT')
+    self.assertEqual(str(first.view(6, 5000)), '')
+    self.files.release(first)
+    self.assertEqual(len(self.files), 1)
+    self.files.release(second)
+    self.assertEqual(len(self.files), 0)
+    self.assertRaises(ValueError, first.read, 1, 0) # it's been unmapped
+
+  def test_different_files(self):
+    self.write('a', 'ACGT')
+    self.write('b', 'TGCA')
+    first = self.files.acquire(self.open('a'))
+    second = self.files.acquire(self.open('b'))
+    self.assertIsNot(first, second)
+    self.assertEqual((first.read(4, 0), second.read(4, 0)), ('ACGT', 'TGCA'))
+
+  def test_empty_files_arent_mapped(self):
+    self.write('empty', '')
+    self.assertEqual(self.files.acquire(self.open('empty')), None)
+    self.assertEqual(len(self.files), 0)
+
+  def tearDown(self):
+    for fd in self.fds:
+      os.close(fd)
+    shutil.rmtree(self.temp_dir)
+
+class TestCacheMapping(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="mapping_for_tests_",
+                                     suffix="_tmp")
+    self.contents = os.urandom(300 * 1024)
+    os.makedirs(os.path.join(self.temp_dir, 'GCA_1'))
+    with open(os.path.join(self.temp_dir, 'GCA_1', 'README.txt'), 'wb') as f:
+      f.write(self.contents)
+
+  def test_cached_files_are_read_from_one_mapping(self):
+    cache = GenbankCache(self.temp_dir, lambda path: None)
+    handles = [cache.open('GCA_1/README.txt', os.O_RDONLY) for i in xrange(3)]
+    self.assertEqual(len(cache.mapped_files), 1)
+    self.assertEqual(cache.read(128 * 1024, 100, handles[0]),
+                     self.contents[100:100 + 128 * 1024])
+    view = cache.read_view(128 * 1024, 250 * 1024, handles[1])
+    self.assertIsInstance(view, buffer)
+    self.assertEqual(str(view), self.contents[250 * 1024:])
+    self.assertEqual(cache.metrics.value('genbankfs_served_bytes_total'),
+                     128 * 1024 + 50 * 1024)
+    self.assertIn('genbankfs_mapped_files 1\n', cache.metrics.render())
+    for fh in handles:
+      cache.release(fh)
+    self.assertEqual(len(cache.mapped_files), 0)
+    cache.close()
+
+  def test_without_mapping(self):
+    cache = GenbankCache(self.temp_dir, lambda path: None, map_files=False)
+    fh = cache.open('GCA_1/README.txt', os.O_RDONLY)
+    self.assertEqual(cache.read_view(10, 5, fh), self.contents[5:15])
+    cache.release(fh)
+    self.assertEqual(cache.mapped_files, None)
+    cache.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
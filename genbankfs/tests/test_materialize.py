@@ -0,0 +1,88 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from genbankfs import GenbankCache, GenbankSearch
+from genbankfs.materialize import materialize, matching_paths, parse_terms
+from genbankfs.tests.fake_origin import HTTPOrigin, make_accession
+from genbankfs.tests.synthetic import assembly_summary
+
+def wait_for(predicate, timeout=5):
+  deadline = time.time() + timeout
+  while not predicate() and time.time() < deadline:
+    time.sleep(0.01)
+  return predicate()
+
+class TestMaterialize(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="materialize_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    os.makedirs(self.origin_dir)
+    self.origin = HTTPOrigin(self.origin_dir).start()
+    self.searcher = GenbankSearch(assembly_summary(20, genera=2, species_per_genus=2,
+                                                   ftp_root=self.origin.url))
+    self.genus = self.searcher.list('genus')[0]
+    self.accessions = self.searcher.list('accession', genus=self.genus)
+    for accession in self.accessions:
+      make_accession(self.origin_dir, accession,
+                     {'md5checksums.txt': accession,
+                      accession + '_genomic.fna.gz': accession * 10})
+    self.cache = GenbankCache(os.path.join(self.temp_dir, 'cache'),
+                              self.searcher.build_url_lookup(),
+                              discover_sizes=False, max_queue=20)
+
+  def test_parse_terms(self):
+    self.assertEqual(parse_terms(['genus=foo', 'species=bar']),
+                     {'genus': 'foo', 'species': 'bar'})
+    self.assertRaises(ValueError, parse_terms, ['genus'])
+    self.assertRaises(ValueError, parse_terms, ['genus='])
+
+  def test_matching_paths(self):
+    paths = matching_paths(self.searcher, ['md5checksums.txt'], genus=self.genus)
+    self.assertEqual(paths, ["%s/md5checksums.txt" % accession
+                             for accession in sorted(self.accessions)])
+    self.assertEqual(len(matching_paths(self.searcher, genus=self.genus)),
+                     7 * len(self.accessions))
+    self.assertRaises(ValueError, matching_paths, self.searcher, colour='blue')
+
+  def test_materialize(self):
+    files = ['md5checksums.txt', '{accession}_genomic.fna.gz', 'README.txt']
+    results = materialize(self.searcher, self.cache, files=files, genus=self.genus)
+    self.assertEqual(results['downloaded'], 2 * len(self.accessions))
+    self.assertEqual(results['failed'], len(self.accessions))
+    for accession in self.accessions:
+      self.assertTrue(self.cache.is_cached(accession + '/md5checksums.txt'))
+      self.assertTrue(self.cache.is_cached(accession + '/%s_genomic.fna.gz' % accession))
+    results = materialize(self.searcher, self.cache, files=files[:1], genus=self.genus)
+    self.assertEqual(results['cached'], len(self.accessions))
+    self.assertEqual(results['downloaded'], 0)
+
+  def test_prefetch_siblings(self):
+    self.cache.prefetch_siblings = True
+    accession = self.accessions[0]
+    fh = self.cache.open(accession + '/md5checksums.txt', os.O_RDONLY)
+    self.assertEqual(self.cache.read(100, 0, fh), accession)
+    self.cache.release(fh)
+    sibling = '%s/%s_genomic.fna.gz' % (accession, accession)
+    self.assertTrue(wait_for(lambda: self.cache.is_cached(sibling)))
+    self.assertTrue(wait_for(lambda: not self.cache.downloads))
+    prefetched = [path for method, path, byte_range in self.origin.requests]
+    self.assertEqual(len(prefetched), 7)
+    fh = self.cache.open(sibling, os.O_RDONLY)
+    self.assertEqual(self.cache.read(1000, 0, fh), accession * 10)
+    self.cache.release(fh)
+    self.assertEqual(len(self.origin.requests), 7)
+
+  def tearDown(self):
+    self.cache.close()
+    self.origin.stop()
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
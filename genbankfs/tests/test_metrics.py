@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+
+import unittest
+import urllib2
+
+from threading import Thread
+
+from genbankfs.metrics import Histogram, Metrics, MetricsServer
+from genbankfs.tests.foreign_thread import call_from_foreign_threads
+
+class TestMetrics(unittest.TestCase):
+  def test_render(self):
+    metrics = Metrics()
+    metrics.describe('requests_total', "Requests")
+    metrics.inc('requests_total', op='read')
+    metrics.inc('requests_total', 2, op='read')
+    metrics.inc('requests_total', op='open')
+    metrics.gauge('queue_depth', lambda: 7)
+    metrics.observe('latency_seconds', 0.003, buckets=(0.001, 0.01), op='read')
+    metrics.observe('latency_seconds', 5, buckets=(0.001, 0.01), op='read')
+    self.assertEqual(metrics.value('requests_total', op='read'), 3)
+    self.assertEqual(metrics.render().splitlines(), [
+      '# HELP requests_total Requests',
+      '# TYPE requests_total counter',
+      'requests_total{op="open"} 1',
+      'requests_total{op="read"} 3',
+      '# TYPE queue_depth gauge',
+      'queue_depth 7',
+      '# TYPE latency_seconds histogram',
+      'latency_seconds_bucket{op="read",le="0.001"} 0',
+      'latency_seconds_bucket{op="read",le="0.01"} 1',
+      'latency_seconds_bucket{op="read",le="+Inf"} 2',
+      'latency_seconds_sum{op="read"} 5.003',
+      'latency_seconds_count{op="read"} 2'])
+
+  def test_timed(self):
+    metrics = Metrics()
+    for i in xrange(3):
+      with metrics.timed('op_seconds', op='getattr'):
+        pass
+    histogram = metrics.histogram('op_seconds', op='getattr')
+    self.assertEqual(histogram.count, 3)
+    self.assertLess(histogram.sum, 0.1)
+
+  def test_threads(self):
+    metrics = Metrics()
+    def record():
+      for i in xrange(100):
+        metrics.inc('reads_total')
+        metrics.observe('read_seconds', 0.001)
+    threads = [Thread(target=record) for i in xrange(4)]
+    for thread in threads[:2]:
+      thread.start()
+      thread.join()
+    self.assertEqual(metrics.value('reads_total'), 200)
+    for thread in threads[2:]:
+      thread.start()
+    for thread in threads[2:]:
+      thread.join()
+    record()
+    record() # with the same shard
+    self.assertLessEqual(len(metrics.shards), 5)
+    self.assertEqual(metrics.value('reads_total'), 600)
+    self.assertEqual(metrics.histogram('read_seconds').count, 600)
+    self.assertIn('reads_total 600\n', metrics.render())
+
+  def test_foreign_threads(self):
+    metrics = Metrics()
+    call_from_foreign_threads(lambda: metrics.inc('reads_total'), 100)
+    self.assertEqual(metrics.value('reads_total'), 100)
+    self.assertLessEqual(len(metrics.shards), 2) # not one per call
+
+  def test_quantile(self):
+    histogram = Histogram((1, 2, 4))
+    self.assertIsNone(histogram.quantile(0.5))
+    for value in [0.5] * 50 + [1.5] * 49 + [3]:
+      histogram.observe(value)
+    self.assertEqual(histogram.quantile(0.5), 1)
+    self.assertEqual(histogram.quantile(0.99), 2)
+    self.assertEqual(histogram.quantile(1), 4)
+    histogram.observe(10)
+    self.assertEqual(histogram.quantile(1), float('inf'))
+
+  def test_server(self):
+    metrics = Metrics()
+    metrics.inc('requests_total')
+    with MetricsServer(metrics, ('127.0.0.1', 0)) as server:
+      url = "http://127.0.0.1:%s/metrics" % server.server_address[1]
+      self.assertIn('requests_total 1\n', urllib2.urlopen(url).read())
+      self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/nope')
+
+if __name__ == '__main__':
+  unittest.main()
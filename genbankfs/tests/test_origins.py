@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from time import sleep, time
+
+from genbankfs import GenbankCache
+from genbankfs.origins import (CacheServer, OriginChain, PeerOrigin,
+                               SharedDirectoryOrigin, UpstreamOrigin)
+from genbankfs.tests.fake_origin import HTTPOrigin, make_accession
+
+def unreachable_url():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  url = "http://127.0.0.1:%s" % sock.getsockname()[1]
+  sock.close() # so nothing is listening
+  return url
+
+def read_through_chain(cache_dir, shared_dir, upstream_url):
+  """Run in another process: reads GCA_1/file, writing it back to shared_dir"""
+  origins = OriginChain([SharedDirectoryOrigin(shared_dir, write_back=True),
+                         UpstreamOrigin(lambda p: upstream_url + '/' + p)])
+  cache = GenbankCache(cache_dir, origins, streaming=False, discover_sizes=False,
+                       verify_checksums=False)
+  try:
+    fh = cache.open('GCA_1/file', os.O_RDONLY)
+    cache.read(10**6, 0, fh)
+    cache.release(fh)
+    deadline = time() + 10
+    while (not os.path.isfile(os.path.join(shared_dir, 'GCA_1', 'file')) and
+           time() < deadline):
+      sleep(0.05)
+  finally:
+    cache.close()
+
+class TestOrigins(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="origins_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    self.shared_dir = os.path.join(self.temp_dir, 'shared')
+    self.contents = 'upstream file\n' * 1000
+    make_accession(self.origin_dir, 'GCA_1', {'file': self.contents,
+                                              'other': 'other file'})
+    self.caches = []
+
+  def tearDown(self):
+    for cache in self.caches:
+      cache.close()
+    shutil.rmtree(self.temp_dir)
+
+  def make_cache(self, name, origins, **kwargs):
+    cache = GenbankCache(os.path.join(self.temp_dir, name), origins, streaming=False,
+                         discover_sizes=False, verify_checksums=False, **kwargs)
+    self.caches.append(cache)
+    return cache
+
+  def read(self, cache, path):
+    fh = cache.open(path, os.O_RDONLY)
+    try:
+      return cache.read(10**6, 0, fh)
+    finally:
+      cache.release(fh)
+
+  def wait_for_file(self, path, timeout=10):
+    deadline = time() + timeout
+    while not os.path.isfile(path) and time() < deadline:
+      sleep(0.05)
+    return os.path.isfile(path)
+
+  def upstream_requests(self, upstream):
+    return [path for command, path, byte_range in upstream.requests]
+
+  def test_shared_directory_first(self):
+    make_accession(self.shared_dir, 'GCA_1', {'file': 'shared copy'})
+    with HTTPOrigin(self.origin_dir) as upstream:
+      for event_loop in (False, True):
+        origins = OriginChain([SharedDirectoryOrigin(self.shared_dir),
+                               UpstreamOrigin(lambda p: upstream.url + '/' + p)])
+        cache = self.make_cache('cache_%s' % event_loop, origins, event_loop=event_loop)
+        self.assertEqual(self.read(cache, 'GCA_1/file'), 'shared copy')
+        self.assertEqual(self.read(cache, 'GCA_1/other'), 'other file')
+      self.assertEqual(self.upstream_requests(upstream),
+                       ['/GCA_1/other', '/GCA_1/other'])
+
+  def test_write_back(self):
+    with HTTPOrigin(self.origin_dir) as upstream:
+      origins = OriginChain([SharedDirectoryOrigin(self.shared_dir, write_back=True),
+                             UpstreamOrigin(lambda p: upstream.url + '/' + p)])
+      cache = self.make_cache('cache', origins)
+      self.assertEqual(self.read(cache, 'GCA_1/file'), self.contents)
+      shared_path = os.path.join(self.shared_dir, 'GCA_1', 'file')
+      self.assertTrue(self.wait_for_file(shared_path))
+      with open(shared_path) as f:
+        self.assertEqual(f.read(), self.contents)
+      self.assertEqual(os.listdir(os.path.dirname(shared_path)), ['file'])
+
+  def test_peer(self):
+    with HTTPOrigin(self.origin_dir) as upstream:
+      lookup = lambda p: upstream.url + '/' + p
+      first = self.make_cache('first', lookup)
+      self.assertEqual(self.read(first, 'GCA_1/file'), self.contents)
+      with CacheServer(first.root_dir, ('127.0.0.1', 0)) as server:
+        for event_loop in (False, True):
+          origins = OriginChain([PeerOrigin(server.url), UpstreamOrigin(lookup)])
+          second = self.make_cache('second_%s' % event_loop, origins,
+                                   event_loop=event_loop)
+          self.assertEqual(self.read(second, 'GCA_1/file'), self.contents)
+          # the peer doesn't have this so we go upstream
+          self.assertEqual(self.read(second, 'GCA_1/other'), 'other file')
+      self.assertEqual(self.upstream_requests(upstream),
+                       ['/GCA_1/file', '/GCA_1/other', '/GCA_1/other'])
+
+  def test_cache_server(self):
+    make_accession(self.shared_dir, 'GCA_1', {'file': 'cached'})
+    make_accession(self.shared_dir, 'tmp', {'file': 'partial'})
+    server = CacheServer(self.shared_dir)
+    self.assertEqual(server.cached_path('/GCA_1/file'),
+                     os.path.join(server.root_dir, 'GCA_1', 'file'))
+    for path in ['/GCA_1/missing', '/tmp/file', '/GCA_1', '/GCA_1/../GCA_1/file',
+                 '/GCA_1/file/']:
+      self.assertIsNone(server.cached_path(path))
+    server.server_close()
+
+  def test_dead_peer(self):
+    peer = PeerOrigin(unreachable_url(), timeout=1)
+    with HTTPOrigin(self.origin_dir) as upstream:
+      origins = OriginChain([peer, UpstreamOrigin(lambda p: upstream.url + '/' + p)])
+      cache = self.make_cache('cache', origins)
+      self.assertEqual(self.read(cache, 'GCA_1/file'), self.contents)
+    self.assertGreater(peer.down_until, time())
+    self.assertEqual([source.origin for source in origins.sources('GCA_1/other')],
+                     [origins.upstream])
+
+  def test_nodes_share_a_directory(self):
+    with HTTPOrigin(self.origin_dir) as upstream:
+      node = multiprocessing.Process(target=read_through_chain,
+                                     args=(os.path.join(self.temp_dir, 'first'),
+                                           self.shared_dir, upstream.url))
+      node.start()
+      node.join(30)
+      self.assertEqual(node.exitcode, 0)
+      self.assertEqual(self.upstream_requests(upstream), ['/GCA_1/file'])
+    # upstream has gone away but the file is in the shared directory
+    upstream_url = unreachable_url()
+    origins = OriginChain([SharedDirectoryOrigin(self.shared_dir),
+                           UpstreamOrigin(lambda p: upstream_url + '/' + p)])
+    cache = self.make_cache('second', origins)
+    self.assertEqual(self.read(cache, 'GCA_1/file'), self.contents)
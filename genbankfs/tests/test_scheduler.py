@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+
+import unittest
+
+from Queue import Full
+from threading import Thread
+
+from genbankfs.scheduler import (DownloadScheduler, background_priority,
+                                 foreground_priority, prefetch_priority)
+
+def make_scheduler(max_queued=10, **kwargs):
+  return DownloadScheduler({foreground_priority: max_queued,
+                            prefetch_priority: max_queued,
+                            background_priority: max_queued}, **kwargs)
+
+def run_all(scheduler):
+  jobs = []
+  while scheduler.qsize():
+    entry = scheduler.get()
+    jobs.append(entry.job)
+    scheduler.done(entry)
+  return jobs
+
+class TestScheduler(unittest.TestCase):
+  def test_classes(self):
+    scheduler = make_scheduler()
+    scheduler.put('size lookup', background_priority)
+    scheduler.put('prefetch', prefetch_priority)
+    scheduler.put('read', foreground_priority)
+    self.assertEqual(run_all(scheduler), ['read', 'prefetch', 'size lookup'])
+
+  def test_smallest_first(self):
+    scheduler = make_scheduler()
+    scheduler.put('unknown 1', foreground_priority)
+    scheduler.put('big', foreground_priority, size=10**9)
+    scheduler.put('unknown 2', foreground_priority)
+    scheduler.put('small', foreground_priority, size=100)
+    self.assertEqual(run_all(scheduler), ['small', 'big', 'unknown 1', 'unknown 2'])
+
+  def test_starved_jobs_go_first(self):
+    scheduler = make_scheduler(max_wait=60)
+    scheduler.put('big', foreground_priority, size=10**9).queued_at -= 61
+    scheduler.put('small', foreground_priority, size=100)
+    self.assertEqual(run_all(scheduler), ['big', 'small'])
+
+  def test_processes_take_turns(self):
+    scheduler = make_scheduler()
+    for i in xrange(3):
+      scheduler.put('greedy %s' % i, foreground_priority, pid=1, size=1)
+    scheduler.put('modest', foreground_priority, pid=2, size=10)
+    self.assertEqual(run_all(scheduler), ['greedy 0', 'modest', 'greedy 1', 'greedy 2'])
+
+  def test_per_host_limit(self):
+    scheduler = make_scheduler(per_host=1)
+    scheduler.put('a1', foreground_priority, host='a', size=1)
+    scheduler.put('a2', foreground_priority, host='a', size=2)
+    scheduler.put('b1', prefetch_priority, host='b', size=1)
+    first = scheduler.get()
+    second = scheduler.get()
+    self.assertEqual((first.job, second.job), ('a1', 'b1'))
+    waiting = []
+    thread = Thread(target=lambda: waiting.append(scheduler.get()))
+    thread.daemon = True
+    thread.start()
+    thread.join(0.1)
+    self.assertEqual(waiting, []) # a2 has to wait for a1
+    scheduler.done(first)
+    thread.join(1)
+    self.assertEqual(waiting[0].job, 'a2')
+
+  def test_full(self):
+    scheduler = make_scheduler(max_queued=2)
+    scheduler.put('prefetch 1', prefetch_priority)
+    scheduler.put('prefetch 2', prefetch_priority)
+    self.assertRaises(Full, scheduler.put, 'prefetch 3', prefetch_priority)
+    scheduler.put('read', foreground_priority)
+    self.assertEqual(scheduler.qsize(), 3)
+    self.assertEqual(scheduler.qsize(prefetch_priority), 2)
+
+  def test_promote(self):
+    scheduler = make_scheduler()
+    scheduler.put('prefetch', prefetch_priority, pid=1)
+    scheduler.put('read', foreground_priority, pid=1)
+    self.assertTrue(scheduler.promote('prefetch', foreground_priority, pid=2))
+    self.assertEqual(scheduler.qsize(foreground_priority), 2)
+    self.assertEqual(run_all(scheduler), ['read', 'prefetch'])
+    self.assertFalse(scheduler.promote('prefetch', foreground_priority))
+
+  def test_close(self):
+    scheduler = make_scheduler(per_host=1)
+    scheduler.put('running', foreground_priority, host='ncbi')
+    scheduler.put('prefetch', prefetch_priority, host='ncbi')
+    self.assertEqual(scheduler.get().job, 'running')
+    got = []
+    waiting = Thread(target=lambda: got.append(scheduler.get())) # for the prefetch
+    waiting.start()
+    self.assertEqual([entry.job for entry in scheduler.close()], ['prefetch'])
+    waiting.join()
+    self.assertEqual((got, scheduler.qsize()), ([None], 0))
+    self.assertRaises(Full, scheduler.put, 'read', foreground_priority)
+
+if __name__ == '__main__':
+  unittest.main()
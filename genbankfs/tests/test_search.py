@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+
+import unittest
+
+import pandas as pd
+
+from StringIO import StringIO
+
+from genbankfs import GenbankSearch
+from genbankfs.tests.synthetic import assembly_summary
+
+summary = """\
+assembly_accession\ttaxid\tspecies_taxid\torganism_name\tftp_path
+GCA_000007045.1\t171101\t1313\tStreptococcus pneumoniae R6\tftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCA_000007045.1_ASM704v1
+GCA_000006885.1\t170187\t1313\tStreptococcus pneumoniae TIGR4\tftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCA_000006885.1_ASM688v1
+GCA_000007265.1\t208435\t1311\tStreptococcus agalactiae 2603V/R\tftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCA_000007265.1_ASM726v1
+GCA_000005845.2\t511145\t562\tEscherichia coli str. K-12 substr. MG1655\tftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCA_000005845.2_ASM584v2
+"""
+
+class TestSearch(unittest.TestCase):
+  def setUp(self):
+    self.searcher = GenbankSearch(StringIO(summary))
+
+  def test_list_everything(self):
+    self.assertEqual(self.searcher.list('genus'),
+                     ['escherichia', 'streptococcus'])
+    self.assertEqual(self.searcher.list('species_taxid'),
+                     ['1311', '1313', '562'])
+
+  def test_list_with_terms(self):
+    self.assertEqual(self.searcher.list('species', genus='streptococcus'),
+                     ['streptococcus_agalactiae', 'streptococcus_pneumoniae'])
+    self.assertEqual(self.searcher.list('accession', genus='streptococcus',
+                                        species_taxid='1313'),
+                     ['GCA_000006885.1_ASM688v1', 'GCA_000007045.1_ASM704v1'])
+    self.assertEqual(self.searcher.list('organism_name',
+                                        species='escherichia_coli'),
+                     ['escherichia_coli_str_k_12_substr_mg1655'])
+
+  def test_list_no_matches(self):
+    self.assertEqual(self.searcher.list('accession', genus='streptococcus',
+                                        species_taxid='562'), [])
+    self.assertEqual(self.searcher.list('accession', genus='not_a_genus'), [])
+
+  def test_exists(self):
+    self.assertTrue(self.searcher.exists())
+    self.assertTrue(self.searcher.exists(genus='streptococcus', species_taxid='1311'))
+    self.assertTrue(self.searcher.exists(genus='Streptococcus'))
+    self.assertFalse(self.searcher.exists(genus='streptococcus', species_taxid='562'))
+    self.assertFalse(self.searcher.exists(genus='not_a_genus'))
+    self.assertTrue(self.searcher.exists(accession='GCA_000007045.1_ASM704v1',
+                                         taxid='171101'))
+    self.assertFalse(self.searcher.exists(accession='GCA_000007045.1_ASM704v1',
+                                          taxid='170187'))
+
+  def test_list_unknown_folder(self):
+    self.assertRaises(ValueError, self.searcher.list, 'foo')
+
+  def test_query(self):
+    result = self.searcher.query(taxid='171101', foo='bar')
+    self.assertEqual(list(result['accession_slug']), ['GCA_000007045.1_ASM704v1'])
+    self.assertEqual(list(result['ftp_path']),
+                     ['ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCA_000007045.1_ASM704v1'])
+    self.assertEqual(list(result['genus_slug']), ['streptococcus'])
+    self.assertEqual(len(self.searcher.query()), 4)
+
+  def test_url_lookup(self):
+    lookup = self.searcher.build_url_lookup()
+    self.assertEqual(lookup('GCA_000005845.2_ASM584v2/README.txt'),
+                     'ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCA_000005845.2_ASM584v2/README.txt')
+
+  def test_matches_dataframe_query(self):
+    summary = assembly_summary(2000, genera=10, species_per_genus=5,
+                               strains_per_species=5)
+    searcher = GenbankSearch(summary)
+    summary.seek(0)
+    database = pd.read_csv(summary, delimiter='\t')
+    searcher._add_slug_columns(database)
+    genus = searcher.list('genus')[3]
+    species = searcher.list('species', genus=genus)[1]
+    expected = database[(database['genus_slug'] == genus) &
+                        (database['species_slug'] == species)]
+    self.assertEqual(searcher.list('taxid', genus=genus, species=species),
+                     sorted(set(expected['taxid_slug'])))
+    self.assertEqual(list(searcher.query(genus=genus, species=species).index),
+                     list(expected.index))
+
+if __name__ == '__main__':
+  unittest.main()
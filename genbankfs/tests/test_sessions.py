@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+from threading import Thread
+
+from genbankfs import GenbankCache, sessions
+from genbankfs.sessions import SessionError, SessionPool, thread_sessions
+from genbankfs.sizes import parse_ftp_listing
+from genbankfs.sparse import fetch_range
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin, make_accession
+from genbankfs.tests.foreign_thread import call_from_foreign_threads
+
+class TruncatingHandler(StreamRequestHandler):
+  """Hangs up part way through a chunked response"""
+  def handle(self):
+    while self.rfile.readline().strip():
+      pass
+    self.wfile.write("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                     "100\r\ncut short")
+
+class TestSessions(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="sessions_for_tests_",
+                                     suffix="_tmp")
+    self.files = dict(("file_%s" % i, str(i) * (1000 * i)) for i in xrange(1, 8))
+    make_accession(self.temp_dir, 'GCA_1', self.files)
+    make_accession(self.temp_dir, 'GCA_2', {'other': 'other file'})
+
+  def test_ftp_session_is_reused(self):
+    with FTPOrigin(self.temp_dir) as origin:
+      pool = SessionPool()
+      for filename, contents in sorted(self.files.items()):
+        transfer = pool.open("%s/GCA_1/%s" % (origin.url, filename))
+        self.assertEqual(int(transfer.info()['content-length']), len(contents))
+        self.assertEqual(transfer.read(), contents)
+        transfer.close()
+      self.assertEqual(pool.open(origin.url + "/GCA_2/other").read(), 'other file')
+      self.assertEqual(origin.connections, 1)
+      commands = [command for command, argument in origin.commands]
+      self.assertEqual(commands.count('USER'), 1)
+      self.assertEqual(commands.count('CWD'), 2)
+      self.assertEqual(commands.count('RETR'), 8)
+
+  def test_ftp_reconnects(self):
+    with FTPOrigin(self.temp_dir) as origin:
+      pool = SessionPool()
+      url = origin.url + "/GCA_1/file_1"
+      transfer = pool.open(url)
+      transfer.read()
+      transfer.close()
+      pool.session(url).ftp.sock.close() # as if the server had hung up
+      self.assertEqual(pool.open(url).read(), self.files['file_1'])
+      self.assertEqual(origin.connections, 2)
+
+  def test_ftp_missing_file(self):
+    with FTPOrigin(self.temp_dir) as origin:
+      pool = SessionPool()
+      self.assertRaises(SessionError, pool.open, origin.url + "/GCA_1/missing")
+      self.assertRaises(SessionError, pool.open, origin.url + "/GCA_3/missing")
+      self.assertEqual(pool.open(origin.url + "/GCA_2/other").read(), 'other file')
+      self.assertEqual(origin.connections, 1)
+
+  def test_ftp_listing_and_ranges(self):
+    with FTPOrigin(self.temp_dir) as origin:
+      pool = SessionPool()
+      sizes = parse_ftp_listing(pool.listing(origin.url + "/GCA_1/"))
+      self.assertEqual(sizes, dict((name, len(contents)) for name, contents
+                                   in self.files.items()))
+      url = origin.url + "/GCA_1/file_3"
+      self.assertEqual(fetch_range(url, 1000, 1010), (1000, '3' * 10, 3000))
+      self.assertEqual(fetch_range(url, 2990, 4000), (2990, '3' * 10, 3000))
+
+  def test_http_session_is_reused(self):
+    with HTTPOrigin(self.temp_dir, keep_alive=True) as origin:
+      pool = SessionPool()
+      for filename, contents in sorted(self.files.items()):
+        transfer = pool.open("%s/GCA_1/%s" % (origin.url, filename))
+        self.assertEqual(transfer.read(), contents)
+        transfer.close()
+      self.assertEqual(pool.head(origin.url + "/GCA_2/other")['content-length'], '10')
+      self.assertEqual(pool.open(origin.url + "/GCA_2/other").read(), 'other file')
+      self.assertEqual(origin.connections, 1)
+      # errors close the connection but it's reopened for the next request
+      self.assertEqual(pool.head(origin.url + "/GCA_2/missing"), None)
+      self.assertRaises(SessionError, pool.open, origin.url + "/GCA_2/missing")
+      self.assertEqual(pool.open(origin.url + "/GCA_2/other").read(), 'other file')
+
+  def test_http_reconnects(self):
+    with HTTPOrigin(self.temp_dir, keep_alive=True) as origin:
+      pool = SessionPool()
+      url = origin.url + "/GCA_1/file_1"
+      pool.open(url).read()
+      pool.session(url).connection.sock.close()
+      self.assertEqual(pool.open(url).read(), self.files['file_1'])
+      self.assertEqual(origin.connections, 2)
+
+  def test_http_cut_short(self):
+    server = ThreadingTCPServer(('127.0.0.1', 0), TruncatingHandler)
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+      url = "http://127.0.0.1:%s/GCA_1/cut_short" % server.server_address[1]
+      self.assertRaises(SessionError, SessionPool().open(url).read)
+      with HTTPOrigin(self.temp_dir) as origin:
+        lookup = lambda path: url if path == 'GCA_1/cut_short' else origin.url + '/' + path
+        cache = GenbankCache(os.path.join(self.temp_dir, 'cache'), lookup,
+                             concurent_downloads=1, streaming=False,
+                             discover_sizes=False, verify_checksums=False)
+        try:
+          for path in ['GCA_1/cut_short', 'GCA_1/file_1']:
+            fh = cache.open(path, os.O_RDONLY)
+            data = cache.read(10000, 0, fh)
+            cache.release(fh)
+          self.assertEqual(data, self.files['file_1'])
+          self.assertTrue(cache.threads[0].is_alive())
+        finally:
+          cache.close()
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_thread_sessions(self):
+    sessions._pools.clear() # so the first call makes a new pool
+    sessions._pools['finished'] = SessionPool()
+    sessions._pools['finished'].last_used = 0
+    pools = call_from_foreign_threads(thread_sessions, 50)
+    self.assertLessEqual(len(set(map(id, pools))), 2) # not one per call
+    self.assertNotIn('finished', sessions._pools)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
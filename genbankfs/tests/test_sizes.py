@@ -0,0 +1,86 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from genbankfs import GenbankCache
+from genbankfs.sizes import SizeDiscovery, SizeIndex, parse_ftp_listing
+from genbankfs.tests.fake_origin import HTTPOrigin, make_accession
+
+ftp_listing = """\
+-r--r--r--   1 ftp      anonymous     1954 Jun 10  2015 GCA_000007045.1_ASM704v1_assembly_report.txt
+-r--r--r--   1 ftp      anonymous   605137 Jun 10  2015 GCA_000007045.1_ASM704v1_genomic.fna.gz
+lr--r--r--   1 ftp      anonymous       47 Jun 10  2015 latest -> GCA_000007045.1_ASM704v1_genomic.fna.gz
+dr-xr-xr-x   2 ftp      anonymous     4096 Jun 10  2015 some_directory
+-r--r--r--   1 ftp      anonymous      727 Jun 10  2015 md5checksums.txt
+"""
+
+def wait_for(predicate, timeout=5):
+  deadline = time.time() + timeout
+  while not predicate() and time.time() < deadline:
+    time.sleep(0.01)
+  return predicate()
+
+class TestSizes(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="sizes_for_tests_",
+                                     suffix="_tmp")
+    self.origin_dir = os.path.join(self.temp_dir, 'origin')
+    make_accession(self.origin_dir, 'GCA_1', {'README.txt': 'x' * 123,
+                                              'GCA_1_genomic.fna.gz': 'y' * 4567})
+    self.origin = HTTPOrigin(self.origin_dir).start()
+    self.lookup = lambda path: "%s/%s" % (self.origin.url, path)
+
+  def test_parse_ftp_listing(self):
+    expected = {
+      'GCA_000007045.1_ASM704v1_assembly_report.txt': 1954,
+      'GCA_000007045.1_ASM704v1_genomic.fna.gz': 605137,
+      'md5checksums.txt': 727
+    }
+    self.assertEqual(parse_ftp_listing(ftp_listing), expected)
+
+  def test_size_index_is_persisted(self):
+    index_path = os.path.join(self.temp_dir, 'sizes.tsv')
+    index = SizeIndex(index_path)
+    index.update({'GCA_1/README.txt': 10, 'GCA_1/foo': 20})
+    index.update({'GCA_1/README.txt': 30})
+    reloaded = SizeIndex(index_path)
+    self.assertEqual(reloaded.get('GCA_1/README.txt'), 30)
+    self.assertEqual(reloaded.get('GCA_1/foo'), 20)
+    self.assertEqual(reloaded.get('GCA_1/bar'), None)
+
+  def test_http_discovery(self):
+    index = SizeIndex(os.path.join(self.temp_dir, 'sizes.tsv'))
+    discovery = SizeDiscovery(index, self.lookup)
+    discovery.request('GCA_1/README.txt')
+    discovery.request('GCA_1/GCA_1_genomic.fna.gz')
+    discovery.request('GCA_1/missing.txt')
+    self.assertTrue(wait_for(lambda: not discovery.pending))
+    self.assertEqual(index.get('GCA_1/README.txt'), 123)
+    self.assertEqual(index.get('GCA_1/GCA_1_genomic.fna.gz'), 4567)
+    self.assertEqual(index.get('GCA_1/missing.txt'), None)
+    self.assertIn('GCA_1/missing.txt', discovery.failed)
+
+  def test_cache_getattr(self):
+    cache = GenbankCache(os.path.join(self.temp_dir, 'cache'), self.lookup,
+                         unknown_size=42)
+    attributes = cache.getattr('GCA_1/README.txt')
+    self.assertEqual(attributes['st_size'], 42)
+    self.assertTrue(wait_for(lambda: cache.sizes.get('GCA_1/README.txt')))
+    self.assertEqual(cache.getattr('GCA_1/README.txt')['st_size'], 123)
+    # so that the kernel can cache them
+    self.assertEqual(cache.getattr('GCA_1/README.txt')['st_mtime'], attributes['st_mtime'])
+    self.assertEqual(attributes['st_mtime'], cache.created_at)
+    self.assertEqual(cache.getattr('GCA_1/missing.txt')['st_size'], 42)
+    cache.close()
+
+  def tearDown(self):
+    self.origin.stop()
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from mock import patch
+
+from genbankfs import GenbankSearch
+from genbankfs.snapshot import source_digest
+from genbankfs.tests.synthetic import write_assembly_summary
+
+class TestSnapshot(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="snapshot_for_tests_",
+                                     suffix="_tmp")
+    self.summary_path = os.path.join(self.temp_dir, 'assembly_summary.txt')
+    with open(self.summary_path, 'w') as f:
+      write_assembly_summary(f, 500, genera=5, species_per_genus=3,
+                             strains_per_species=4)
+    self.snapshot_root = os.path.join(self.temp_dir, 'metadata')
+
+  def load(self):
+    with open(self.summary_path) as f:
+      return GenbankSearch(f, snapshot_root=self.snapshot_root)
+
+  def test_remount_uses_snapshot(self):
+    original = self.load()
+    with patch.object(GenbankSearch, '_build') as build_mock:
+      remounted = self.load()
+      self.assertFalse(build_mock.called)
+    self.assertIsInstance(remounted.indexes['genus'].codes, np.memmap)
+    for folder in original.folders:
+      self.assertEqual(remounted.list(folder), original.list(folder))
+    genus = original.list('genus')[1]
+    self.assertEqual(remounted.list('taxid', genus=genus),
+                     original.list('taxid', genus=genus))
+    accession = original.list('accession')[7]
+    path = "%s/README.txt" % accession
+    self.assertEqual(remounted.build_url_lookup()(path),
+                     original.build_url_lookup()(path))
+
+  def test_snapshot_is_keyed_by_content(self):
+    self.load()
+    with open(self.summary_path, 'a') as f:
+      f.write("GCA_1\tPRJNA1\t1\t1\tFoo bar baz\tASM1\tftp://foo/GCA_1_ASM1\n")
+    remounted = self.load()
+    self.assertIn('GCA_1_ASM1', remounted.list('accession'))
+    # two snapshots and sources.json
+    self.assertEqual(len(os.listdir(self.snapshot_root)), 3)
+
+  def test_digest_is_remembered(self):
+    with open(self.summary_path) as f:
+      digest = source_digest(f, self.snapshot_root)
+      self.assertEqual(f.tell(), 0)
+    with open(self.summary_path) as f:
+      with patch('genbankfs.snapshot.hashlib') as hashlib_mock:
+        self.assertEqual(source_digest(f, self.snapshot_root), digest)
+        self.assertFalse(hashlib_mock.sha1.called)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
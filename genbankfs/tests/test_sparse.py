@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from genbankfs import GenbankCache
+from genbankfs.sparse import SparseFile, fetch_range
+from genbankfs.tests.fake_origin import FTPOrigin, HTTPOrigin, make_accession
+
+class TestSparse(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(dir=os.getcwd(),
+                                     prefix="sparse_for_tests_",
+                                     suffix="_tmp")
+    self.contents = os.urandom(1000 * 1000)
+    make_accession(os.path.join(self.temp_dir, 'origin'), 'GCA_1',
+                   {'GCA_1_genomic.fna.gz': self.contents})
+    self.origin = HTTPOrigin(os.path.join(self.temp_dir, 'origin')).start()
+    self.lookup = lambda path: "%s/%s" % (self.origin.url, path)
+    self.cache = GenbankCache(os.path.join(self.temp_dir, 'cache'), self.lookup,
+                              discover_sizes=False, sparse=True,
+                              block_size=64*1024, read_ahead=0)
+    self.path = 'GCA_1/GCA_1_genomic.fna.gz'
+
+  def range_requests(self):
+    return [request for request in self.origin.requests if request[2]]
+
+  def test_fetch_range(self):
+    url = self.lookup(self.path)
+    self.assertEqual(fetch_range(url, 10, 20),
+                     (10, self.contents[10:20], len(self.contents)))
+    self.origin.ranges = False
+    self.assertEqual(fetch_range(url, 10, 20),
+                     (0, self.contents, len(self.contents)))
+
+  def test_unknown_size(self):
+    with FTPOrigin(os.path.join(self.temp_dir, 'origin'), sizes=False) as origin:
+      cache = GenbankCache(os.path.join(self.temp_dir, 'ftp_cache'),
+                           lambda path: "%s/%s" % (origin.url, path),
+                           discover_sizes=False, sparse=True, block_size=64*1024,
+                           read_ahead=0)
+      try:
+        # so the whole file is downloaded rather than filled in
+        fh = cache.open(self.path, os.O_RDONLY)
+        self.assertEqual(cache.read(len(self.contents), 0, fh), self.contents)
+        cache.release(fh)
+        self.assertEqual(cache.sparse_files, {})
+      finally:
+        cache.close() # which waits for the download to be stored
+    self.assertTrue(cache.is_cached(self.path))
+
+  def test_only_fetches_what_is_read(self):
+    fh = self.cache.open(self.path, os.O_RDONLY)
+    self.assertEqual(len(self.range_requests()), 1) # to find the size
+    self.assertEqual(self.cache.read(100, 10, fh), self.contents[10:110])
+    self.assertEqual(len(self.range_requests()), 1)
+    self.assertEqual(self.cache.read(100, 500000, fh), self.contents[500000:500100])
+    self.assertEqual(self.range_requests()[-1][2], 'bytes=458752-524287')
+    self.assertEqual(self.cache.getattr(self.path)['st_size'], len(self.contents))
+    self.assertFalse(os.path.exists(os.path.join(self.cache.root_dir, self.path)))
+
+  def test_promoted_when_complete(self):
+    fh = self.cache.open(self.path, os.O_RDONLY)
+    contents = "".join(self.cache.read(128*1024, offset, fh)
+                       for offset in xrange(0, len(self.contents), 128*1024))
+    self.assertEqual(contents, self.contents)
+    with open(os.path.join(self.cache.root_dir, self.path), 'rb') as f:
+      self.assertEqual(f.read(), self.contents)
+    partial_path = os.path.join(self.cache.root_dir, 'partial', self.path)
+    self.assertFalse(os.path.exists(partial_path))
+    self.assertFalse(os.path.exists(partial_path + '.blocks'))
+    self.cache.release(fh)
+    self.assertEqual(self.cache.sparse_files, {})
+
+  def test_read_ahead_grows(self):
+    self.cache.read_ahead = 64*1024
+    fh = self.cache.open(self.path, os.O_RDONLY)
+    for offset in xrange(0, 512*1024, 4096):
+      self.cache.read(4096, offset, fh)
+    self.assertEqual(self.cache.handles[fh].read_ahead, 16*1024**2)
+    ranges = [request[2] for request in self.range_requests()]
+    self.assertEqual(ranges, ['bytes=0-65535', 'bytes=65536-131071',
+                              'bytes=131072-196607', 'bytes=196608-327679',
+                              'bytes=327680-589823', 'bytes=589824-999999'])
+
+  def test_blocks_survive_restart(self):
+    data_path = os.path.join(self.temp_dir, 'sparse_file')
+    sparse_file = SparseFile(data_path, 1000, 100)
+    sparse_file.write(200, "x" * 150)
+    sparse_file.close()
+    sparse_file = SparseFile(data_path, 1000, 100)
+    self.assertEqual([sparse_file.has_block(b) for b in xrange(4)],
+                     [False, False, True, False])
+    self.assertEqual(sparse_file.missing_ranges(0, 1000), [[0, 2], [3, 10]])
+
+  def tearDown(self):
+    self.cache.close()
+    self.origin.stop()
+    shutil.rmtree(self.temp_dir)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,8 +8,7 @@ setup(
   licence='MIT',
   install_requires=[
     'boltons>=15.0.0',
-    'fusepy>=2.0.2',
-    'numexpr>=2.4.3',
+    'fusepy>=3.0.1',
     'numpy>=1.9.1',
     'pandas>=0.16.2'
   ],
@@ -18,5 +17,5 @@ setup(
     'mock'
   ],
   packages=['genbankfs'],
-  scripts=['scripts/genbankfs-start']
+  scripts=['scripts/genbankfs-start', 'scripts/genbankfs-materialize']
 )